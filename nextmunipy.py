@@ -3,19 +3,60 @@
 # original version: 2012/05/14
 
 from xml.dom import minidom
-import urllib2
+from xml.parsers.expat import ExpatError
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
+import httplib
+from cStringIO import StringIO
+import urlparse
+import socket
+import zlib
+import threading
+import heapq, random
+import hashlib, re
+import os
+import tempfile
+import gzip
+from multiprocessing.pool import ThreadPool
 import numpy
 import time
 import warnings
+from array import array
 from datetime import datetime, timedelta
 # import nmvis
 
 
 # some definitions
 MAX_STOPS_PER_PREDICTION = 150
-MIN_TIME_BETWEEN_REQUESTS = 45
+MAX_CONCURRENT_REQUESTS = 4		# number of worker threads used to send the chunks of a split prediction request
+MIN_TIME_BETWEEN_REQUESTS = 45		# seconds; the request budget lets REQUEST_BURST requests through per this period
 STOP_DATABASE_FILENAME = '/users/jason/documents/python work/NextMuniStopDatabase.dat'
+ROUTE_CACHE_DIRECTORY = '/users/jason/documents/python work/RouteCache'
+ROUTE_CACHE_TTL = 24 * 60 * 60		# seconds; cached route configurations older than this are downloaded again
+ROUTE_CACHE_VERSION = 2
+USE_ROUTE_CACHE = True
 KEEP_PREDICTION_XML = False
+PREDICTION_ATTRIBUTES = set(['minutes', 'seconds', 'vehicle', 'block', 'tripTag', 'affectedByLayover', 
+                             'isDeparture', 'epochTime', 'dirTag'])		# the attributes of a complete <prediction> element
+USE_STREAMING_PARSER = True		# parse prediction responses incrementally instead of building a minidom DOM
+NEXTBUS_URL = 'http://webservices.nextbus.com/service/publicXMLFeed?command='
+HTTP_POOL_SIZE = 4			# maximum number of idle keep-alive connections kept per host
+HTTP_TIMEOUT = 30.0			# seconds
+HTTP_USE_GZIP = True		# ask for gzip-compressed responses
+HTTP_READ_SIZE = 16 * 1024
+USE_REQUEST_BUDGET = True	# every request waits for the shared RequestBudget (see getRequestBudget)
+REQUEST_BURST = 10			# requests that can be sent at once, after the budget has been idle; this also limits the
+				#   steady rate (to 10 per MIN_TIME_BETWEEN_REQUESTS), so a TrackerScheduler raises it to
+				#   what one period of its polls needs (see RequestBudget.ensureBurst)
+BYTE_BUDGET = 2 * 1024 * 1024	# bytes (as received) that can be downloaded per BYTE_BUDGET_PERIOD
+BYTE_BUDGET_PERIOD = 20.0	# seconds
+REQUEST_RETRIES = 3			# times a failed request is sent again (when the failure may be transient)
+RETRY_BACKOFF = 2.0			# seconds; the n-th retry waits RETRY_BACKOFF * 2**n, plus up to as much again of jitter
+DEFAULT_REQUEST_PRIORITY = 30.0	# priority of requests that give none (lower is sooner; trackers use the minutes to the next arrival)
+PREDICTIONS_BLOCK_PATTERN = re.compile(r'<predictions\b[^>]*?(?:/>|>.*?</predictions>)', re.S)	# one stop's block of a response
+BLOCK_TAG_PATTERN = re.compile(r'\b(routeTag|stopTag)="([^"]*)"')
 
 
 # a struct for holding characters used to parse/write data files,
@@ -35,6 +76,14 @@ class DatabaseParser:
         self.routesTag = 'routes'
         self.routeDirTag = 'routedirs'
         self.commentTag = '#'
+        self.cacheRouteTag = '@route'		# first field of route/direction lines in a route cache file
+        self.cacheDirectionTag = '@direction'
+        self.tagTag = 'tag'
+        self.titleTag = 'title'
+        self.stopsTag = 'stops'
+        self.savedTag = 'saved'
+        self.versionTag = 'version'
+        self.escapes = [('%', '%25'), (';', '%3B'), ('=', '%3D'), (',', '%2C'), ('\n', '%0A')]	# (in the order applied by escape)
         self.order = ['routeTag', 'stopTag', 'vehicle', 'directionTag', \
                       'startTime', 'endTime', 'currentTime', \
                       'predictedWait', 'actualWait', 'uncertainty',
@@ -67,21 +116,596 @@ class DatabaseParser:
     def longitudeIndex(self): return self.index('longitude')
     def lonIndex(self): return self.index('longitude')
     
+    # a value with its separator characters escaped (so that it can be written as a tag-value pair), and back
+    def escape(self, value):
+        for (c, code) in self.escapes: value = value.replace(c, code)
+        return value
+    def unescape(self, value):
+        for (c, code) in reversed(self.escapes): value = value.replace(code, c)
+        return value
+    
 		
    
-# general function for sending commands to NextBus.com using its public API
-def sendCommand(cmdStr):
+#
+# NextBusError
+#
+class NextBusError(Exception):
+    '''
+    An error reported by nextbus.com (an <Error> element, or an HTTP error code).  shouldRetry is True if
+    the same request may succeed later (NextBus sets it for errors such as an overloaded server).
+    '''
+    def __init__(self, message, shouldRetry=False):
+        Exception.__init__(self, message)
+        self.shouldRetry = shouldRetry
+        
+        
+# True if a failed request may succeed when sent again: network errors, HTTP errors, truncated
+#    responses, and the NextBus errors that say so
+def isRetryable(e):
+    if isinstance(e, NextBusError): return e.shouldRetry
+    return isinstance(e, (IOError, httplib.HTTPException, SyntaxError, ExpatError))
+    
+    
+# call function(*args), retrying (after an exponentially growing, jittered delay) up to REQUEST_RETRIES
+#    times while it fails in a way that may be transient
+def callWithRetries(function, *args):
+    for attempt in range(REQUEST_RETRIES + 1):
+        try:
+            return function(*args)
+        except Exception as e:
+            if attempt >= REQUEST_RETRIES or not isRetryable(e): raise
+            delay = RETRY_BACKOFF * 2 ** attempt
+            delay += random.uniform(0, delay)
+            warnings.warn("Request failed (%s); retrying in %.1f s" % (e, delay))
+            sleep(delay)
+            
+            
+#
+# Clock
+#
+class Clock:
+    '''
+    The source of the current time for nextmunipy and nmtracker (see now, clockTime and sleep).  The shared
+    clock is replaced by a SimulatedClock while recorded responses are replayed.
+    '''
+    def now(self):
+        return datetime.now()
+        
+    # seconds since the epoch
+    def time(self):
+        return time.time()
+        
+    def sleep(self, seconds):
+        time.sleep(seconds)
+        
+        
+#
+# SimulatedClock
+#
+class SimulatedClock(Clock):
+    '''
+    A clock that only moves when it is told to: sleeping advances it at once, and a ResponseReplayer moves
+    it to the time of each response it replays.
+    '''
+    def __init__(self, startTime=0.0):
+        self.currentTime = startTime		# seconds since the epoch
+        
+    def now(self):
+        return datetime.fromtimestamp(self.currentTime)
+        
+    def time(self):
+        return self.currentTime
+        
+    def sleep(self, seconds):
+        self.currentTime += max(seconds, 0)
+        
+    # move the clock forward to t (never back)
+    def advanceTo(self, t):
+        self.currentTime = max(self.currentTime, t)
+        
+        
+# the shared clock
+clock = Clock()
+
+def now():
+    return clock.now()
+    
+def clockTime():
+    return clock.time()
+    
+def sleep(seconds):
+    clock.sleep(seconds)
+    
+    
+#
+# ResponseRecorder
+#
+class ResponseRecorder:
+    '''
+    Appends every response received by openCommand (and sendCommand) to a gzip-compressed log, with the time
+    of its request, so that a run can be replayed later without nextbus.com (see ResponseReplayer).  Each
+    entry is a line '<time> <length> <command>' followed by the (decompressed) response and a newline.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.fid = gzip.open(filename, 'ab')
+        self.lock = threading.Lock()
+        self.count = 0
+        
+    def record(self, t, cmdStr, data):
+        self.lock.acquire()
+        try:
+            self.fid.write('%r %i %s\n' % (t, len(data), cmdStr))
+            self.fid.write(data)
+            self.fid.write('\n')
+            self.count += 1
+        finally:
+            self.lock.release()
+            
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.fid: self.fid.close()
+            self.fid = None
+        finally:
+            self.lock.release()
+            
+            
+# the (time, command, response) entries of a response log, in the order they were recorded
+def iterRecordedResponses(filename):
+    fid = gzip.open(filename, 'rb')
+    try:
+        while True:
+            header = fid.readline()
+            if not header.endswith('\n'): break		# (the end of the log, or a partly written entry)
+            (t, n, cmdStr) = header[:-1].split(' ', 2)
+            data = fid.read(int(n))
+            if len(data) < int(n) or fid.read(1) != '\n': break
+            yield (float(t), cmdStr, data)
+    finally:
+        fid.close()
+        
+        
+#
+# ReplayFinished
+#
+class ReplayFinished(Exception):
+    '''
+    Raised when a request has no (more) recorded responses to replay.
+    '''
+    pass
+    
+    
+#
+# ResponseReplayer
+#
+class ResponseReplayer:
+    '''
+    Answers the requests of openCommand from a response log (see ResponseRecorder) instead of nextbus.com.
+    The responses to each command are handed out in the order they were recorded, and the simulated clock
+    is moved to the time of each one, so that the replayed run sees the same times as the recorded run
+    (as long as it sends the same requests).  The log is read as the requests come in; only the responses
+    read past on the way to a request (those of other commands) are kept in memory.
+    '''
+    def __init__(self, filename, clock):
+        self.filename = filename
+        self.clock = clock
+        
+        # (the times and number of responses, from a first pass that keeps none of them)
+        self.startTime = None
+        self.endTime = None
+        self.count = 0
+        for (t, cmdStr, data) in iterRecordedResponses(filename):
+            if self.startTime is None: self.startTime = t
+            self.endTime = t
+            self.count += 1
+            
+        self.entries = iterRecordedResponses(filename)
+        self.pending = {}		# dictionary (key=command) of lists of (time, response) read but not replayed yet
+        self.lock = threading.Lock()
+        self.replayedCount = 0
+        
+    # the next recorded (time, response) of a command (None if the log has no more), read from the
+    #    log if none is pending (called with the lock held)
+    def nextResponse(self, cmdStr):
+        responses = self.pending.get(cmdStr)
+        if responses:
+            if len(responses) == 1: del self.pending[cmdStr]
+            return responses.pop(0)
+        for (t, cmd, data) in self.entries:
+            if cmd == cmdStr: return (t, data)
+            if cmd not in self.pending: self.pending[cmd] = []
+            self.pending[cmd].append((t, data))
+        return None
+        
+    # the next recorded response to a command (as a file-like object)
+    def open(self, cmdStr):
+        self.lock.acquire()
+        try:
+            response = self.nextResponse(cmdStr)
+            if not response: raise ReplayFinished('No recorded response left for ' + cmdStr)
+            (t, data) = response
+            self.clock.advanceTo(t)
+            self.replayedCount += 1
+        finally:
+            self.lock.release()
+        return StringIO(data)
+        
+    # close the log
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.entries.close()
+            self.pending = {}
+        finally:
+            self.lock.release()
+            
+            
+# the recorder and replayer used by openCommand (see startRecording and startReplay)
+responseRecorder = None
+responseReplayer = None
+
+# record every response to a (gzip-compressed) log file
+def startRecording(filename):
+    global responseRecorder
+    stopRecording()
+    responseRecorder = ResponseRecorder(filename)
+    return responseRecorder
+    
+def stopRecording():
+    global responseRecorder
+    if responseRecorder: responseRecorder.close()
+    responseRecorder = None
+    
+# answer requests from a response log, on a simulated clock that starts at the log's first request
+#    (the request budget is not used while replaying)
+def startReplay(filename):
+    global responseReplayer, clock, USE_REQUEST_BUDGET
+    stopReplay()
+    simulatedClock = SimulatedClock()
+    responseReplayer = ResponseReplayer(filename, simulatedClock)
+    if responseReplayer.startTime is not None: simulatedClock.advanceTo(responseReplayer.startTime)
+    responseReplayer.useRequestBudget = USE_REQUEST_BUDGET		# (restored by stopReplay)
+    clock = simulatedClock
+    USE_REQUEST_BUDGET = False
+    return responseReplayer
+    
+def stopReplay():
+    global responseReplayer, clock, USE_REQUEST_BUDGET
+    if not responseReplayer: return
+    responseReplayer.close()
+    USE_REQUEST_BUDGET = responseReplayer.useRequestBudget
+    responseReplayer = None
+    clock = Clock()
+    
+    
+#
+# HTTPConnectionPool
+#
+class HTTPConnectionPool:
+    '''
+    Keeps idle keep-alive connections to each host, so that repeated requests to nextbus.com do not pay
+    for TCP (and DNS) setup every time.  One pool is shared by every call to openCommand/sendCommand.
+    '''
+    def __init__(self, maxSize=None, timeout=None, useGzip=None):
+        if maxSize is None: maxSize = HTTP_POOL_SIZE
+        if timeout is None: timeout = HTTP_TIMEOUT
+        if useGzip is None: useGzip = HTTP_USE_GZIP
+        self.maxSize = maxSize
+        self.timeout = timeout
+        self.useGzip = useGzip
+        
+        self.idleConnections = {}	# dictionary (key=host) containing lists of idle connections
+        self.lock = threading.Lock()
+        self.requestCount = 0
+        self.connectionCount = 0
+        
+    # take an idle connection to host from the pool, or open a new one
+    def getConnection(self, host):
+        self.lock.acquire()
+        try:
+            conns = self.idleConnections.get(host)
+            if conns: return conns.pop()
+            self.connectionCount += 1
+        finally:
+            self.lock.release()
+        return httplib.HTTPConnection(host, timeout=self.timeout)
+        
+    # return a connection (whose response has been read completely) to the pool
+    def releaseConnection(self, host, conn):
+        self.lock.acquire()
+        try:
+            conns = self.idleConnections.setdefault(host, [])
+            if len(conns) < self.maxSize:
+                conns.append(conn)
+                return
+        finally:
+            self.lock.release()
+        conn.close()
+        
+    # close all idle connections
+    def closeAll(self):
+        self.lock.acquire()
+        try:
+            for conns in self.idleConnections.values():
+                for conn in conns:
+                    conn.close()
+            self.idleConnections = {}
+        finally:
+            self.lock.release()
+    
+    # send a GET request for url, returning a file-like PooledResponse
+    def urlopen(self, url):
+        parts = urlparse.urlsplit(url)
+        host = parts.netloc
+        path = parts.path
+        if parts.query: path += '?' + parts.query
+        
+        headers = {'Connection': 'keep-alive'}
+        if self.useGzip: headers['Accept-Encoding'] = 'gzip'
+        
+        for attempt in range(2):
+            conn = self.getConnection(host)
+            isReused = conn.sock is not None
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                break
+            except (httplib.HTTPException, socket.error):
+                # the server may have dropped an idle connection; retry once on a fresh one
+                conn.close()
+                if not isReused or attempt > 0: raise
+                
+        self.lock.acquire()
+        self.requestCount += 1
+        self.lock.release()
+        return PooledResponse(self, host, conn, response)
+        
+        
+#
+# PooledResponse
+#
+class PooledResponse:
+    '''
+    A file-like wrapper around a response from an HTTPConnectionPool.  Gzip-encoded bodies are decompressed
+    as they are read, and the connection goes back to the pool once the body has been read completely.
+    '''
+    def __init__(self, pool, host, conn, response):
+        self.pool = pool
+        self.host = host
+        self.conn = conn
+        self.response = response
+        self.code = response.status
+        
+        self.decompressor = None
+        if (response.getheader('content-encoding') or '').lower() == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = ''
+        self.isFinished = False
+        self.byteCount = 0		# bytes received (before decompression)
+        self.budget = None		# the RequestBudget charged for the bytes, once the body has been read
+        
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while not self.isFinished: self.fill()
+            data = self.buffer
+            self.buffer = ''
+            return data
+        
+        while len(self.buffer) < size and not self.isFinished:
+            self.fill()
+        data = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return data
+        
+    # read the next chunk of the body into the buffer
+    def fill(self):
+        chunk = self.response.read(HTTP_READ_SIZE)
+        if not chunk:
+            if self.decompressor: self.buffer += self.decompressor.flush()
+            self.finish(True)
+            return
+        self.byteCount += len(chunk)
+        if self.decompressor: chunk = self.decompressor.decompress(chunk)
+        self.buffer += chunk
+        
+    # hand the connection back to the pool (if the body was read completely), or close it
+    def finish(self, isComplete):
+        if self.isFinished: return
+        self.isFinished = True
+        if self.budget: self.budget.chargeBytes(self.byteCount)
+        if isComplete and not self.response.will_close:
+            self.pool.releaseConnection(self.host, self.conn)
+        else:
+            self.conn.close()
+        
+    def close(self):
+        self.finish(False)
+        
+        
+#
+# RequestBudget
+#
+class RequestBudget:
+    '''
+    A pair of token buckets shared by all requests to nextbus.com: one of requests (REQUEST_BURST of them
+    per MIN_TIME_BETWEEN_REQUESTS seconds) and one of bytes (BYTE_BUDGET per BYTE_BUDGET_PERIOD seconds).
+    A request waits in acquire() until both buckets have tokens; the bytes of its response are charged
+    once they have been read (so a large response delays the requests after it).  Requests that wait at
+    the same time (e.g. the chunks of a split request) are let through by priority (lower first); a
+    TrackerScheduler sends the polls of different routes in priority order as well.
+    '''
+    def __init__(self, requestBurst=None, requestPeriod=None, byteBudget=None, bytePeriod=None):
+        if requestBurst is None: requestBurst = REQUEST_BURST
+        if requestPeriod is None: requestPeriod = MIN_TIME_BETWEEN_REQUESTS
+        if byteBudget is None: byteBudget = BYTE_BUDGET
+        if bytePeriod is None: bytePeriod = BYTE_BUDGET_PERIOD
+        self.requestBurst = float(requestBurst)
+        self.requestRate = requestBurst / float(requestPeriod)		# tokens per second
+        self.byteBudget = float(byteBudget)
+        self.byteRate = byteBudget / float(bytePeriod)
+        
+        self.requestTokens = self.requestBurst
+        self.byteTokens = self.byteBudget
+        self.lastRefillTime = clockTime()
+        self.condition = threading.Condition()
+        self.waiting = []		# heap of (priority, sequence number) of the waiting requests
+        self.sequence = 0
+        
+        self.requestCount = 0
+        self.byteCount = 0
+        self.delayedCount = 0	# requests that had to wait
+        self.totalDelay = 0.0	# seconds
+        self.maxDelay = 0.0
+        
+    # add the tokens earned since the last refill (called with the condition held)
+    def refill(self):
+        now = clockTime()
+        elapsed = now - self.lastRefillTime
+        self.lastRefillTime = now
+        self.requestTokens = min(self.requestTokens + elapsed * self.requestRate, self.requestBurst)
+        self.byteTokens = min(self.byteTokens + elapsed * self.byteRate, self.byteBudget)
+        
+    # seconds until both buckets have tokens again
+    def timeUntilReady(self):
+        t = 0.0
+        if self.requestTokens < 1.0: t = max(t, (1.0 - self.requestTokens) / self.requestRate)
+        if self.byteTokens <= 0.0: t = max(t, (1.0 - self.byteTokens) / self.byteRate)
+        return max(t, 0.01)
+        
+    # wait until a request can be sent; returns the time (in seconds) spent waiting
+    def acquire(self, priority=None):
+        if priority is None: priority = DEFAULT_REQUEST_PRIORITY
+        t0 = clockTime()
+        
+        self.condition.acquire()
+        try:
+            entry = (priority, self.sequence)
+            self.sequence += 1
+            heapq.heappush(self.waiting, entry)
+            try:
+                while True:
+                    self.refill()
+                    if self.waiting[0] == entry and self.requestTokens >= 1.0 and self.byteTokens > 0.0: break
+                    self.waitForTokens()
+            except:
+                # (a request whose wait was interrupted, e.g. by KeyboardInterrupt, leaves the line)
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+                self.condition.notifyAll()
+                raise
+            heapq.heappop(self.waiting)
+            self.requestTokens -= 1.0
+            self.condition.notifyAll()		# (the next request in line may be able to go as well)
+            
+            delay = clockTime() - t0
+            self.requestCount += 1
+            if delay > 0.01:
+                self.delayedCount += 1
+                self.totalDelay += delay
+                self.maxDelay = max(self.maxDelay, delay)
+        finally:
+            self.condition.release()
+        return delay
+        
+    # wait (with the condition held) until the buckets may have tokens again; a SimulatedClock is moved 
+    #    forward instead, since no time would pass while waiting for it
+    def waitForTokens(self):
+        if isinstance(clock, SimulatedClock): clock.sleep(self.timeUntilReady())
+        else: self.condition.wait(self.timeUntilReady())
+        
+    # let at least burst requests through per requestPeriod (the budget is only ever raised)
+    def ensureBurst(self, burst):
+        self.condition.acquire()
+        try:
+            self.refill()
+            if burst <= self.requestBurst: return
+            self.requestRate *= burst / self.requestBurst
+            self.requestBurst = float(burst)
+        finally:
+            self.condition.release()
+            
+    # charge the bytes of a response
+    def chargeBytes(self, n):
+        self.condition.acquire()
+        try:
+            self.refill()
+            self.byteTokens -= n
+            self.byteCount += n
+        finally:
+            self.condition.release()
+            
+    def show(self):
+        print "Request budget: %i requests (%i bytes) sent" % (self.requestCount, self.byteCount)
+        print "  %i requests delayed, by %.1f s in total (at most %.1f s)" % (self.delayedCount, self.totalDelay, self.maxDelay)
+        
+        
+# the budget shared by all requests
+sharedRequestBudget = None
+
+def getRequestBudget():
+    global sharedRequestBudget
+    if sharedRequestBudget is None:
+        sharedRequestBudget = RequestBudget()
+    return sharedRequestBudget
+    
+    
+# the pool shared by all requests
+sharedConnectionPool = None
+
+def getConnectionPool():
+    global sharedConnectionPool
+    if sharedConnectionPool is None:
+        sharedConnectionPool = HTTPConnectionPool()
+    return sharedConnectionPool
+    
+    
+# general function for sending commands to NextBus.com using its public API;
+#    returns the (unparsed) response as a file-like object.  The request waits for the
+#    shared RequestBudget (requests with a lower priority value go first)
+def openCommand(cmdStr, priority=None):
 
-    baseURL = 'http://webservices.nextbus.com/service/publicXMLFeed?command='
     cmdStr = cmdStr.replace(' ', '+')
-    url = baseURL + cmdStr
+    url = NEXTBUS_URL + cmdStr
+    if responseReplayer: return responseReplayer.open(cmdStr)
+    
+    t = clockTime()		# (the time the request was made, before any wait for the request budget)
+    budget = None
+    if USE_REQUEST_BUDGET:
+        budget = getRequestBudget()
+        budget.acquire(priority)
     
-    f = urllib2.urlopen(url)
+    f = getConnectionPool().urlopen(url)
+    f.budget = budget
 
     if f.code != 200:
-        raise Exception('Error: url request code is ' + str(f.code) + '; quitting.')
+        f.close()
+        raise NextBusError('Error: url request code is ' + str(f.code), shouldRetry=(f.code >= 500 or f.code == 429))
+        
+    # (a recorded response is read whole, and handed out from memory)
+    if responseRecorder:
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        responseRecorder.record(t, cmdStr, data)
+        return StringIO(data)
+
+    return f
+    
+    
+# general function for sending commands to NextBus.com using its public API;
+#    returns the response parsed into a minidom DOM (failed requests are retried, see callWithRetries)
+def sendCommand(cmdStr, priority=None):
+    return callWithRetries(sendCommandOnce, cmdStr, priority)
+    
+def sendCommandOnce(cmdStr, priority=None):
 
-    result = minidom.parse(f)
+    f = openCommand(cmdStr, priority)
+    try:
+        result = minidom.parse(f)
+    finally:
+        f.close()
 
     #if result.getElementsByTagName("Error"):        
     #    raise Exception('An error occurred while parsing XML results from URL:\n' + url + '\nError:\n' + str(result.getElementsByTagName("Error")))
@@ -92,7 +716,11 @@ def sendCommand(cmdStr):
   
 # Get predictions for all stops specified in route  
 #    returns a PredictionList object (just a list of predictions with methods to access each)
-def getMultiStopPrediction(routeTagList, stopList):
+#    (set streaming=False to parse the response with the older minidom DOM path; with a PredictionBlockCache,
+#    the stops whose predictions have not changed since the last request are left out)
+def getMultiStopPrediction(routeTagList, stopList, streaming=None, batch=False, cache=None, priority=None):
+
+    if streaming is None: streaming = USE_STREAMING_PARSER
 
     # stopList must be a list
     if type(stopList) == str: stopList = [stopList]
@@ -112,45 +740,179 @@ def getMultiStopPrediction(routeTagList, stopList):
     if len(routeTagList) != len(stopList):
         raise Exception('routeTagList and stopList must be same length')
     
-    # check stopList length; if greater than allowed, split request in half recursively.
-    if len(stopList) > MAX_STOPS_PER_PREDICTION:
+    currentTime = now()
+    if cache: cache.beginPoll()
+    
+    # split long stop lists into balanced chunks (each within the per-request limit), and send
+    #    the chunks concurrently so the whole poll takes about one round trip
+    chunks = splitStopRequest(routeTagList, stopList)
+    if len(chunks) == 1:
+        return requestPredictions(chunks[0][0], chunks[0][1], currentTime, streaming, batch, cache, priority)
+    
+    results = getRequestPool().map(lambda c: requestPredictions(c[0], c[1], currentTime, streaming, batch, cache, priority), chunks)
+    
+    # merge the chunks back into a single list (in stop order)
+    if batch:
+        predictionBatch = PredictionBatch(currentTime)
+        for r in results:
+            predictionBatch.extend(r)
+        return predictionBatch
+    predictionList = []
+    for r in results:
+        predictionList += r
+    return predictionList
+    
+    
+# Split parallel route tag/stop lists into the fewest chunks of at most maxStops stops,
+#    with chunk lengths differing by no more than one (e.g., 151 stops --> 76 + 75)
+def splitStopRequest(routeTagList, stopList, maxStops=None):
+
+    if maxStops is None: maxStops = MAX_STOPS_PER_PREDICTION
+    
+    n = len(stopList)
+    nChunks = max(int(numpy.ceil(n / float(maxStops))), 1)
+    
+    chunks = []
+    start = 0
+    for i in range(nChunks):
+        stop = start + (n - start) // (nChunks - i)
+        chunks.append( (routeTagList[start:stop], stopList[start:stop]) )
+        start = stop
+    return chunks
+    
+    
+# Send a single predictionsForMultiStops request (at most MAX_STOPS_PER_PREDICTION stops); returns
+#    a list of Predictions, or a PredictionBatch if batch is True (a failed request is retried, see callWithRetries)
+def requestPredictions(routeTagList, stopList, currentTime=None, streaming=None, batch=False, cache=None, priority=None):
+
+    if streaming is None: streaming = USE_STREAMING_PARSER
     
-        warnings.warn('Number of stops requested (%i) exceeds maximum allowed (%i).\n' \
-                      '  Attempting to split request in two...' % (len(stopList), MAX_STOPS_PER_PREDICTION))
-        try:
-            halfway = int(numpy.ceil(len(stopList) / 2.0))
-            predList1 = getMultiStopPrediction(routeTagList[:halfway], stopList[:halfway])
-            predList2 = getMultiStopPrediction(routeTagList[halfway:], stopList[halfway:])
-            nStops = len(numpy.unique( [p.stopTag for p in predList1] + [p.stopTag for p in predList2] ))
-            if len(predList1 + predList2) != nStops:
-                warnings.warn('Recursive call to getMultiStopPrediction did not return the right number of stops\n' + 
-                              '  (%i predictions for %i stops)' % (nStops, len(stopList)))
-            return (predList1 + predList2)
-        except:
-            warnings.warn('Could not split stop request in half.  Keeping only the first %i stops.' % MAX_STOPS_PER_PREDICTION)
-            stopList = stopList[0:MAX_STOPS_PER_PREDICTION]
-        
-        
     # BUILD REQUEST STRING
     cmdStr = 'predictionsForMultiStops&a=sf-muni'
     for tag, stop in zip(routeTagList, stopList):
         shortTag = tag.split('_')[0]
         cmdStr += '&stops=%s|%s' % (shortTag, stop)
+        
+    return callWithRetries(requestPredictionsOnce, cmdStr, currentTime, streaming, batch, cache, priority)
+    
+def requestPredictionsOnce(cmdStr, currentTime, streaming, batch, cache, priority):
 
-    xmlData = sendCommand(cmdStr)
+    if cache:
+        # (the response is read whole, so that its unchanged blocks can be dropped before parsing)
+        f = openCommand(cmdStr, priority)
+        try:
+            (data, digests) = cache.filterResponse(f.read())
+        finally:
+            f.close()
+        if streaming: f = StringIO(data)
+        else: xmlData = minidom.parseString(data)
+    elif streaming:
+        f = openCommand(cmdStr, priority)
+    else:
+        xmlData = sendCommandOnce(cmdStr, priority)
 
+    if streaming:
+        try:
+            if batch: result = parsePredictionBatch(f, currentTime)
+            else: result = parsePredictionStream(f, currentTime)
+        finally:
+            f.close()
+    else:
+        result = parsePredictionDOM(xmlData, currentTime)
+        if batch: result = PredictionBatch(currentTime, result)
+        
+    # (the blocks are only remembered once they have been parsed, so that a retried request parses them again)
+    if cache: cache.update(digests)
+    return result
+        
+        
+# the bounded pool of worker threads used to send chunks of a split request concurrently
+sharedRequestPool = None
+
+def getRequestPool():
+    global sharedRequestPool
+    if sharedRequestPool is None:
+        sharedRequestPool = ThreadPool(MAX_CONCURRENT_REQUESTS)
+    return sharedRequestPool
+        
+        
+# Read a predictionsForMultiStops response incrementally (SAX-style), yielding each <prediction>
+#    element's attributes (a dictionary that is only valid until the next element is read) along with
+#    (routeTag, routeName, stopTag, stopName, directionName) of its enclosing elements.  No DOM is
+#    built for the response.
+def iterPredictionStream(f):
+
+    routeTag = None; routeName = None; stopTag = None; stopName = None; directionName = None
+    
+    for (event, elem) in iterparse(f, events=('start', 'end')):
+        tag = elem.tag
+        
+        if event == 'start':
+            # the attributes of the enclosing elements are available as soon as they open
+            if tag == 'predictions':
+                attrs = elem.attrib
+                routeTag = None; routeName = None; stopTag = None; stopName = None
+                if 'routeTag' in attrs: routeTag = str(attrs['routeTag'])
+                if 'routeTitle' in attrs: routeName = str(attrs['routeTitle'])
+                if 'stopTag' in attrs: stopTag = str(attrs['stopTag'])
+                if 'stopTitle' in attrs: stopName = str(attrs['stopTitle']).replace('&amp;', '&')
+            elif tag == 'direction':
+                directionName = elem.get('title')
+            elif tag == 'Error':
+                raise NextBusError('Error in getting prediction data.', elem.get('shouldRetry') == 'true')
+                
+        elif tag == 'prediction':
+            yield (elem.attrib, routeTag, routeName, stopTag, stopName, directionName)
+            elem.clear()
+            
+        elif tag == 'predictions':
+            elem.clear()		# release the finished block
+            
+            
+# Parse a predictionsForMultiStops response incrementally, creating each Prediction as soon as
+#    its <prediction> element has been read
+def parsePredictionStream(f, currentTime=None):
+
+    if currentTime is None: currentTime = now()
+    
+    predictionList = []
+    for (attrs, routeTag, routeName, stopTag, stopName, directionName) in iterPredictionStream(f):
+        newPrediction = Prediction(attrs, currentTime)
+        newPrediction.routeTag = routeTag
+        newPrediction.routeName = routeName
+        newPrediction.stopTag = stopTag
+        newPrediction.stopName = stopName
+        newPrediction.directionName = directionName
+        newPrediction.currentTime = currentTime
+        predictionList.append(newPrediction)
+            
+    return predictionList
+    
+    
+# Parse a predictionsForMultiStops response incrementally into a PredictionBatch (no Prediction
+#    objects are created)
+def parsePredictionBatch(f, currentTime=None):
+
+    predictionBatch = PredictionBatch(currentTime)
+    for (attrs, routeTag, routeName, stopTag, stopName, directionName) in iterPredictionStream(f):
+        predictionBatch.append(attrs, routeTag, routeName, stopTag, stopName, directionName)
+    return predictionBatch
+    
+    
+# Parse a predictionsForMultiStops response that has already been loaded into a minidom DOM
+#    (the original parsing path; kept for comparison with parsePredictionStream)
+def parsePredictionDOM(xmlData, currentTime=None):
+
+    if currentTime is None: currentTime = now()
+    
     # check for a returned error
-    if xmlData.getElementsByTagName("Error"):
-        raise Exception('Error in getting prediction data.')
+    errors = xmlData.getElementsByTagName("Error")
+    if errors:
+        raise NextBusError('Error in getting prediction data.', errors[0].getAttribute('shouldRetry') == 'true')
 
     xmlByStop = xmlData.getElementsByTagName("predictions")
 
-    sec = []
-    min = []
     predictionList = []
-    currentTime = datetime.now()
-    
-    thePredictions = []    
     
     # parse each returned XML block    
     for xs in xmlByStop:
@@ -164,7 +926,6 @@ def getMultiStopPrediction(routeTagList, stopList):
         
         xmlByDir = xs.getElementsByTagName("direction")
         
-        dirs = []
         for xd in xmlByDir:
             directionName = None
             if xd.hasAttribute('title'): directionName = xd.getAttribute('title')
@@ -172,7 +933,7 @@ def getMultiStopPrediction(routeTagList, stopList):
             xmlByPred = xd.getElementsByTagName("prediction")
 
             for xp in xmlByPred:
-                newPrediction = Prediction(xp)
+                newPrediction = Prediction(xp, currentTime)
                 newPrediction.routeTag = routeTag
                 newPrediction.routeName = routeName
                 newPrediction.stopTag = stopTag
@@ -181,13 +942,45 @@ def getMultiStopPrediction(routeTagList, stopList):
                 newPrediction.currentTime = currentTime
                 
                 predictionList.append(newPrediction)
-                sec.append(newPrediction.getSeconds())
-                min.append(newPrediction.getMinutes())
     
     return predictionList
     
 
 
+# Get the locations of the vehicles on a route that have been reported since lastTime (the time
+#    returned by the previous call, in epoch milliseconds; 0 for the last 15 minutes).  Returns a list 
+#    of VehicleLocations and the time to pass on the next call.
+def getVehicleLocations(routeTag, lastTime=0):
+
+    cmdStr = 'vehicleLocations&a=sf-muni&r=%s&t=%i' % (routeFromString(routeTag), lastTime)
+    return callWithRetries(requestVehicleLocations, cmdStr, lastTime)
+    
+def requestVehicleLocations(cmdStr, lastTime):
+    f = openCommand(cmdStr)
+    try:
+        return parseVehicleLocations(f, lastTime)
+    finally:
+        f.close()
+        
+        
+# Parse a vehicleLocations response incrementally; returns (list of VehicleLocations, lastTime)
+def parseVehicleLocations(f, lastTime=0, currentTime=None):
+
+    if currentTime is None: currentTime = now()
+    
+    locations = []
+    for (event, elem) in iterparse(f):
+        if elem.tag == 'vehicle':
+            locations.append(VehicleLocation(elem.attrib, currentTime))
+            elem.clear()
+        elif elem.tag == 'lastTime':
+            lastTime = long(elem.get('time', lastTime))
+        elif elem.tag == 'Error':
+            raise NextBusError('Error in getting vehicle locations.', elem.get('shouldRetry') == 'true')
+            
+    return (locations, lastTime)
+    
+    
 # UTILITY FUNCTIONS not specific to a particular line/stop:
 
 
@@ -232,10 +1025,15 @@ def routeAndDirectionTagFromString(aStr):
 #
 # Prediction
 #
-class Prediction:
+class Prediction(object):
     '''
     Returns an object with properties that contain info on the when and where of a prediction downloaded from nextmuni.com 
+    (The attributes are fixed by __slots__, since a Prediction is created for every vehicle at every stop of every poll.)
     '''
+    __slots__ = ['routeTag', 'stopTag', 'routeName', 'stopName', 'directionName', 'directionTag', 'timeStamp', 
+                 'startTime', 'endTime', 'actualWait', 'uncertainty', 'currentTime', 
+                 'minutes', 'seconds', 'vehicle', 'block', 'tripTag', 'isLayovered', 'isDeparture', 
+                 'epochTime', 'isComplete', 'xml']
          
     # called by both __init__ and __init__(xml)
     def initialSetup(self):
@@ -244,6 +1042,7 @@ class Prediction:
         self.routeName = None        
         self.stopName = None
         self.directionName = None
+        self.directionTag = None
         self.timeStamp = None	# this is set internally, when the prediction is downloaded.
         
         # the following are set externally:
@@ -259,35 +1058,42 @@ class Prediction:
         self.epochTime = []; self.isComplete = False
         
     
-    def __init__(self, xml=None):
+    # xml is either a minidom <prediction> element, or a plain dictionary of its attributes
+    #    (as produced by the streaming parser); timeStamp is the time of download (default: now)
+    def __init__(self, xml=None, timeStamp=None):
         
         self.initialSetup()
         if not xml: return
         
-        self.timeStamp = datetime.now()
+        if timeStamp is None: timeStamp = now()
+        self.timeStamp = timeStamp
         hasAllAttributes = True
         
+        if isinstance(xml, dict): attrs = xml
+        else: attrs = dict(xml.attributes.items())
+        
         if KEEP_PREDICTION_XML: self.xml = xml
+        if KEEP_PREDICTION_XML and isinstance(xml, dict): self.xml = dict(xml)	# the streaming parser recycles its dictionaries
         
-        if xml.hasAttribute('minutes'): self.minutes = int(xml.getAttribute('minutes')); 
+        if 'minutes' in attrs: self.minutes = int(attrs['minutes']); 
         else: hasAllAttributes = False
-        if xml.hasAttribute('seconds'): self.seconds = int(xml.getAttribute('seconds')); 
+        if 'seconds' in attrs: self.seconds = int(attrs['seconds']); 
         else: hasAllAttributes = False
-        if xml.hasAttribute('vehicle'): self.vehicle = str(xml.getAttribute('vehicle')); 
+        if 'vehicle' in attrs: self.vehicle = str(attrs['vehicle']); 
         else: hasAllAttributes = False
-        if xml.hasAttribute('block'): self.block = str(xml.getAttribute('block')); 
+        if 'block' in attrs: self.block = str(attrs['block']); 
         else: hasAllAttributes = False
-        if xml.hasAttribute('tripTag'): self.tripTag = str(xml.getAttribute('tripTag')); 
+        if 'tripTag' in attrs: self.tripTag = str(attrs['tripTag']); 
         else: hasAllAttributes = False
-        if xml.hasAttribute('affectedByLayover'): self.isLayovered = bool(xml.getAttribute('affectedByLayover')); 
+        if 'affectedByLayover' in attrs: self.isLayovered = attrs['affectedByLayover'] == 'true'; 
         else: hasAllAttributes = False
-        if xml.hasAttribute('isDeparture'): self.isDeparture = bool(xml.getAttribute('isDeparture')); 
+        if 'isDeparture' in attrs: self.isDeparture = attrs['isDeparture'] == 'true'; 
         else: hasAllAttributes = False
-        if xml.hasAttribute('epochTime'): self.epochTime = int(xml.getAttribute('epochTime')); 
+        if 'epochTime' in attrs: self.epochTime = int(attrs['epochTime']); 
         else: hasAllAttributes = False
-        if xml.hasAttribute('dirTag'): self.directionTag = str(xml.getAttribute('dirTag')); 
+        if 'dirTag' in attrs: self.directionTag = str(attrs['dirTag']); 
         else: hasAllAttributes = False
-        if not self.routeTag: self.routeTag = self.directionTag.split('_')[0]
+        if not self.routeTag and self.directionTag: self.routeTag = self.directionTag.split('_')[0]
         self.isComplete = hasAllAttributes
 
     
@@ -313,7 +1119,7 @@ class Prediction:
         self.setUncertainty(delta)
               
     def setCurrentTime(self, t=None):
-        if t is None: t = datetime.now()
+        if t is None: t = now()
         self.currentTime = t
     
     
@@ -499,6 +1305,244 @@ class PredictionList:
            
            
         
+#
+# PredictionBatch
+#
+class PredictionBatch:
+    '''
+    The predictions of a whole predictionsForMultiStops response, stored by column (one list or array per
+    attribute) instead of as one Prediction object per vehicle and stop.  Individual Predictions can still
+    be made from the batch when needed (see prediction and predictions).
+    '''
+    def __init__(self, currentTime=None, predictions=None):
+        if currentTime is None: currentTime = now()
+        self.currentTime = currentTime
+        
+        self.routeTags = []; self.routeNames = []; self.stopTags = []; self.stopNames = []
+        self.directionTags = []; self.directionNames = []
+        self.vehicles = []; self.blocks = []; self.tripTags = []
+        self.minutes = array('i'); self.seconds = array('i'); self.epochTimes = array('d')	# (epoch times are in ms)
+        self.isLayovered = array('b'); self.isDeparture = array('b'); self.isComplete = array('b')
+        
+        if predictions:
+            for p in predictions: self.appendPrediction(p)
+            
+    def __len__(self):
+        return len(self.minutes)
+        
+    def __getitem__(self, i):
+        return self.prediction(i)
+        
+    # add the attributes of a <prediction> element (and its enclosing elements)
+    def append(self, attrs, routeTag=None, routeName=None, stopTag=None, stopName=None, directionName=None):
+        get = attrs.get
+        directionTag = get('dirTag')
+        if directionTag is not None: directionTag = str(directionTag)
+        if not routeTag and directionTag: routeTag = directionTag.split('_')[0]
+        vehicle = get('vehicle'); block = get('block'); tripTag = get('tripTag')
+        
+        self.routeTags.append(routeTag)
+        self.routeNames.append(routeName)
+        self.stopTags.append(stopTag)
+        self.stopNames.append(stopName)
+        self.directionTags.append(directionTag)
+        self.directionNames.append(directionName)
+        self.vehicles.append(vehicle if vehicle is None else str(vehicle))
+        self.blocks.append(block if block is None else str(block))
+        self.tripTags.append(tripTag if tripTag is None else str(tripTag))
+        self.minutes.append(int(get('minutes', -1)))
+        self.seconds.append(int(get('seconds', -1)))
+        self.epochTimes.append(float(get('epochTime', -1)))
+        self.isLayovered.append(get('affectedByLayover') == 'true')
+        self.isDeparture.append(get('isDeparture') == 'true')
+        self.isComplete.append(len(PREDICTION_ATTRIBUTES.intersection(attrs)) == len(PREDICTION_ATTRIBUTES))
+        
+    # add an existing Prediction
+    def appendPrediction(self, p):
+        def number(x): return -1 if x == [] else x
+        self.appendFields(p.routeTag, p.routeName, p.stopTag, p.stopName, p.directionTag, p.directionName, 
+                          p.vehicle, p.block, p.tripTag, number(p.minutes), number(p.seconds), number(p.epochTime), 
+                          p.isLayovered, p.isDeparture, p.isComplete)
+                          
+    def appendFields(self, routeTag, routeName, stopTag, stopName, directionTag, directionName, vehicle, block, 
+                     tripTag, minutes, seconds, epochTime, isLayovered, isDeparture, isComplete):
+        self.routeTags.append(routeTag)
+        self.routeNames.append(routeName)
+        self.stopTags.append(stopTag)
+        self.stopNames.append(stopName)
+        self.directionTags.append(directionTag)
+        self.directionNames.append(directionName)
+        self.vehicles.append(vehicle)
+        self.blocks.append(block)
+        self.tripTags.append(tripTag)
+        self.minutes.append(minutes)
+        self.seconds.append(seconds)
+        self.epochTimes.append(epochTime)
+        self.isLayovered.append(bool(isLayovered))
+        self.isDeparture.append(bool(isDeparture))
+        self.isComplete.append(bool(isComplete))
+        
+    # add the predictions of another batch
+    def extend(self, other):
+        for name in ['routeTags', 'routeNames', 'stopTags', 'stopNames', 'directionTags', 'directionNames', 
+                     'vehicles', 'blocks', 'tripTags', 'minutes', 'seconds', 'epochTimes', 'isLayovered', 'isDeparture', 'isComplete']:
+            getattr(self, name).extend(getattr(other, name))
+            
+    # the i-th prediction, as a Prediction
+    def prediction(self, i):
+        p = Prediction()
+        p.timeStamp = self.currentTime
+        p.currentTime = self.currentTime
+        p.routeTag = self.routeTags[i]; p.routeName = self.routeNames[i]
+        p.stopTag = self.stopTags[i]; p.stopName = self.stopNames[i]
+        p.directionTag = self.directionTags[i]; p.directionName = self.directionNames[i]
+        p.vehicle = self.vehicles[i]; p.block = self.blocks[i]; p.tripTag = self.tripTags[i]
+        p.minutes = self.minutes[i]; p.seconds = self.seconds[i]; p.epochTime = int(self.epochTimes[i])
+        p.isLayovered = bool(self.isLayovered[i]); p.isDeparture = bool(self.isDeparture[i])
+        p.isComplete = bool(self.isComplete[i])
+        return p
+        
+    # all of the predictions, as a list of Predictions
+    def predictions(self):
+        return [self.prediction(i) for i in range(len(self))]
+        
+    # the predicted minutes (or seconds) as a numpy array
+    def getMinutes(self):
+        return numpy.array(self.minutes, dtype=int)
+    def getSeconds(self):
+        return numpy.array(self.seconds, dtype=int)
+        
+    # the vehicle tags in the batch (each once)
+    def getVehicles(self):
+        return list(set(self.vehicles))
+        
+    # the indices of the predictions for a stop
+    def indicesForStop(self, stopTag):
+        return [i for (i, s) in enumerate(self.stopTags) if s == stopTag]
+        
+        
+#
+# PredictionBlockCache
+#
+class PredictionBlockCache:
+    '''
+    Remembers a digest of each stop's <predictions> block in the latest predictionsForMultiStops responses.
+    Each response is passed through filterResponse before it is parsed, which drops the blocks that are
+    byte-for-byte the same as in the previous response (their (routeTag, stopTag) pairs are listed in
+    unchangedStops), so that their Predictions are not built again.  Counts the work saved per poll and
+    in total.
+    '''
+    def __init__(self):
+        self.digests = {}			# dictionary (key=(routeTag, stopTag)) of md5 digests of blocks
+        self.lock = threading.Lock()	# (the chunks of a split request are filtered concurrently)
+        self.unchangedStops = set()		# the (routeTag, stopTag) pairs that did not change in the current poll
+        self.pollCount = 0
+        self.blockCount = 0; self.skippedCount = 0; self.skippedBytes = 0
+        self.pollBlockCount = 0; self.pollSkippedCount = 0; self.pollSkippedBytes = 0
+        
+    # start counting a new poll (called by getMultiStopPrediction)
+    def beginPoll(self):
+        self.lock.acquire()
+        try:
+            self.unchangedStops = set()
+            self.pollCount += 1
+            self.pollBlockCount = 0; self.pollSkippedCount = 0; self.pollSkippedBytes = 0
+        finally:
+            self.lock.release()
+            
+    # the (routeTag, stopTag) of a <predictions> block (None if either is missing)
+    def blockKey(self, block):
+        attrs = dict(BLOCK_TAG_PATTERN.findall(block[:block.find('>') + 1]))
+        if 'routeTag' in attrs and 'stopTag' in attrs: return (attrs['routeTag'], attrs['stopTag'])
+        return None
+        
+    # the response data without the blocks that have not changed since the last response, and the digests
+    #    of the changed blocks (to be remembered by update once they have been parsed)
+    def filterResponse(self, data):
+        blocks = PREDICTIONS_BLOCK_PATTERN.findall(data)
+        if not blocks: return (data, {})		# (e.g. an error, which the parser reports)
+        
+        changed = []
+        digests = {}
+        self.lock.acquire()
+        try:
+            for block in blocks:
+                key = self.blockKey(block)
+                digest = hashlib.md5(block).digest()
+                self.blockCount += 1; self.pollBlockCount += 1
+                if key and self.digests.get(key) == digest:
+                    self.unchangedStops.add(key)
+                    self.skippedCount += 1; self.pollSkippedCount += 1
+                    self.skippedBytes += len(block); self.pollSkippedBytes += len(block)
+                else:
+                    if key: digests[key] = digest
+                    changed.append(block)
+        finally:
+            self.lock.release()
+            
+        return (data[:data.find('<predictions')] + ''.join(changed) + '</body>', digests)
+        
+    # remember the digests of parsed blocks
+    def update(self, digests):
+        self.lock.acquire()
+        try:
+            self.digests.update(digests)
+        finally:
+            self.lock.release()
+        
+    # True if the predictions for a (route, stop) did not change in the current poll
+    def isUnchanged(self, routeTag, stopTag):
+        return (routeFromString(routeTag), stopTag) in self.unchangedStops
+        
+    # forget the digests (so that every stop is parsed on the next poll)
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.digests = {}
+        finally:
+            self.lock.release()
+            
+    def show(self):
+        print "Poll %i: %i of %i stops unchanged (%i bytes not parsed)" % (self.pollCount, self.pollSkippedCount, 
+                                                                          self.pollBlockCount, self.pollSkippedBytes)
+        print "  Total: %i of %i stops unchanged (%i bytes not parsed)" % (self.skippedCount, self.blockCount, self.skippedBytes)
+        
+        
+#
+# VehicleLocation
+#
+class VehicleLocation(object):
+    '''
+    The reported position of a vehicle (a <vehicle> element of a vehicleLocations response).
+    '''
+    __slots__ = ['vehicle', 'routeTag', 'directionTag', 'latitude', 'longitude', 'heading', 'speed', 
+                 'isPredictable', 'reportTime']
+                 
+    # attrs is the dictionary of the element's attributes; currentTime is the time of download 
+    #    (the report time is secsSinceReport before it)
+    def __init__(self, attrs=None, currentTime=None):
+        if attrs is None: attrs = {}
+        if currentTime is None: currentTime = now()
+        
+        self.vehicle = str(attrs.get('id', ''))
+        self.routeTag = str(attrs.get('routeTag', ''))
+        self.directionTag = attrs.get('dirTag')
+        if self.directionTag is not None: self.directionTag = str(self.directionTag)
+        self.latitude = float(attrs.get('lat', 'nan'))
+        self.longitude = float(attrs.get('lon', 'nan'))
+        self.heading = int(attrs.get('heading', -1))
+        self.speed = float(attrs.get('speedKmHr', 'nan'))
+        self.isPredictable = attrs.get('predictable') == 'true'
+        self.reportTime = currentTime - timedelta(seconds=int(attrs.get('secsSinceReport', 0)))
+        
+    def getPosition(self):
+        return (self.latitude, self.longitude)
+        
+    def show(self):
+        print "Vehicle %s (%s): (%f, %f) at %s" % (self.vehicle, self.directionTag, self.latitude, self.longitude, 
+                                                    str(self.reportTime).split('.')[0])
+        
+        
 #
 # BusRoute
 #
@@ -514,6 +1558,8 @@ class BusRoute:
         self.directionList = {}
         self.directionTags = {}
         self.stopOrder = {}
+        self.stopsByTag = {}		# dictionary (key=stop tag) of BusStop objects
+        self.stopPositions = {}		# dictionary (key=stop tag) of lists of (direction key, position in stopOrder)
         
     # initializer with a tag (string or xml data)
     def __init__(self, tag=None):
@@ -559,9 +1605,14 @@ class BusRoute:
 
     # initializer for an input that is explicitly a string   
     def initByRouteTag(self, tag):
-        success = self.loadFromFile(tag)
+        success = USE_ROUTE_CACHE and self.loadFromFile(tag)
         if not success:
             success = self.downloadRouteInfo(tag)
+            if success and USE_ROUTE_CACHE:
+                try:
+                    self.saveToFile()
+                except (IOError, OSError), e:
+                    warnings.warn('Could not save route "%s" to the route cache: %s' % (tag, e))
         if not success:
             raise Exception('Could not load Route info for route "%s" from file or download from NextBus.com' % tag)
             
@@ -605,14 +1656,16 @@ class BusRoute:
                 slist.append(str(s.getAttribute('tag')))
             self.stopOrder[dirName] = slist
             
+        self.indexStopOrder()
 
         # get all stop info    
         stps = rte.getElementsByTagName("stop")
         if len(stps) == 0:
             raise Exception('Cannot find stop info')
            
-        # instantiate stop objects
+        # instantiate stop objects (skipping exact duplicates, found by their identity tuples)
         self.stops = []
+        identities = set()
         count = 0
         for s in stps:
 #             print s.toxml()
@@ -620,6 +1673,10 @@ class BusRoute:
             if s.hasAttribute('title'):
                 
                 newStop = BusStop(s)
+                identity = newStop.identity()
+                if identity in identities: continue
+                identities.add(identity)
+                
                 newStop.routes.append(self.routeTag)
                 direction = self.directionOfStop(newStop.tag)
                 if isinstance(direction, list):
@@ -629,14 +1686,10 @@ class BusRoute:
                     newStop.routeDirs.append(self.directionTags[direction])
                 #newStop.show()
                 
-                if len(self.stops) > 0:
-                    (flags,i) = newStop.compareStops(self.stops)
-                    if not any(flags):
-                        self.stops.append(newStop)
-                else: 
-                    self.stops.append(newStop)
+                self.stops.append(newStop)
                 count += 1
         
+        self.indexStops()
         obstops = self.outboundStops()
 
         # make sure stops are in correct order
@@ -645,17 +1698,149 @@ class BusRoute:
         
         for s in obstops:
             self.stops.append(s)
+        self.buildStopIndex()		# (the index above was of the unordered stops, some of which were dropped)
             
         self.xml = xmlData
         
         return True
         
     
-    # load cached route info        
-    def loadFromFile(self, tag):
-        return False
+    # the name of the route cache file for a route tag
+    def cacheFilename(self, tag=None):
+        if tag is None: tag = self.routeTag
+        return os.path.join(ROUTE_CACHE_DIRECTORY, 'RouteConfig_%s.dat' % tag)
         
+    # load cached route info (written by saveToFile); returns False if there is no cache file for
+    #    the route, or if it is older than maxAge seconds
+    def loadFromFile(self, tag, maxAge=None):
+        
+        if maxAge is None: maxAge = ROUTE_CACHE_TTL
+        
+        dbp = DatabaseParser()
+        sep = dbp.separator
+        filename = self.cacheFilename(tag)
+        if not os.path.exists(filename): return False
+        
+        fid = open(filename, 'r')
+        try:
+            lines = fid.readlines()
+        finally:
+            fid.close()
+            
+        route = {}
+        directions = []
+        stops = []
+        try:
+            for line in lines:
+                line = line.rstrip('\n')
+                if not line or line[0] == dbp.commentTag: continue
+                
+                data = line.split(sep)
+                if data[0] == dbp.cacheRouteTag:
+                    route = dict([pair.split(dbp.assigner, 1) for pair in data[1:]])
+                elif data[0] == dbp.cacheDirectionTag:
+                    directions.append(dict([pair.split(dbp.assigner, 1) for pair in data[1:]]))
+                else:
+                    newStop = BusStop()
+                    newStop.setFromDatabaseLine(line)
+                    newStop.identity()		# (raises AttributeError if a field is missing)
+                    stops.append(newStop)
+                    
+            if int(route[dbp.versionTag]) != ROUTE_CACHE_VERSION: return False
+            if time.time() - float(route[dbp.savedTag]) > maxAge: return False
+            
+            self.routeTag = dbp.unescape(route[dbp.tagTag])
+            self.routeName = dbp.unescape(route[dbp.nameTag])
+            self.directionList = {}
+            self.directionTags = {}
+            self.stopOrder = {}
+            for d in directions:
+                dirName = dbp.unescape(d[dbp.nameTag])
+                self.directionList[dirName] = dbp.unescape(d[dbp.titleTag])
+                self.directionTags[dirName] = dbp.unescape(d[dbp.tagTag])
+                if d[dbp.stopsTag]: self.stopOrder[dirName] = map(dbp.unescape, d[dbp.stopsTag].split(dbp.separator_2))
+                else: self.stopOrder[dirName] = []
+        except (KeyError, ValueError, IndexError, AttributeError), e:
+            warnings.warn('Could not read route cache file %s (%s); it will be replaced.' % (filename, e))
+            return False
+            
+        self.stops = stops
+        self.xml = None
+        self.buildStopIndex()
+        return True
+        
+    # save the route info to the route cache, so that later instances can skip the download; the
+    #    file is written under a temporary name and then renamed, so readers never see a partial file
+    def saveToFile(self):
+        
+        dbp = DatabaseParser()
+        sep = dbp.separator
+        a = dbp.assigner
+        
+        lines = ['# Route configuration cache for route %s\n' % self.routeTag]
+        e = dbp.escape
+        lines.append(sep.join([dbp.cacheRouteTag, dbp.tagTag + a + e(self.routeTag), dbp.nameTag + a + e(self.routeName),
+                               dbp.savedTag + a + repr(time.time()), dbp.versionTag + a + str(ROUTE_CACHE_VERSION)]) + '\n')
+        for dirName in self.directionTags.keys():
+            lines.append(sep.join([dbp.cacheDirectionTag, dbp.nameTag + a + e(dirName), dbp.tagTag + a + e(self.directionTags[dirName]),
+                                   dbp.titleTag + a + e(self.directionList[dirName]),
+                                   dbp.stopsTag + a + dbp.separator_2.join(map(e, self.stopOrder[dirName]))]) + '\n')
+        for st in self.stops:
+            lines.append(st.databaseLine())
+            
+        filename = self.cacheFilename()
+        folder = os.path.dirname(filename)
+        if not os.path.isdir(folder): os.makedirs(folder)
+        
+        (fd, tempFilename) = tempfile.mkstemp(dir=folder, prefix='.RouteConfig_', suffix='.tmp')
+        try:
+            fid = os.fdopen(fd, 'w')
+            fid.writelines(lines)
+            fid.flush()
+            os.fsync(fid.fileno())
+            fid.close()
+            try:
+                os.rename(tempFilename, filename)
+            except OSError:		# (on Windows, rename does not replace an existing file)
+                os.remove(filename)
+                os.rename(tempFilename, filename)
+        except:
+            if os.path.exists(tempFilename): os.remove(tempFilename)
+            raise
+        return filename
+        
+        
+    #
+    #
+    # STOP INDEXES
     
+    # build the dictionaries used to look up stops by tag (call again if stops or stopOrder change)
+    def buildStopIndex(self):
+        self.indexStopOrder()
+        self.indexStops()
+        
+    # stop tag --> [(direction key, position)], from stopOrder
+    def indexStopOrder(self):
+        self.stopPositions = {}
+        for dirName in self.stopOrder.keys():
+            for (position, tag) in enumerate(self.stopOrder[dirName]):
+                if tag in self.stopPositions: self.stopPositions[tag].append((dirName, position))
+                else: self.stopPositions[tag] = [(dirName, position)]
+                
+    # stop tag --> BusStop, from stops (the first stop with a tag wins)
+    def indexStops(self):
+        self.stopsByTag = {}
+        for s in self.stops:
+            if s.tag not in self.stopsByTag: self.stopsByTag[s.tag] = s
+            
+    # the (first) position of a stop tag in the stopOrder list for a direction key (None if it is not there)
+    def stopPosition(self, tag, directionKey):
+        if tag in self.stopPositions:
+            for (d, position) in self.stopPositions[tag]:
+                if d == directionKey: return position
+        return None
+        
+        
     #
     #
     # DIRECTIONS
@@ -682,6 +1867,12 @@ class BusRoute:
     def outboundRouteTag(self):
         return self.directionTags[self.outboundKey()]
         
+    # the direction key (e.g., 'Inbound') with the direction tag (e.g., '12_IB1'), or None
+    def directionKeyOfTag(self, dirTag):
+        for (key, tag) in self.directionTags.items():
+            if tag == dirTag: return key
+        return None
+        
     # the normalized 'Inbound'/'Outbound' string, which is a key for the directionList & directionTags dictionaries
     def directionKeyLike(self,str):
         isIn = False
@@ -738,14 +1929,14 @@ class BusRoute:
     def stopIsInbound(self, tag):
         k = self.inboundKey()
         flag = False
-        if k: flag = (tag in self.stopOrder[k])
+        if k: flag = (self.stopPosition(tag, k) is not None)
         return flag
     
     # if the input stop tag lies on the outbound route, return True
     def stopIsOutbound(self, tag):  
         k = self.outboundKey()
         flag = False
-        if k: flag = (tag in self.stopOrder[k])
+        if k: flag = (self.stopPosition(tag, k) is not None)
         return flag   
     
     # positions (lat/lon) of inbound stops
@@ -782,10 +1973,7 @@ class BusRoute:
         
     # return the stop with a tag that matches the input tag (if one exists)
     def stopWithTag(self, tag):
-        for s in self.stops:
-            if s.tag == tag:
-                return s
-        return None
+        return self.stopsByTag.get(tag)
             
     # get a stop by specifying "Folsom" and "16th"
     def stopsFromStreets(self, st1, st2, direction='None'):
@@ -833,30 +2021,27 @@ class BusRoute:
         if len(stopTags) != len(args):
             raise Exception('stop tag list must have same # of elements as the list to sort (2nd argument)')
 
-        # get the inbound/outbound stop tags IN ORDER (guaranteed by xxxstopTags(), which pulls from stopOrder)
-        inStops = self.inboundStopTags()
-        outStops = self.outboundStopTags()
+        # the inbound/outbound direction keys, whose stop positions (in stopOrder) are in stopPositions
+        inKey = self.inboundKey()
+        outKey = self.outboundKey()
         
         stopsAndArgs = zip(stopTags, args)
         
-        # find the index where each tag occurs in in/outStops:
+        # find the index where each tag occurs in the inbound/outbound stop order:
         inIndex = []; outIndex = []
         inArgs = []; outArgs = []
         for line in stopsAndArgs:
             t = line[0]				# the stop tag
             a = line[1]				# the argument
-            try:
-                inIndex.append(inStops.index(t))
+            i = self.stopPosition(t, inKey)
+            if i is not None:
+                inIndex.append(i)
                 inArgs.append(a)
-                
-            except ValueError:		# this means that the tag t was not found in the list; no need to do anything except try the outbound list
-                try:
-                    outIndex.append(outStops.index(t))
+            else:					# the tag t was not found on the inbound route; try the outbound route
+                i = self.stopPosition(t, outKey)
+                if i is not None:
+                    outIndex.append(i)
                     outArgs.append(a)
-                except ValueError:  # no need to do anything
-                    None		
-                except:             # a different kind of error
-                    raise Exception('Error in finding tag "%s" in stop order list' % t)
         
         # order arg according to the indices found above
         if inIndex:
@@ -946,6 +2131,70 @@ class BusRoute:
               
         
               
+#
+# StopDatabase
+#
+class StopDatabase:
+    '''
+    Returns an object holding the stop database file as a dictionary (key = stop tag) of database lines,
+    so that stops can be looked up by tag without scanning the file.  The object is shared by all BusStops
+    (see getStopDatabase), which reads the file again when its modification time changes.
+    '''
+    def __init__(self, filename=None):
+        if filename is None: filename = STOP_DATABASE_FILENAME
+        self.filename = filename
+        self.lines = {}
+        self.mtime = None		# the modification time of the file when it was read
+        self.load()
+        
+    # (re)read the database file
+    def load(self):
+        dbp = DatabaseParser()
+        lines = {}
+        mtime = os.path.getmtime(self.filename)
+        fid = open(self.filename, 'r')
+        try:
+            for txt in fid:
+                if not txt or txt[0] == dbp.commentTag: continue
+                tag = dbp.unescape(txt.split(dbp.separator, 1)[0])
+                if tag not in lines: lines[tag] = txt		# the first line for a tag wins
+        finally:
+            fid.close()
+        self.lines = lines
+        self.mtime = mtime
+        
+    # True if the file was modified since it was read
+    def isOutOfDate(self):
+        try:
+            return os.path.getmtime(self.filename) != self.mtime
+        except OSError:
+            return False		# (keep the lines read before the file was removed)
+        
+    def __len__(self):
+        return len(self.lines)
+        
+    def __contains__(self, tag):
+        return tag in self.lines
+        
+    # the database line for a stop tag (or None, if the tag is not in the database)
+    def lineWithTag(self, tag):
+        return self.lines.get(tag)
+        
+        
+# the stop database shared by all BusStops
+sharedStopDatabase = None
+
+def getStopDatabase(filename=None):
+    global sharedStopDatabase
+    if filename is None: filename = STOP_DATABASE_FILENAME
+    if sharedStopDatabase is None or sharedStopDatabase.filename != filename:
+        sharedStopDatabase = StopDatabase(filename)
+    elif sharedStopDatabase.isOutOfDate():
+        sharedStopDatabase.load()
+    return sharedStopDatabase
+    
+    
+              
 #
 # BusStop
 #    
@@ -1013,22 +2262,24 @@ class BusStop:
                 kv = pair.split(assigner)
 
                 if len(kv) != 2:
-                    raise Exception('Stop Database tag-value syntax is not preserved in line:\n%s' % txt)
+                    raise ValueError('Stop Database tag-value syntax is not preserved in line:\n%s' % txt)
                 key = kv[0]
-                val = kv[1]
+                val = dbp.unescape(kv[1].rstrip('\n'))
                 if key == dbp.stopTag: self.tag = val
                 elif key == dbp.nameTag: self.name = val
                 elif key == dbp.latTag: self.latitude = float(val)
                 elif key == dbp.lonTag: self.longitude = float(val)
-                elif key == dbp.idTag: self.stopID = int(val)
+                elif key == dbp.idTag:
+                    try: self.stopID = int(val)
+                    except ValueError: self.stopID = val
                 elif key == dbp.routesTag:
-                    routes = val.split(dbp.separator_2)
+                    routes = kv[1].rstrip('\n').split(dbp.separator_2)
                     for r in routes:
-                        self.routes.append(r.strip('\n'))
+                        self.routes.append(dbp.unescape(r))
                 elif key == dbp.routeDirTag:
-                    directions = val.split(dbp.separator_2)
+                    directions = kv[1].rstrip('\n').split(dbp.separator_2)
                     for d in directions:
-                        self.routeDirs.append(d.strip('\n'))
+                        self.routeDirs.append(dbp.unescape(d))
                 else:
                     warnings.warn('Unrecognized tag in Stop Database tag/value pair:\n  %s' % pair)
                     
@@ -1040,22 +2291,10 @@ class BusStop:
     
         # get database parser object (more of a struct, really)
         dbp = DatabaseParser()
-        separator = dbp.separator
-        assigner = dbp.assigner
         
-        fid = open(dbp.stopDatabaseFilename, 'r')
-        
-        txt = fid.readline()
-        data = txt.split(dbp.separator)
-        
-        while txt and data[0] != tag:
-            txt = fid.readline()
-            data = txt.split(separator)
-            
-        if fid and txt:
+        txt = getStopDatabase(dbp.stopDatabaseFilename).lineWithTag(tag)
+        if txt:
             self.setFromDatabaseLine(txt)
-
-        fid.close()
              
         
     # this should be the designated initializer
@@ -1077,6 +2316,20 @@ class BusStop:
         self.xml = xmlData    
     
     
+    # format the stop as a line of the stop database (the inverse of setFromDatabaseLine); separator
+    #    characters in the values are escaped (see DatabaseParser.escape)
+    def databaseLine(self):
+        dbp = self.dbp
+        a = dbp.assigner
+        e = dbp.escape
+        fields = [e(self.tag), dbp.stopTag + a + e(self.tag), dbp.nameTag + a + e(self.name),
+                  dbp.latTag + a + repr(self.latitude), dbp.lonTag + a + repr(self.longitude),
+                  dbp.idTag + a + e(str(self.stopID))]
+        if self.routes: fields.append(dbp.routesTag + a + dbp.separator_2.join(map(e, self.routes)))
+        if self.routeDirs: fields.append(dbp.routeDirTag + a + dbp.separator_2.join(map(e, self.routeDirs)))
+        return dbp.separator.join(fields) + '\n'
+    
+    
     # display to command line    
     def show(self):
         print 'STOP ' + self.tag
@@ -1098,9 +2351,13 @@ class BusStop:
     #
     # OTHER METHODS
     
+    # the fields that make two stops identical, as a hashable tuple
+    def identity(self):
+        return (self.tag, self.name, self.latitude, self.longitude, self.stopID)
+        
     # compare this stop to a list of other stops, returning an array with True where they are identical (deep copies)
     def compareStops(self, someStops):
-        i = v = []
+        i = []; v = []
         index = 0
         for aStop in someStops:
             flag = True
@@ -1161,7 +2418,7 @@ class BusStop:
         
         sec = []
         min = []
-        currentTime = datetime.now()
+        currentTime = now()
         for p in pred:
             s = p.getAttribute("seconds")
             m = p.getAttribute("minutes")
@@ -0,0 +1,443 @@
+# NMARCHIVE
+#  Writes the prediction databases of nmtracker.TrackerController: the '; '-separated text files, and
+#  a compact binary format (which this module also reads).  Writers keep their file open, and buffer
+#  records in memory until ARCHIVE_FLUSH_COUNT records are waiting or ARCHIVE_FLUSH_INTERVAL has passed.
+#
+#  A binary archive is a pair of files:
+#    PredictionDatabaseRte12_20120515_143341.nma  ---  a short header, followed by fixed-width records (ARCHIVE_DTYPE)
+#    PredictionDatabaseRte12_20120515_143341.ids  ---  the route/stop/direction tags, one per line; records
+#                                                       refer to a tag by its line number (its id)
+#  Times are stored as seconds since 1970-01-01 00:00:00 of the (local) time that the text files record.
+#
+#  Vehicle positions (see nmtracker.VehicleTracker) are archived the same way, with POSITION_DTYPE records
+#  in a .nmp file.
+
+import os
+import time
+import threading, Queue
+import warnings
+import numpy
+import nextmunipy as nm
+
+ARCHIVE_FILE_EXT = '.nma'
+ID_FILE_EXT = '.ids'
+ARCHIVE_MAGIC = 'NMARCHV1'		# first bytes of every archive file
+POSITION_FILE_EXT = '.nmp'
+POSITION_MAGIC = 'NMPOSIT1'		# first bytes of every position archive file
+ARCHIVE_HEADER_SIZE = 16		# bytes before the first record
+MISSING_TIME = 0				# stored in place of a missing time (e.g. a prediction that was never closed)
+MISSING_VEHICLE = -1			# stored in place of a vehicle tag that is not a number
+ARCHIVE_FLUSH_COUNT = 100		# records buffered by a writer before they are written to disk
+ARCHIVE_FLUSH_INTERVAL = 60.0	# seconds; longest time a record stays buffered (see ArchiveWriter.flushIfDue)
+ARCHIVE_QUEUE_SIZE = 1000		# batches of rows waiting for a BackgroundArchiveWriter before write() blocks
+ARCHIVE_QUEUE_TICK = 1.0		# seconds; how often an idle BackgroundArchiveWriter checks its writers' flush interval
+
+# one line of a text database file (fields in nextmunipy.DatabaseParser.order)
+TEXT_RECORD_FORMAT = '%s; %s; %s; %s; %s; %s; %s; %i; %f; %i; %f; %f; \n'
+
+# one record per prediction; field names (and order) follow nextmunipy.DatabaseParser.order
+ARCHIVE_DTYPE = numpy.dtype([('routeTag', '<u4'), ('stopTag', '<u4'), ('vehicle', '<i4'), ('directionTag', '<u4'),
+                             ('startTime', '<u4'), ('endTime', '<u4'), ('currentTime', '<u4'),
+                             ('predictedWait', '<f4'), ('actualWait', '<f4'), ('uncertainty', '<i2'),
+                             ('latitude', '<f4'), ('longitude', '<f4')])
+TAG_FIELDS = ['routeTag', 'stopTag', 'directionTag']
+TIME_FIELDS = ['startTime', 'endTime', 'currentTime']
+
+# one record per reported vehicle position; rows are (routeTag, vehicle, directionTag, reportTime,
+#    latitude, longitude, heading, speed)
+POSITION_DTYPE = numpy.dtype([('routeTag', '<u4'), ('vehicle', '<i4'), ('directionTag', '<u4'), ('reportTime', '<u4'),
+                              ('latitude', '<f4'), ('longitude', '<f4'), ('heading', '<i2'), ('speed', '<f4')])
+POSITION_TAG_FIELDS = ['routeTag', 'directionTag']
+POSITION_TIME_FIELDS = ['reportTime']
+
+
+# the (archive, id) filenames that go with a database filename (of either format)
+def archiveFilenames(filename, ext=ARCHIVE_FILE_EXT):
+    base = os.path.splitext(filename)[0]
+    return (base + ext, base + ID_FILE_EXT)
+
+
+# convert a list/array of times (datetimes, datetime64s, or strings; None for missing) to epoch seconds
+def epochSeconds(times):
+    times = numpy.asarray(times)
+    if times.dtype.kind in ['S', 'U']:
+        times = numpy.char.strip(times)
+        times[times == 'None'] = 'NaT'
+    times = times.astype('datetime64[s]')
+    seconds = times.astype(numpy.int64)
+    seconds[numpy.isnat(times)] = MISSING_TIME
+    return seconds
+
+
+# convert an array of epoch seconds (as stored in an archive) to datetime64 values
+def timesFromSeconds(seconds):
+    times = numpy.asarray(seconds).astype(numpy.int64).astype('datetime64[s]')
+    times[numpy.asarray(seconds) == MISSING_TIME] = numpy.datetime64('NaT')
+    return times
+
+
+# convert a list/array of vehicle tags to integers (MISSING_VEHICLE for tags that are not numbers)
+def vehicleNumbers(vehicles):
+    vehicles = numpy.asarray(vehicles)
+    try:
+        return vehicles.astype(numpy.int64)
+    except ValueError:
+        numbers = []
+        for v in vehicles:
+            try: numbers.append(int(v))
+            except ValueError: numbers.append(MISSING_VEHICLE)
+        return numpy.array(numbers, dtype=numpy.int64)
+
+
+#
+# StringTable
+#
+class StringTable:
+    '''
+    The tags (of routes, stops, and directions) that the records of an archive refer to by id.  Tags
+    are given ids in the order they are first seen, and appended to the table's file by save().
+    '''
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.strings = []
+        self.ids = {}
+        self.savedCount = 0
+        if filename and os.path.exists(filename):
+            self.load()
+
+    def __len__(self):
+        return len(self.strings)
+
+    # read the tags in the table's file (a partially written last line is ignored)
+    def load(self):
+        fid = open(self.filename, 'r')
+        try:
+            for line in fid:
+                if not line.endswith('\n'): break
+                self.add(line[:-1])
+        finally:
+            fid.close()
+        self.savedCount = len(self.strings)
+
+    def add(self, s):
+        self.ids[s] = len(self.strings)
+        self.strings.append(s)
+
+    # the id of a tag (assigning a new id to a tag not already in the table)
+    def intern(self, s):
+        s = str(s).strip()
+        i = self.ids.get(s)
+        if i is None:
+            i = len(self.strings)
+            self.add(s)
+        return i
+
+    # the ids of a list/array of tags
+    def internAll(self, values):
+        values = numpy.asarray(values)
+        if len(values) == 0: return numpy.zeros(0, dtype=numpy.uint32)
+        (tags, inverse) = numpy.unique(values, return_inverse=True)
+        ids = numpy.array([self.intern(t) for t in tags], dtype=numpy.uint32)
+        return ids[inverse]
+
+    # the tags with the given ids
+    def tagsWithIds(self, ids):
+        return numpy.array(self.strings)[ids] if len(self.strings) else numpy.array([''] * len(ids))
+
+    # append the tags that have not been saved yet to the table's file
+    def save(self):
+        if self.savedCount == len(self.strings) or not self.filename:
+            return
+        fid = open(self.filename, 'a')
+        try:
+            fid.write(''.join([s + '\n' for s in self.strings[self.savedCount:]]))
+            fid.flush()
+            os.fsync(fid.fileno())
+        finally:
+            fid.close()
+        self.savedCount = len(self.strings)
+
+
+# a time as written to a text database file (YYYY-MM-DD HH:MM:SS)
+def timeString(t):
+    return str(t).split('.')[0]
+
+
+# the text database lines (TEXT_RECORD_FORMAT) of a list of rows
+def textFromRows(rows):
+    return ''.join([TEXT_RECORD_FORMAT % (r[0], r[1], r[2], r[3], timeString(r[4]), timeString(r[5]),
+                                          timeString(r[6]), r[7], r[8], r[9], r[10], r[11]) for r in rows])
+
+
+#
+# ArchiveWriter
+#
+class ArchiveWriter:
+    '''
+    Appends records (rows in nextmunipy.DatabaseParser.order) to a database file through a single open
+    handle.  Rows are buffered, and written (and synced to disk) together by flush, as the data that
+    encoder (a function of a list of rows) returns for them.  Subclasses open the file.
+    '''
+    def __init__(self, filename, encoder, flushCount=None, flushInterval=None):
+        if flushCount is None: flushCount = ARCHIVE_FLUSH_COUNT
+        if flushInterval is None: flushInterval = ARCHIVE_FLUSH_INTERVAL
+        self.filename = filename
+        self.encoder = encoder
+        self.flushCount = flushCount
+        self.flushInterval = flushInterval
+        self.fid = None
+        self.rows = []
+        self.recordCount = 0		# records written to disk
+        self.lastFlushTime = time.time()
+
+    # add rows to the buffer (writing the buffer if it is full, or has waited long enough)
+    def write(self, rows):
+        self.rows.extend(rows)
+        self.flushIfDue()
+
+    # write the buffer if it is full, or flushInterval seconds have passed since the last flush
+    def flushIfDue(self):
+        if len(self.rows) >= self.flushCount or time.time() - self.lastFlushTime >= self.flushInterval:
+            self.flush()
+
+    # write the buffered rows, and sync the file to disk
+    def flush(self):
+        if self.rows:
+            self.writeData(self.encoder(self.rows))
+            self.recordCount += len(self.rows)
+            self.rows = []
+        self.lastFlushTime = time.time()
+
+    def writeData(self, data):
+        self.fid.write(data)
+        self.fid.flush()
+        os.fsync(self.fid.fileno())
+
+    # write any buffered rows, and close the file
+    def close(self):
+        if self.fid is None: return
+        try:
+            self.flush()
+        finally:
+            self.fid.close()
+            self.fid = None
+
+
+#
+# TextArchiveWriter
+#
+class TextArchiveWriter(ArchiveWriter):
+    '''
+    Writes a text database file (one TEXT_RECORD_FORMAT line per record).  A new file is started with
+    header (a string of '#' comment lines), or an existing file is appended to if header is None.
+    '''
+    def __init__(self, filename, header=None, flushCount=None, flushInterval=None):
+        ArchiveWriter.__init__(self, filename, textFromRows, flushCount, flushInterval)
+        if header is None:
+            self.fid = open(self.filename, 'a')
+        else:
+            self.fid = open(self.filename, 'w')
+            self.writeData(header)
+
+
+#
+# BinaryArchiveWriter
+#
+class BinaryArchiveWriter(ArchiveWriter):
+    '''
+    Appends prediction records to an archive (and its tags to the archive's StringTable).  Records can be
+    given as rows (in nextmunipy.DatabaseParser.order, as a TrackerController archives them) or as the
+    tuple of columns returned by nmdata.loadData.
+    '''
+    dtype = ARCHIVE_DTYPE		# (the record format; subclasses archive other records)
+    magic = ARCHIVE_MAGIC
+    fileExt = ARCHIVE_FILE_EXT
+    tagFields = TAG_FIELDS
+    timeFields = TIME_FIELDS
+
+    def __init__(self, filename, overwrite=False, flushCount=None, flushInterval=None):
+        (filename, idFilename) = archiveFilenames(filename, self.fileExt)
+        ArchiveWriter.__init__(self, filename, self.encodeRows, flushCount, flushInterval)
+        if overwrite:
+            for fn in [self.filename, idFilename]:
+                if os.path.exists(fn): os.remove(fn)
+
+        self.table = StringTable(idFilename)
+
+        # a new archive starts with its header
+        if os.path.exists(self.filename) and os.path.getsize(self.filename) > 0:
+            checkHeader(self.filename, self.magic)
+            self.fid = open(self.filename, 'ab')
+        else:
+            self.fid = open(self.filename, 'wb')
+            self.writeData(self.magic.ljust(ARCHIVE_HEADER_SIZE, '\0'))
+
+    # convert a tuple of data columns (in nextmunipy.DatabaseParser.order) to an array of records
+    def recordsFromColumns(self, columns):
+        names = self.dtype.names
+        count = len(columns[0])
+        records = numpy.zeros(count, dtype=self.dtype)
+        for (i, name) in enumerate(names):
+            col = columns[i]
+            if len(col) != count:		# (old database files have no latitude/longitude columns)
+                records[name] = numpy.nan
+            elif name in self.tagFields:
+                records[name] = self.table.internAll(col)
+            elif name in self.timeFields:
+                records[name] = epochSeconds(col)
+            elif name == 'vehicle':
+                records[name] = vehicleNumbers(col)
+            else:
+                records[name] = numpy.asarray(col, dtype=float)
+        return records
+
+    # convert a list of rows (in nextmunipy.DatabaseParser.order) to an array of records
+    def recordsFromRows(self, rows):
+        if not rows: return numpy.zeros(0, dtype=self.dtype)
+        return self.recordsFromColumns(zip(*rows))
+
+    # the data written for a list of rows (the records' tags are saved to the StringTable before the
+    #    records themselves are written)
+    def encodeRows(self, rows):
+        records = self.recordsFromRows(rows)
+        self.table.save()
+        return records.tostring()
+
+    # write an array of records to the archive (after any buffered rows)
+    def writeRecords(self, records):
+        self.flush()
+        if len(records) == 0: return
+        self.table.save()
+        self.writeData(numpy.asarray(records, dtype=self.dtype).tostring())
+        self.recordCount += len(records)
+
+
+#
+# PositionArchiveWriter
+#
+class PositionArchiveWriter(BinaryArchiveWriter):
+    '''
+    Appends vehicle position records (POSITION_DTYPE) to a position archive.  Rows are (routeTag, vehicle,
+    directionTag, reportTime, latitude, longitude, heading, speed).
+    '''
+    dtype = POSITION_DTYPE
+    magic = POSITION_MAGIC
+    fileExt = POSITION_FILE_EXT
+    tagFields = POSITION_TAG_FIELDS
+    timeFields = POSITION_TIME_FIELDS
+
+
+#
+# BackgroundArchiveWriter
+#
+class BackgroundArchiveWriter:
+    '''
+    Hands rows to one or more ArchiveWriters from a background thread, so that a polling loop only
+    has to queue its rows.  write() blocks while ARCHIVE_QUEUE_SIZE batches are waiting (so a slow disk
+    slows the loop down instead of using up memory), and close() writes every queued row before it
+    returns.  onWrite (if given) is called with each batch of rows (and the message queued with it) in
+    the background thread, before the rows are written.  Rows cannot be written after close().
+    '''
+    def __init__(self, writers, onWrite=None, queueSize=None):
+        if queueSize is None: queueSize = ARCHIVE_QUEUE_SIZE
+        self.writers = writers
+        self.onWrite = onWrite
+        self.queue = Queue.Queue(queueSize)
+        self.filename = ', '.join([w.filename for w in writers])
+        self.errorCount = 0
+        self.blockedCount = 0		# calls to write() that had to wait for room in the queue
+        self.isClosed = False
+        
+        self.thread = threading.Thread(target=self.run, name='BackgroundArchiveWriter')
+        self.thread.daemon = True
+        self.thread.start()
+        
+    # queue rows to be written, and a message (any object) to be passed to onWrite with them
+    def write(self, rows, message=None):
+        if self.isClosed:
+            raise ValueError("BackgroundArchiveWriter for %s is closed" % self.filename)
+        if not rows and message is None: return
+        try:
+            self.queue.put((rows, message), False)
+        except Queue.Full:
+            self.blockedCount += 1
+            self.queue.put((rows, message))
+            
+    # (the background thread checks the flush interval itself)
+    def flushIfDue(self):
+        pass
+        
+    # the background thread: write each batch of rows, until close() queues None
+    def run(self):
+        while True:
+            try:
+                rows = self.queue.get(True, ARCHIVE_QUEUE_TICK)
+            except Queue.Empty:
+                self.apply('flushIfDue')
+                continue
+            if rows is None:
+                break
+            (rows, message) = rows
+            if self.onWrite:
+                try:
+                    self.onWrite(rows, message)
+                except Exception as e:
+                    warnings.warn("Error showing archived rows: %s" % e)
+            if rows: self.apply('write', rows)
+        self.apply('close')
+        
+    # call a method of every writer (a writer that fails is reported, and does not stop the others)
+    def apply(self, method, *args):
+        for w in self.writers:
+            try:
+                getattr(w, method)(*args)
+            except Exception as e:
+                self.errorCount += 1
+                warnings.warn("Could not save predictions to %s: %s" % (w.filename, e))
+                
+    # write all queued rows, and close the writers
+    def close(self):
+        if self.isClosed: return
+        self.isClosed = True
+        self.queue.put(None)
+        self.thread.join()
+        
+        
+# raise an IOError if a file is not an archive (of the kind that starts with magic)
+def checkHeader(filename, magic=ARCHIVE_MAGIC):
+    fid = open(filename, 'rb')
+    try:
+        header = fid.read(ARCHIVE_HEADER_SIZE)
+    finally:
+        fid.close()
+    if not header.startswith(magic):
+        raise IOError("%s is not a %s archive" % (filename, 'prediction' if magic == ARCHIVE_MAGIC else 'position'))
+
+
+# write a tuple of data columns (as returned by nmdata.loadData) to a new archive
+def writeArchive(filename, columns):
+    writer = BinaryArchiveWriter(filename, overwrite=True)
+    try:
+        writer.writeRecords(writer.recordsFromColumns(columns))
+    finally:
+        writer.close()
+    return writer.filename
+
+
+# memory-map the records of an archive; returns (records, StringTable).  A partially written last
+#    record (e.g. of an archive that is still being written) is ignored.
+def openArchive(filename, writerClass=BinaryArchiveWriter):
+    (filename, idFilename) = archiveFilenames(filename, writerClass.fileExt)
+    checkHeader(filename, writerClass.magic)
+    dtype = writerClass.dtype
+    count = (os.path.getsize(filename) - ARCHIVE_HEADER_SIZE) // dtype.itemsize
+    if count > 0:
+        records = numpy.memmap(filename, dtype=dtype, mode='r', offset=ARCHIVE_HEADER_SIZE, shape=(count,))
+    else:
+        records = numpy.zeros(0, dtype=dtype)
+    return (records, StringTable(idFilename))
+
+
+# memory-map the records of a position archive; returns (records, StringTable)
+def openPositionArchive(filename):
+    return openArchive(filename, PositionArchiveWriter)
@@ -10,9 +10,13 @@ filenameExt = '.dat'
 sep = ';'
 
 import os
+import warnings
 import nextmunipy as nm
+import nmarchive
 import numpy
 MISSING_VALUE = numpy.nan
+LOAD_CHUNK_SIZE = 1024 * 1024		# bytes of a database file parsed at a time by loadData
+USE_BINARY_ARCHIVE = True		# loadData reads the binary archive (see nmarchive) that goes with a text file, if there is one
 FORCE_POSITION_FROM_DATABASE = True
 
 # ----------------------------------------------------------------------------------------
@@ -21,7 +25,8 @@ FORCE_POSITION_FROM_DATABASE = True
 
 # database files have the format: PredictionDatabaseRte12_20120515_143341.dat
 # this function returns the most recent database file starting with, e.g., PredictionDatabaseRte12
-def findFileStartingWith(fn):
+#   (optionally, only files with the extension ext, e.g. '.dat', or one of a list of extensions)
+def findFileStartingWith(fn, ext=None):
    
     import os
    
@@ -29,8 +34,11 @@ def findFileStartingWith(fn):
     folder = os.path.dirname(fn)
     allFiles = os.listdir(folder)
     matches = []
+    if isinstance(ext, str): ext = [ext]
    
     for f in allFiles:
+        if ext and os.path.splitext(f)[1] not in ext:
+            continue
         if ( (prefix + '_') in f or (prefix + '.') in f ) and 'OLD' not in f:
             matches.append(f)
     if len(matches) < 1:
@@ -68,9 +76,122 @@ def findFileStartingWith(fn):
                 d1 = d2
                 t1 = t2
     
+    if filename is None: return (matches, None)
     mostRecent = os.path.normpath(folder + '/' + filename)
     return (matches, mostRecent)
+    
+# the database files of a route's runs (full paths), and the most recent of them; a run saved in both
+#   formats is represented by its binary archive if USE_BINARY_ARCHIVE is set, and by its text file otherwise
+def findDatabaseFiles(routeTag):
+    
+    folder = os.path.dirname(filenameBase)
+    (matches, mostRecent) = findFileStartingWith(filenameBase + routeTag, [filenameExt, nmarchive.ARCHIVE_FILE_EXT])
+    preferredExt = nmarchive.ARCHIVE_FILE_EXT if USE_BINARY_ARCHIVE else filenameExt
+    
+    runs = {}
+    for m in matches:
+        (base, ext) = os.path.splitext(m)
+        if base not in runs or ext == preferredExt: runs[base] = m
+    filenames = [os.path.normpath(os.path.join(folder, runs[base])) for base in sorted(runs.keys())]
+    
+    if mostRecent:
+        base = os.path.splitext(os.path.basename(mostRecent))[0]
+        mostRecent = os.path.normpath(os.path.join(folder, runs[base]))
+    return (filenames, mostRecent)
+        
+# the columns of a PredData object, in database file order (see nextmunipy.DatabaseParser.order)
+COLUMNS = ['routes', 'stops', 'vehicles', 'directions', 'startTimes', 'endTimes', 'currentTimes', \
+           'predictions', 'waits', 'uncertainty', 'latitudes', 'longitudes']
+CATEGORICAL_COLUMNS = ['routes', 'stops', 'vehicles', 'directions']
+TIME_COLUMNS = ['startTimes', 'endTimes', 'currentTimes']
+DERIVED_COLUMNS = {'delays': 'delays'}		# values computed from the columns, and the PredData methods that compute them
+
+#
+# Categorical
+#
+class Categorical:
+    '''
+    A column of repeated labels (route, stop, direction or vehicle tags), stored as integer codes
+    into a sorted array of the distinct labels.
+    '''
+    def __init__(self, values=None, codes=None, categories=None):
+        if values is not None:
+            (categories, codes) = numpy.unique(numpy.asarray(values), return_inverse=True)
+        if categories is None: categories = numpy.array([])
+        if codes is None: codes = numpy.zeros(0, dtype=numpy.int32)
+        self.categories = numpy.asarray(categories)
+        self.codes = numpy.asarray(codes, dtype=numpy.int32)
+        
+    def __len__(self):
+        return len(self.codes)
+        
+    # the labels themselves (optionally, only those at indices)
+    def values(self, indices=None):
+        if indices is None: return self.categories[self.codes]
+        return self.categories[self.codes[indices]]
+        
+    # a new Categorical containing the entries at indices
+    def take(self, indices):
+        return Categorical(codes=self.codes[indices], categories=self.categories)
+        
+    # a boolean array, True where the label equals value
+    def equalTo(self, value):
+        i = numpy.searchsorted(self.categories, value)
+        if i < len(self.categories) and self.categories[i] == value:
+            return self.codes == i
+        return numpy.zeros(len(self.codes), dtype=bool)
+        
+    # the indices that sort the column by label (categories are sorted, so codes sort the same way)
+    def argsort(self):
+        return numpy.argsort(self.codes, kind='mergesort')
+        
+    # a new Categorical containing this column followed by another
+    def concatenate(self, other):
+        if len(other) == 0: return self
+        if len(self) == 0: return other
+        categories = numpy.union1d(self.categories, other.categories)
+        codes1 = numpy.searchsorted(categories, self.categories)[self.codes]
+        codes2 = numpy.searchsorted(categories, other.categories)[other.codes]
+        return Categorical(codes=numpy.concatenate((codes1, codes2)), categories=categories)
+        
+        
+# convert a list/array of 'YYYY-MM-DD HH:MM:SS' strings (or datetimes) to a datetime64 array
+def toDatetime64(times):
+    times = numpy.asarray(times)
+    if times.dtype.kind in ['S', 'U']:
+        times = numpy.char.strip(times)
+        times[times == 'None'] = 'NaT'
+    return times.astype('datetime64[s]')
+    
+    
+# convert a tuple of data columns (as returned by loadData) into a dictionary of columnar arrays
+def columnsFromData(allData):
+    columns = {}
+    for (i, name) in enumerate(COLUMNS):
+        col = allData[i]
+        if name in CATEGORICAL_COLUMNS:
+            if not isinstance(col, Categorical):
+                col = numpy.asarray(col)
+                if col.dtype.kind in ['S', 'U']: col = numpy.char.strip(col)
+                col = Categorical(col)
+        elif name in TIME_COLUMNS:
+            col = toDatetime64(col)
+        else:
+            col = numpy.asarray(col, dtype=float)
+        columns[name] = col
         
+    # old database files have no latitude/longitude columns
+    count = len(columns['routes'])
+    for name in ['latitudes', 'longitudes']:
+        if len(columns[name]) != count: columns[name] = MISSING_VALUE * numpy.ones(count)
+    return columns
+    
+    
+# a dictionary of empty columns
+def emptyColumns():
+    return columnsFromData([[]] * len(COLUMNS))
+    
+    
 #
 # PredData 
 # 
@@ -78,42 +199,24 @@ def findFileStartingWith(fn):
 class PredData:
     '''
     Returns an object with properties and methods to access a prediction database (currently a text file) generated by a TrackerController object.
+    The data is stored by column: numpy arrays for the numeric columns, datetime64 arrays for times, and
+    Categorical codes for route, stop, vehicle and direction tags.
     '''
     def __init__(self, allData=None, arg='all'):
         
         # initialize and empty instance
-        self.data = []
+        self.parser = nm.DatabaseParser()
+        self.columns = emptyColumns()
         self.count = 0
-        if not allData:
+        if allData is None or len(allData) == 0:
             return
         # initialize with a list of route tags
         elif type(allData) == str:
             self.initWithRoute(allData, arg)
             return
             
-        self.parser = nm.DatabaseParser()
-        route = allData[self.parser.routeIndex()]
-        stop = allData[self.parser.stopIndex()]
-        vehicle = allData[self.parser.vehicleIndex()]
-        direction = allData[self.parser.directionIndex()]
-        startTime = allData[self.parser.startTimeIndex()]
-        endTime = allData[self.parser.endTimeIndex()]
-        currentTime = allData[self.parser.currentTimeIndex()]
-        prediction = allData[self.parser.predictionIndex()]
-        wait = allData[self.parser.waitIndex()]
-        delta = allData[self.parser.uncertaintyIndex()]
-        latitude = allData[self.parser.latIndex()]
-        longitude = allData[self.parser.lonIndex()]
-        delay = numpy.array(wait) - numpy.array(prediction)
-                
-        self.count = len(route)
-        if not latitude: latitude = [None] * self.count
-        if not longitude: longitude = [None] * self.count
-        self.data = []
-        for i in range(len(route)):
-            self.data.append( (route[i],stop[i].strip(),vehicle[i],direction[i].strip(), \
-                    startTime[i].strip(),endTime[i].strip(),currentTime[i].strip(), \
-                    prediction[i],wait[i],delta[i],latitude[i],longitude[i],wait[i]-prediction[i]) )
+        self.columns = columnsFromData(allData)
+        self.count = len(self.columns['routes'])
 
                     
     # initialize the data list by loading data from a list of route tags (which indicate a list of files)
@@ -121,9 +224,9 @@ class PredData:
     
         if type(routeTags) == str: routeTags = [routeTags]
         for rt in routeTags:
-            (filenames, recentFile) = findFileStartingWith(filenameBase + rt)
+            (filenames, recentFile) = findDatabaseFiles(rt)
             if (arg.lower() in ['last','recent']):
-                filenames = [recentFile]
+                filenames = [recentFile] if recentFile else []
             for fn in filenames:
                 newData = loadData(fn)
                 self.appendData(newData)
@@ -131,243 +234,352 @@ class PredData:
                     
     # returns a dictionary that can be used like a struct to get data components
     def getDict(self, theData=None):
-        if not theData:
-            theData = self.data
-        dataDict = {'routes': self.routes(), 'stops': self.stops(), 'vehicles': self.vehicles(), 'directions': self.directions(), \
-                         'startTimes': self.startTimes(), 'endTimes': self.endTimes(), 'currentTimes': self.currentTimes(), \
-                         'predictions': self.predictions(), 'waits':self.waits(), 'uncertainty': self.uncertainties(), \
-                         'latitudes': self.latitudes(), 'longitudes': self.longitudes(), 'delays': self.delays()}
+        dataDict = {}
+        for name in COLUMNS + DERIVED_COLUMNS.keys():
+            dataDict[name] = self.variable(name)
         return dataDict
         
     
-    def copyContainingData(self, data):
-        self.data = data
+    def copyContainingData(self, columns):
+        self.columns = columns
+        self.count = len(columns['routes'])
         return self
         
-    # append another PredData object's data, or append data (in the same list-of-tuples format) to this one's data
+    # append another PredData object's data, or append data (in the tuple-of-columns format returned by loadData) to this one's data
     def appendData(self, newData):
         if type(newData) == tuple:
             newPredData = PredData(newData)
         else: 
             newPredData = newData
+        for name in COLUMNS:
+            a = self.columns[name]
+            b = newPredData.columns[name]
+            if isinstance(a, Categorical): self.columns[name] = a.concatenate(b)
+            else: self.columns[name] = numpy.concatenate((a, b))
         self.count += newPredData.count
-        self.data += newPredData.data
         
         
+    # the values of strOut where strVar equals val (either can be a column, or a derived value such as 'delays')
     def dataForVarEqualTo(self, strOut, strVar, val):
-        theDict = self.getDict()
-        out = theDict[strOut]
-        var = theDict[strVar]
-        #indices = []
-        outList = []
-        for (o,v) in zip(out,var):
-            if v == val: outList.append(o)
-        return outList
+        var = self.columns.get(strVar)
+        if isinstance(var, Categorical): mask = var.equalTo(val)
+        else: mask = (self.variable(strVar) == val)
+        return self.variable(strOut, numpy.nonzero(mask)[0])
     
     # a special case of the above method    
     def delaysForPredEqualTo(self, targetPred):
-        delays = self.delays()
-        predictions = self.predictions()
-        theDelays = []
-        for (d,p) in zip(delays, predictions):
-            if p == targetPred: theDelays.append(d)
-        return theDelays
-        #return [d for (d,p) in zip(delays,predictions) if p == targetPred]
+        return self.delays()[self.predictions() == targetPred]
     
     
     # some idiosyncratic getters for certain data: 
+    
+    # current times, in seconds from midnight of the earliest day in the data
     def currentTimesInSeconds(self):
-        from datetime import datetime, timedelta
-        
         cts = self.currentTimes()
-        t0 = datetime.strptime(min(cts), TIME_FMT)
-        t0 = t0.strftime(TIME_FMT.split()[0]) + ' 00:00:00'
-        t0 = datetime.strptime(t0, TIME_FMT)
-
-        return [(datetime.strptime(ct,TIME_FMT) - t0).total_seconds()]
+        t0 = cts.min().astype('datetime64[D]')
+        return (cts - t0).astype('timedelta64[s]').astype(float)
     
+    # day of the week of the current times (Monday = 1, ..., Sunday = 7)
     def dayOfWeekNumeric(self):
-        from datetime import datetime
-        return [datetime.strptime(ct,TIME_FMT).isoweekday() for ct in cts]
+        days = self.currentTimes().astype('datetime64[D]').astype(numpy.int64)
+        return (days + 3) % 7 + 1		# 1970-01-01 was a Thursday
             
             
             
-    # sets the output type for list getters (which as constructed return tuples)
-    def formatOutput(self, out):
-        return (list(out))    
+    # a column as an array (optionally, only the entries at indices); numeric and time columns
+    #    are returned without copying when no indices are given
+    def column(self, name, indices=None):
+        col = self.columns[name]
+        if isinstance(col, Categorical): return col.values(indices)
+        if indices is None: return col
+        return col[indices]
+        
+    # a column, or a derived value (see DERIVED_COLUMNS), by name
+    def variable(self, name, indices=None):
+        if name in DERIVED_COLUMNS: return getattr(self, DERIVED_COLUMNS[name])(indices)
+        return self.column(name, indices)
+        
+    # the Categorical object (codes and categories) for a tag column
+    def categorical(self, name):
+        return self.columns[name]
 
 	# list getters
-    def routes(self,indices=None):
-        A = self.getLists()
-        a = A[self.parser.routeIndex()]
-        if indices:
-            r = a; a = []
-            for i in indices: a.append(r[i])
-        return(self.formatOutput(a))
-    def stops(self,indices=None):
-        A = self.getLists()
-        a = A[self.parser.stopIndex()]
-        if indices:
-            r = a; a = []
-            for i in indices: a.append(r[i])
-        return(self.formatOutput(a))
-    def vehicles(self,indices=None):
-        A = self.getLists()
-        a = A[self.parser.vehicleIndex()]
-        if indices:
-            r = a; a = []
-            for i in indices: a.append(r[i])
-        return(self.formatOutput(a))
-    def directions(self,indices=None):
-        A = self.getLists()
-        a = A[self.parser.dirIndex()]
-        if indices:
-            r = a; a = []
-            for i in indices: a.append(r[i])
-        return(self.formatOutput(a))
-    def startTimes(self,indices=None):
-        A = self.getLists()
-        a = A[self.parser.startTimeIndex()]
-        if indices:
-            r = a; a = []
-            for i in indices: a.append(r[i])
-        return(self.formatOutput(a))
-    def endTimes(self,indices=None):
-        A = self.getLists()
-        a = A[self.parser.endTimeIndex()]
-        if indices:
-            r = a; a = []
-            for i in indices: a.append(r[i])
-        return(self.formatOutput(a))
-    def currentTimes(self,indices=None):
-        A = self.getLists()
-        a = A[self.parser.currentTimeIndex()]
-        if indices:
-            r = a; a = []
-            for i in indices: a.append(r[i])
-        return(self.formatOutput(a))
-    def predictions(self,indices=None):
-        A = self.getLists()
-        a = A[self.parser.predIndex()]
-        if indices:
-            r = a; a = []
-            for i in indices: a.append(r[i])
-        return(self.formatOutput(a))
-    def waits(self,indices=None):
-        A = self.getLists()
-        a = A[self.parser.waitIndex()]
-        if indices:
-            r = a; a = []
-            for i in indices: a.append(r[i])
-        return(self.formatOutput(a))
+    def routes(self,indices=None): return self.column('routes', indices)
+    def stops(self,indices=None): return self.column('stops', indices)
+    def vehicles(self,indices=None): return self.column('vehicles', indices)
+    def directions(self,indices=None): return self.column('directions', indices)
+    def startTimes(self,indices=None): return self.column('startTimes', indices)
+    def endTimes(self,indices=None): return self.column('endTimes', indices)
+    def currentTimes(self,indices=None): return self.column('currentTimes', indices)
+    def predictions(self,indices=None): return self.column('predictions', indices)
+    def waits(self,indices=None): return self.column('waits', indices)
     def delays(self,indices=None):
-        p = numpy.array(self.predictions())
-        w = numpy.array(self.waits())
-        d = list(w - p)
-        if indices:
-            r = d; d = []
-            for i in indices: d.append(r[i])
-        return d
-    def uncertainties(self,indices=None):
-        A = self.getLists()
-        a = A[self.parser.uncertaintyIndex()]
-        if indices:
-            r = a; a = []
-            for i in indices: a.append(r[i])
-        return(self.formatOutput(a))
-    def latitudes(self,indices=None):
-        A = self.getLists()
-        a = A[self.parser.latIndex()]
-        if indices:
-            r = a; a = []
-            for i in indices: a.append(r[i])
-        return(self.formatOutput(a))
-    def longitudes(self,indices=None):
-        A = self.getLists()
-        a = A[self.parser.lonIndex()]
-        if indices:
-            r = a; a = []
-            for i in indices: a.append(r[i])
-        return(self.formatOutput(a))    
-    # a utility for the above getters
+        d = self.columns['waits'] - self.columns['predictions']
+        if indices is None: return d
+        return d[indices]
+    def uncertainties(self,indices=None): return self.column('uncertainty', indices)
+    def latitudes(self,indices=None): return self.column('latitudes', indices)
+    def longitudes(self,indices=None): return self.column('longitudes', indices)
+    # all columns, in database file order
     def getLists(self):
-        return zip(*self.data)    
+        return tuple([self.column(name) for name in COLUMNS])
     
     def sortedBy(self, s):
-        if s.lower() == 'route': sortedData = sorted(self.data, key=lambda line: line[self.parser.routeIndex()])
-        if s.lower() == 'stop': sortedData = sorted(self.data, key=lambda line: line[self.parser.stopIndex()])
-        if s.lower() == 'vehicle': sortedData = sorted(self.data, key=lambda line: line[self.parser.vehicleIndex()])
-        if s.lower() == 'direction': sortedData = sorted(self.data, key=lambda line: line[self.parser.dirIndex()])
-        if s.lower() == 'startTime': sortedData = sorted(self.data, key=lambda line: line[self.parser.startTimeIndex()])
-        if s.lower() == 'endTime': sortedData = sorted(self.data, key=lambda line: line[self.parser.endTimeIndex()])
-        if s.lower() == 'currentTime': sortedData = sorted(self.data, key=lambda line: line[self.parser.currentTimeIndex()])
-        if s.lower() == 'predictedWait': sortedData = sorted(self.data, key=lambda line: line[self.parser.predIndex()])
-        if s.lower() == 'wait': sortedData = sorted(self.data, key=lambda line: line[self.parser.wiatIndex()])
-        if s.lower() == 'delay': sortedData = sorted(self.data, key=lambda line: line[-1])
-        if s.lower() == 'latitude': sortedData = sorted(self.data, key=lambda line: line[self.parser.latIndex()])
-        if s.lower() == 'uncertiainty': sortedData = sorted(self.data, key=lambda line: line[self.parser.deltaIndex()])
-        if s.lower() == 'longitude': sortedData = sorted(self.data, key=lambda line: line[self.parser.lonIndex()])
-        return self.copyContainingData(sortedData)
+        names = {'route': 'routes', 'stop': 'stops', 'vehicle': 'vehicles', 'direction': 'directions', \
+                 'starttime': 'startTimes', 'endtime': 'endTimes', 'currenttime': 'currentTimes', \
+                 'predictedwait': 'predictions', 'wait': 'waits', 'latitude': 'latitudes', \
+                 'uncertainty': 'uncertainty', 'uncertiainty': 'uncertainty', 'longitude': 'longitudes'}
+        if s.lower() == 'delay':
+            order = numpy.argsort(self.delays(), kind='mergesort')
+        else:
+            col = self.columns[names[s.lower()]]
+            if isinstance(col, Categorical): order = col.argsort()
+            else: order = numpy.argsort(col, kind='mergesort')
+            
+        sortedColumns = {}
+        for name in COLUMNS:
+            col = self.columns[name]
+            if isinstance(col, Categorical): sortedColumns[name] = col.take(order)
+            else: sortedColumns[name] = col[order]
+        return self.copyContainingData(sortedColumns)
 
 
 # Loads all of the data saved in the specified prediction database file, and returns it as a tuple
+#    of columnar arrays: (route, stop, vehicle, direction, startTime, endTime, currentTime, 
+#    predictedWait, actualWait, uncertainty, latitude, longitude).  Times are datetime64 arrays.
+#    Binary archives (see nmarchive) are loaded in place of the text file they go with.
 def loadData(fn='14',opt='recent'):
 
     if not fn: fn = '14'
         
     if len(fn) < 10:
-        (filenames, filename) = findFileStartingWith(filenameBase + fn)
+        (filenames, filename) = findDatabaseFiles(fn)
+        if filename is None: raise IOError('No prediction database files found for route %s' % fn)
     else:
         filename = fn
     print filename
+    
+    archiveFilename = nmarchive.archiveFilenames(filename)[0]
+    if filename == archiveFilename or (USE_BINARY_ARCHIVE and os.path.exists(archiveFilename)):
+        return loadArchive(archiveFilename)
+    return loadTextData(filename)
+    
+    
+# Loads a prediction database text file (see loadData)
+def loadTextData(filename):
+    
+    # parse the file in blocks of (about) LOAD_CHUNK_SIZE bytes, each ending on a line boundary
+    chunks = []
     fid = open(filename, 'r')
+    try:
+        remainder = ''
+        block = fid.read(LOAD_CHUNK_SIZE)
+        while block:
+            block = remainder + block
+            iend = block.rfind('\n') + 1
+            if iend > 0:
+                chunks.append(parseDataBuffer(block[:iend]))
+            remainder = block[iend:]
+            block = fid.read(LOAD_CHUNK_SIZE)
+        if remainder:
+            chunks.append(parseDataBuffer(remainder))
+    finally:
+        fid.close()
+        
+    if not chunks: chunks = [parseDataBuffer('')]
+    if len(chunks) == 1: return chunks[0]
+    return tuple([numpy.concatenate([c[i] for c in chunks]) for i in range(len(chunks[0]))])
+    
     
-    # get data indices (in line)
+# Converts the text of a prediction database file (complete lines only) to a tuple of columnar arrays
+#    (see loadData).  The text is parsed as one array of bytes: the separators of every line are
+#    located at once, and each column is converted from a (lines x characters) array of its fields.
+def parseDataBuffer(data):
+
     parser = nm.DatabaseParser()
-    iroute = parser.routeIndex(); istop = parser.stopIndex(); ivehicle = parser.vehicleIndex()
-    idirection = parser.directionIndex(); istarttime = parser.startTimeIndex(); iendtime = parser.endTimeIndex()
-    icurrenttime = parser.currentTimeIndex(); ipred = parser.predIndex(); iwait = parser.waitIndex()
-    idelta = parser.uncertaintyIndex(); ilat = parser.latitudeIndex(); ilon = parser.longitudeIndex()
-    
-    # make empty lists
-    route=[]; stop=[]; vehicle=[]; direction=[]; startTime=[]; stopTime=[]; endTime=[];
-    currentTime=[]; p=[]; w=[]; delta=[]; lat=[]; lon=[];
-    
-    txt = fid.readline()
-    
-    while txt:
-        if len(txt) > 0 and not txt[0] == '#':
-            data = txt.split(sep)
-           
-            # remove endline from end of line
-            if '\n' in data[-1]: data.pop()
+    buf = numpy.frombuffer(data, dtype=numpy.uint8)
+    
+    # line boundaries, without trailing whitespace (the last line may have no newline)
+    lineEnds = numpy.flatnonzero(buf == ord('\n'))
+    if len(buf) and buf[-1] != ord('\n'): lineEnds = numpy.append(lineEnds, len(buf))
+    lineStarts = numpy.zeros(len(lineEnds), dtype=lineEnds.dtype)
+    lineStarts[1:] = lineEnds[:-1] + 1
+    lineEnds = skipWhitespace(buf, lineEnds, forward=False)
+    
+    # the separators of each line; a separator at the end of a line has no field after it
+    seps = numpy.flatnonzero(buf == ord(sep))
+    firstSep = numpy.searchsorted(seps, lineStarts)
+    sepCount = numpy.searchsorted(seps, lineEnds) - firstSep
+    fieldCount = sepCount + 1
+    hasSep = numpy.flatnonzero(sepCount > 0)
+    fieldCount[hasSep] -= seps[firstSep[hasSep] + sepCount[hasSep] - 1] == lineEnds[hasSep] - 1
+    
+    # skip blank and comment lines; lines with lat/lon have 12 fields, older files have 10
+    isData = lineEnds > lineStarts
+    isData[isData] = buf[lineStarts[isData]] != ord(parser.commentTag)
+    for i in numpy.flatnonzero(isData & (fieldCount < 10)):
+        print "Line with less than 10 entries reached: %s" % data[lineStarts[i]:lineEnds[i]]
+    keep = isData & (fieldCount >= 10)
+    if not keep.all():
+        lineStarts = lineStarts[keep]; lineEnds = lineEnds[keep]
+        firstSep = firstSep[keep]; sepCount = sepCount[keep]; fieldCount = fieldCount[keep]
+        
+    # the (whitespace-trimmed) start of the field after each separator, and end of the field before it
+    fieldStarts = numpy.append(skipWhitespace(buf, seps + 1), 0)
+    fieldEnds = numpy.append(skipWhitespace(buf, seps, forward=False), 0)
+    lineStarts = skipWhitespace(buf, lineStarts)
+    lastSep = len(seps)
+    
+    # the start and end of field i on every line (missing fields are empty)
+    def bounds(i):
+        if i == 0: start = lineStarts
+        else: start = fieldStarts[numpy.minimum(firstSep + i - 1, lastSep)]
+        end = numpy.where(i < sepCount, fieldEnds[numpy.minimum(firstSep + i, lastSep)], lineEnds)
+        start = numpy.where(i < fieldCount, start, end)
+        return (start, numpy.maximum(start, end))
+        
+    def column(name, alignRight=False): return fieldChars(buf, *bounds(parser.index(name)), alignRight=alignRight)
+    def tags(name): return fieldsToStrings(column(name))
+    def times(name): return fieldsToTimes(column(name))
+    def numbers(name, fallback=None): return fieldsToNumbers(column(name, alignRight=True), fallback)
+    
+    # (vehicle tags that are not numbers are converted as in binary archives)
+    return (tags('routeTag'), tags('stopTag'), numbers('vehicle', nmarchive.vehicleNumbers).astype(numpy.int64), 
+            tags('directionTag'), times('startTime'), times('endTime'), times('currentTime'), 
+            numbers('predictedWait'), numbers('actualWait'), numbers('uncertainty').astype(int), 
+            numbers('latitude'), numbers('longitude'))
             
-            try:
-                route.append(data[iroute]);
-                stop.append((data[istop])); 
-                vehicle.append(int(data[ivehicle])); 
-                direction.append((data[idirection])); 
-                startTime.append(data[istarttime]); 
-                endTime.append(data[iendtime]);
-                currentTime.append(data[icurrenttime]); 
-                p.append(float(data[ipred])); 
-                w.append(float(data[iwait])); 
-                delta.append(int(data[idelta]))
-                try:
-                    lat.append(float(data[ilat]))
-                    lon.append(float(data[ilon]))
-                except IndexError:
-                    lat.append(MISSING_VALUE)
-                    lon.append(MISSING_VALUE)
-            except IndexError:
-                print "Line with less than 10 entries reached: %s" % txt
-                
-        txt = fid.readline()
+            
+# Moves positions in buf forward (or, for the ends of fields, back) past any whitespace other than newlines
+def skipWhitespace(buf, positions, forward=True):
+    (pos, step, offset) = (positions.copy(), 1, 0) if forward else (positions.copy(), -1, -1)
+    while True:
+        c = buf.take(pos + offset, mode='clip')
+        white = (c <= ord(' ')) & (c != ord('\n'))
+        white &= (pos < len(buf)) if forward else (pos > 0)
+        if not white.any(): return pos
+        pos[white] += step
         
-    return (route,stop,vehicle,direction,startTime,endTime,currentTime,p,w,delta,lat,lon)
-
-
+        
+# Returns a (fields x characters) array of the bytes of each field, padded with zeros after the field
+#    (or, with alignRight, before it).  The rows are taken from a view of buf that has a row starting at
+#    every byte (so no array of indices is built).
+def fieldChars(buf, start, end, alignRight=False):
+    lengths = end - start
+    width = max(int(lengths.max()), 1) if len(lengths) else 1
+    first = (end - width) if alignRight else start
+    if len(first) and (first.min() < 0 or first.max() + width > len(buf)):
+        padding = numpy.zeros(width, dtype=numpy.uint8)
+        buf = numpy.concatenate((padding, buf, padding))
+        first = first + width
+    rows = numpy.lib.stride_tricks.as_strided(buf, shape=(max(len(buf) - width + 1, 0), width), strides=(1, 1))
+    chars = rows[first]
+    
+    # (the bytes of the neighbouring fields are cleared, unless every field fills its row)
+    if (lengths != width).any():
+        if alignRight: inField = numpy.arange(width) >= (width - lengths)[:, None]
+        else: inField = numpy.arange(width) < lengths[:, None]
+        numpy.multiply(chars, inField, out=chars)
+    return chars
+    
+    
+# Converts an array of (left-aligned) field bytes to an array of strings
+def fieldsToStrings(chars):
+    return numpy.ascontiguousarray(chars).view('S%d' % chars.shape[1]).reshape(len(chars))
+    
+    
+# (for fieldsToNumbers: the value of each digit, and weights that count the digits (4096), other
+#    characters (64) and dots (1) of a field of up to 63 bytes in one sum; zeros pad a field and count as nothing)
+DIGIT_VALUES = numpy.zeros(256)
+DIGIT_VALUES[ord('0'):ord('9') + 1] = numpy.arange(10)
+CHARACTER_WEIGHTS = 64 * numpy.ones(256)
+CHARACTER_WEIGHTS[0] = 0
+CHARACTER_WEIGHTS[ord('.')] = 1
+CHARACTER_WEIGHTS[ord('0'):ord('9') + 1] = 4096
 
+# Converts an array of (right-aligned) field bytes to floats.  Plain decimals (e.g. -122.41, 12) are
+#    converted by digit arithmetic, and nan and empty fields are MISSING_VALUE; anything else (e.g.
+#    exponents) is converted from its string by fallback (by default, numpy's float conversion).
+def fieldsToNumbers(chars, fallback=None):
+    (n, width) = chars.shape
+    places = 10.0 ** numpy.arange(width - 1, -1, -1)
+    
+    # plain decimals have 1-14 digits, at most one dot, and nothing else but a leading minus sign
+    codes = chars.astype(numpy.intp)		# (tables are faster to index with these than with bytes)
+    weights = CHARACTER_WEIGHTS.take(codes).dot(numpy.ones(width)).astype(numpy.int64)
+    (digitCount, otherCount, dotCount) = (weights >> 12, (weights >> 6) & 63, weights & 63)
+    firstChars = chars[numpy.arange(n), numpy.minimum(width - (digitCount + otherCount + dotCount), width - 1)]
+    isNegative = firstChars == ord('-')
+    simple = (otherCount == isNegative) & (dotCount <= 1) & (digitCount >= 1) & (digitCount <= 14) & (width < 64)
+    
+    # the digits as one integer, with the dot counted as a 0 digit, and the place of the dot (0 if there
+    #    is none); the digits after the dot are the remainder of that integer in the dot's place
+    number = DIGIT_VALUES.take(codes).dot(places)
+    dotPlace = (chars == ord('.')).dot(places)
+    hasDot = numpy.flatnonzero(dotPlace > 0)
+    fraction = numpy.fmod(number[hasDot], dotPlace[hasDot])
+    number[hasDot] = ((number[hasDot] - fraction) / 10.0 + fraction) / dotPlace[hasDot]
+    number[isNegative] *= -1
+    
+    other = ~simple
+    if fallback is None:
+        missing = chars[:, -1] == 0
+        if width >= 3:
+            missing |= (chars[:, -1] == ord('n')) & (chars[:, -2] == ord('a')) & (chars[:, -3] == ord('n')) & \
+                       ((chars[:, -4] == 0) if width > 3 else True)
+        number[missing] = MISSING_VALUE
+        other &= ~missing
+        fallback = lambda strings: numpy.array(strings, dtype=str).astype(float)
+    if other.any():
+        number[other] = fallback([row.tostring().lstrip('\0') for row in chars[other]])
+    return number
+    
+    
+# Converts an array of (left-aligned) field bytes to datetime64 values.  Times in TIME_FMT are converted
+#    by numpy as a whole; anything else (e.g. None, or fractional seconds) by toDatetime64.
+def fieldsToTimes(chars):
+    (n, width) = chars.shape
+    times = numpy.empty(n, dtype='datetime64[s]')
+    if width >= 19:
+        simple = chars[:, 18] != 0
+        if width > 19: simple &= chars[:, 19] == 0
+    else:
+        simple = numpy.zeros(n, dtype=bool)
+        
+    if simple.all():
+        return fieldsToStrings(chars[:, :19]).astype('datetime64[s]')
+    if simple.any():
+        times[simple] = fieldsToStrings(chars[simple, :19]).astype('datetime64[s]')
+    other = ~simple
+    if other.any(): times[other] = toDatetime64(fieldsToStrings(chars[other]))
+    return times
+    
+    
+# Loads a binary prediction archive (see loadData).  The archive's records are memory-mapped, so only the
+#    columns themselves are read.
+def loadArchive(fn):
+    (records, table) = nmarchive.openArchive(fn)
+    names = nm.DatabaseParser().order
+    
+    columns = []
+    for name in names:
+        col = records[name]
+        if name in nmarchive.TAG_FIELDS: col = table.tagsWithIds(col)
+        elif name in nmarchive.TIME_FIELDS: col = nmarchive.timesFromSeconds(col)
+        elif name in ['vehicle', 'uncertainty']: col = col.astype(int)
+        else: col = col.astype(float)
+        columns.append(col)
+    return tuple(columns)
+    
+    
+# Converts a prediction database text file to a binary archive (see nmarchive) with the same name, 
+#    and returns the archive's filename
+def convertToArchive(fn):
+    if len(fn) < 10:
+        (filenames, fn) = findFileStartingWith(filenameBase + fn, filenameExt)
+    return nmarchive.writeArchive(fn, loadTextData(fn))
+    
+    
 # Loads only the real & estimated prediction data from a database file
 def loadWaitTimes(fn=None):
     (route,stop,vehicle,direction,startTime,endTime,currentTime,p,w,delta,lat,lon) = loadData(fn)
@@ -388,15 +600,12 @@ def getDelays(fileName,targetPredictionTimes=None,targetDirection='IB'):
         
     data = loadData(fileName)
     route = data[0]
-    allRoutes = list(numpy.unique(route))
+    (allRoutes, routeCounts) = numpy.unique(route, return_counts=True)
     if len(allRoutes) > 1:
-        targetRoute = allRoutes[0]
-        for r in allRoutes:
-            if allRoutes.count(r) > allRoutes.count(targetRoute):
-                targetRoute = r
+        targetRoute = str(allRoutes[numpy.argmax(routeCounts)])
         warnings.warn("Multiple routes found in file; using the most frequent one (%s)" % targetRoute)
     else:
-        targetRoute = route[0]
+        targetRoute = str(route[0])
         
     rte = nm.BusRoute(targetRoute)
     
@@ -408,7 +617,7 @@ def getDelays(fileName,targetPredictionTimes=None,targetDirection='IB'):
     rw = data[dbp.realWaitIndex()]
     lat = data[dbp.latIndex()]
     lon = data[dbp.lonIndex()]
-    if lat and lon:
+    if len(lat) and not (numpy.all(numpy.isnan(lat)) or numpy.all(numpy.isnan(lon))):
         LAT_LON_RECORDED = True
     else:
         LAT_LON_RECORDED = False
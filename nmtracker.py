@@ -9,12 +9,16 @@
 # routeTag, stopTag, vehicle, directionTag, startTime, endTime, currentTime, predictedWait, actualWait, waitUncertainty,
 
 import nextmunipy as nm
+import nmarchive
 import matplotlib as mat
 from datetime import datetime, timedelta
 import time
 import numpy
 import warnings
-import os, csv
+import os, csv, math
+import heapq, random, copy
+from collections import deque
+from array import array
 
 WAIT_TIME = 60.0
 TIME_TO_RUN = 60 * 60 * 2
@@ -25,9 +29,120 @@ APPEND_DATE = True
 UNITS = 'minutes'
 DATABASE_FILENAME_BASE = '/users/jason/documents/python work/PredictionDatabaseRte'
 DATABASE_FILE_EXT = 'dat'
+POSITION_FILENAME_BASE = '/users/jason/documents/python work/VehiclePositionsRte'
+ARCHIVE_FORMAT = 'both'		# predictions are saved to a 'text' (.dat) file, a 'binary' archive (see nmarchive), or 'both'
+ARCHIVE_IN_BACKGROUND = True	# predictions are written (and shown) by a nmarchive.BackgroundArchiveWriter thread
 VERBOSE = True
 PREDICTION_TIME_THRESHOLD = 1.0
 MISSING_VALUE = numpy.NaN
+SCHEDULER_JITTER = 2.0		# seconds; random offset applied to each poll scheduled by a TrackerScheduler
+SCHEDULER_TICK = 1.0		# seconds; longest uninterrupted sleep of a TrackerScheduler
+COALESCE_REQUESTS = True	# a TrackerScheduler shares prediction requests between its routes
+COALESCE_WINDOW = 5.0		# seconds; polls due within this window of each other are sent together
+EPOCH = datetime(1970, 1, 1)	# (ActiveTrips store poll times as seconds since EPOCH)
+USE_VEHICLE_LOCATIONS = False	# also follow the route's vehicleLocations feed, to time arrivals to the second
+LOCATION_POLL_INTERVAL = 15.0	# seconds between vehicleLocations requests (independent of WAIT_TIME)
+VEHICLE_STALE_TIME = 15 * 60	# seconds; a VehicleTracker forgets vehicles that have not reported for this long
+ARRIVAL_RADIUS = 50.0		# meters; a vehicle reported within this distance of a stop is at the stop
+FINISHED_TRIP_COUNT = 1000	# the arrival sequences of this many finished trips are kept (see ActivePredictionStore)
+FINISHED_TRIP_AGE = 20 * 60	# seconds; a trip that has not arrived at a stop for this long is finished
+ADAPTIVE_POLLING = False	# poll each stop only as often as its soonest prediction calls for (see StopPollPlanner)
+HOT_STOP_MINUTES = 3		# stops with a vehicle predicted within this many minutes are polled every HOT_POLL_INTERVAL
+HOT_POLL_INTERVAL = 20.0	# seconds
+COLD_POLL_INTERVAL = 180.0	# seconds; longest time between polls of a stop
+BREAKER_FAILURES = 3		# consecutive failed polls after which a route's requests are suspended
+BREAKER_COOLDOWN = 5 * 60	# seconds; how long the requests of a route are suspended (see CircuitBreaker)
+OUTAGE_TIME = 5 * 60		# seconds; vehicles that leave the prediction lists after a gap this long between polls are not archived
+SKIP_UNCHANGED_STOPS = False	# stops whose <predictions> block did not change since the last poll are not parsed or tracked again
+				#   (their repeated predictions are then not archived, so the archives hold fewer samples)
+
+#
+#
+# CIRCUITBREAKER CLASS
+#
+
+class CircuitBreaker:
+    '''
+    Suspends the requests of a route after BREAKER_FAILURES consecutive failures (which nextmunipy has already
+    retried), for BREAKER_COOLDOWN seconds.  After that a single trial request is let through: if it succeeds
+    the route is polled as usual again, and if it fails the requests are suspended for another cooldown.
+    '''
+    def __init__(self, name, failureThreshold=None, cooldown=None):
+        if failureThreshold is None: failureThreshold = BREAKER_FAILURES
+        if cooldown is None: cooldown = BREAKER_COOLDOWN
+        self.name = name
+        self.failureThreshold = failureThreshold
+        self.cooldown = cooldown
+        self.failureCount = 0		# consecutive failures
+        self.openUntil = None		# epoch seconds; requests are suspended until then
+        self.tripCount = 0
+        
+    # True while requests are suspended
+    def isOpen(self, now=None):
+        if now is None: now = nm.clockTime()
+        return self.openUntil is not None and now < self.openUntil
+        
+    # True if a request may be sent now
+    def allowRequest(self, now=None):
+        return not self.isOpen(now)
+        
+    def recordSuccess(self):
+        self.failureCount = 0
+        self.openUntil = None
+        
+    def recordFailure(self, now=None):
+        if now is None: now = nm.clockTime()
+        self.failureCount += 1
+        if self.failureCount >= self.failureThreshold:
+            self.openUntil = now + self.cooldown
+            self.tripCount += 1
+            warnings.warn("Suspending requests for %s for %i s after %i failures" % (self.name, self.cooldown, self.failureCount))
+            
+            
+#
+#
+# STOPPOLLPLANNER CLASS
+#
+
+class StopPollPlanner:
+    '''
+    Decides which stops a StopController polls on each update: a stop is polled every HOT_POLL_INTERVAL seconds
+    while a vehicle is predicted within HOT_STOP_MINUTES of it (where arrivals are decided), and otherwise at
+    about half the time its soonest vehicle needs to get that close (at most COLD_POLL_INTERVAL seconds).
+    '''
+    def __init__(self, stopTags):
+        self.nextPollTimes = dict([(tag, 0.0) for tag in stopTags])	# epoch seconds; every stop is due at first
+        self.intervals = {}		# the latest poll interval of each stop
+        
+    # the poll interval of a stop whose soonest prediction is minutes away (None if no vehicle is predicted)
+    def pollInterval(self, minutes):
+        if minutes is None: return COLD_POLL_INTERVAL
+        if minutes <= HOT_STOP_MINUTES: return HOT_POLL_INTERVAL
+        return min(max((minutes - HOT_STOP_MINUTES) * 60.0 / 2.0, HOT_POLL_INTERVAL), COLD_POLL_INTERVAL)
+        
+    # the tags of the stops to poll now (including those due within half a hot interval, which would
+    #    otherwise wait for the next update)
+    def dueStops(self, now=None):
+        if now is None: now = nm.clockTime()
+        return set([tag for (tag, t) in self.nextPollTimes.items() if t <= now + HOT_POLL_INTERVAL / 2.0])
+        
+    # schedule the next poll of each polled stop from its predictions (a dictionary with stop tags as keys);
+    #    polled stops whose predictions did not change keep their interval
+    def schedule(self, predictions, unchangedTags=[], now=None):
+        if now is None: now = nm.clockTime()
+        for (tag, preds) in predictions.items():
+            minutes = [p.getMinutes() for p in preds]
+            self.intervals[tag] = self.pollInterval(min(minutes) if minutes else None)
+            self.nextPollTimes[tag] = now + self.intervals[tag]
+        for tag in unchangedTags:
+            self.nextPollTimes[tag] = now + self.intervals.get(tag, COLD_POLL_INTERVAL)
+            
+    # the number of stops polled every HOT_POLL_INTERVAL
+    def hotCount(self, now=None):
+        if now is None: now = nm.clockTime()
+        return len([t for t in self.nextPollTimes.values() if t <= now + HOT_POLL_INTERVAL])
+        
+        
 
 #
 #
@@ -43,6 +158,13 @@ class StopController:
         self.stops = stops
         self.lastUpdateTime = None
         self.stopUpdateTimes = [-1] * len(stops)
+        self.planner = None
+        self.plannedStops = None		# the stops of the next update (when a planner is used)
+        if ADAPTIVE_POLLING: self.planner = StopPollPlanner(self.tagsOfStops(stops))
+        self.cache = None				# (see nextmunipy.PredictionBlockCache)
+        if SKIP_UNCHANGED_STOPS: self.cache = nm.PredictionBlockCache()
+        self.unchangedStops = []		# the stops polled on the last update whose predictions did not change
+        self.soonestMinutes = {}		# dictionary (key=stopTag) of the soonest predicted arrival at each stop
 
         self.checkStops()
         self.routeTag = self.stops[0].routes[0]
@@ -119,10 +241,11 @@ class StopController:
        
     # INSTANCE METHODS
          
-    # sets all prediction times to empty
-    def clearPredictions(self):
+    # sets all prediction times (of the given stops) to empty
+    def clearPredictions(self, stops=None):
+        if stops is None: stops = self.stops
         self.predictions = {}
-        for s in self.stops:
+        for s in stops:
             self.predictions[s.tag] = []
             
             
@@ -155,29 +278,73 @@ class StopController:
      
             
             
+    # the (route tag, stop tag) pairs requested on each update
+    def requestPairs(self):
+        stops = self.stopsToPoll()
+        return zip(self.routeTagsOfStops(stops), self.tagsOfStops(stops))
+        
+    # the priority of the next update's request (see nextmunipy.RequestBudget): the minutes until the
+    #    soonest predicted arrival at its stops (None if there is none)
+    def requestPriority(self):
+        minutes = [self.soonestMinutes[s.tag] for s in self.stopsToPoll() if s.tag in self.soonestMinutes]
+        if minutes: return min(minutes)
+        return None
+        
+    # the stops requested on the next update: all of them, or (with a planner) the stops that are due
+    def stopsToPoll(self):
+        if not self.planner: return self.stops
+        if self.plannedStops is None:
+            due = self.planner.dueStops()
+            self.plannedStops = [s for s in self.stops if s.tag in due]
+        return self.plannedStops
+        
     # THE MOST IMPORTANT METHOD !
     # get predicted arrival times and assign to appropriate stops
     def updatePredictions(self):
         
-        currentTime = datetime.now()
+        currentTime = nm.now()
         
         #if len(self.stops) > MAX_STOPS_PER_REQUEST:
         #    warnings.warn('Desired number of stops (%i) exceeds maximum multi-stop request length set by application (%i).\n  (The actual limit on number of stops in a multi-stop request is 150.)' % (len(self.stops), MAX_STOPS_PER_REQUEST))
         
-        # get predictions for all stops in one URL request    
-        preds = nm.getMultiStopPrediction(self.routeTagsOfStops(self.stops), self.tagsOfStops(self.stops))
-        predList = nm.PredictionList(preds)
+        # get predictions for all (due) stops in one URL request    
+        stops = self.stopsToPoll()
+        preds = []
+        try:
+            if stops: preds = nm.getMultiStopPrediction(self.routeTagsOfStops(stops), self.tagsOfStops(stops), 
+                                                        cache=self.cache, priority=self.requestPriority())
+        except:
+            if self.cache: self.cache.clear()		# (the cache may hold blocks that were never delivered)
+            raise
+        self.assignPredictions(preds, currentTime, self.cache)
         
-        self.clearPredictions()
-        stopTags = self.tagsOfStops(self.stops)
+    # assign a list of predictions (for this controller's stops) to the appropriate stops
+    #    (called by updatePredictions, or by a PredictionCoalescer that requested them); only the
+    #    stops that were polled, and (with the cache that filtered the response) changed, appear in
+    #    the predictions dictionary
+    def assignPredictions(self, preds, currentTime, cache=None):
         
-        for p in predList:
-            idx = stopTags.index(p.stopTag)
+        polled = self.stopsToPoll()
+        self.unchangedStops = []
+        if cache: self.unchangedStops = [s for s in polled if cache.isUnchanged(s.routes[0], s.tag)]
+        if self.cache and cache is not self.cache: self.cache.clear()	# (its blocks are out of date now)
+        self.clearPredictions([s for s in polled if s not in self.unchangedStops])
+        stopIndices = dict([(tag, i) for (i, tag) in enumerate(self.tagsOfStops(self.stops))])
+        
+        for p in preds:
+            idx = stopIndices[p.stopTag]
             
             self.predictions[p.stopTag].append(p)
             self.stopUpdateTimes[idx] = currentTime
         
+        for (tag, ps) in self.predictions.items():
+            if ps: self.soonestMinutes[tag] = min([p.getMinutes() for p in ps])
+            elif tag in self.soonestMinutes: del self.soonestMinutes[tag]
+        
         self.lastUpdateTime = currentTime
+        if self.planner:
+            self.planner.schedule(self.predictions, self.tagsOfStops(self.unchangedStops))
+            self.plannedStops = None
     
     
     # Returns the predictions as a dictionary, with stop tags as keys
@@ -249,10 +416,373 @@ class StopController:
     
         
         
+# seconds since EPOCH of a datetime, and back
+def secondsFromTime(t):
+    return (t - EPOCH).total_seconds()
+    
+def timeFromSeconds(seconds):
+    return EPOCH + timedelta(seconds=seconds)
+    
+    
+#
+# ACTIVETRIP
+#
+class ActiveTrip(object):
+    '''
+    A vehicle's approach to a single stop, from the first poll that predicts it until it arrives.  Instead of
+    the Prediction objects themselves, only the (poll time, predicted minutes) samples that will be archived
+    are kept (in arrays), along with the latest poll (which decides when the vehicle has arrived).
+    '''
+    __slots__ = ['routeTag', 'stopTag', 'vehicle', 'directionTag', 'tripKey', 'position', 'pollTimes', 'minutes', 
+                 'lastPollTime', 'lastMinutes', 'zeroTime', 'arrivalTime']
+                 
+    # initialize with the first prediction for the vehicle at the stop, and the position of the stop
+    #    in the route's stop order for the prediction's direction (None if unknown)
+    def __init__(self, p, position=None):
+        self.routeTag = p.routeTag
+        self.stopTag = p.stopTag
+        self.vehicle = p.getVehicle()
+        self.directionTag = p.directionTag
+        self.tripKey = tripKey(p)
+        self.position = position
+        self.pollTimes = array('d')		# seconds since EPOCH
+        self.minutes = array('h')
+        self.lastPollTime = None
+        self.lastMinutes = None
+        self.zeroTime = None			# the update time at which the predicted wait first reached 0
+        self.arrivalTime = None			# the time the vehicle was located at the stop (see StopLocator)
+        self.addPrediction(p)
+        
+    def __len__(self):
+        return len(self.minutes)
+        
+    # set the time the vehicle was located at the stop (the first time since the trip was first polled)
+    def setArrivalTime(self, t):
+        if self.arrivalTime: return
+        if secondsFromTime(t) >= (self.pollTimes[0] if len(self) else secondsFromTime(self.lastPollTime)):
+            self.arrivalTime = t
+            
+    # record a poll of the vehicle (predictions shorter than PREDICTION_TIME_THRESHOLD are never archived,
+    #    so only the latest of those is kept)
+    def addPrediction(self, p):
+        self.lastPollTime = p.currentTime
+        self.lastMinutes = p.getMinutes()
+        if p.directionTag: self.directionTag = p.directionTag
+        if self.lastMinutes >= PREDICTION_TIME_THRESHOLD:
+            self.pollTimes.append(secondsFromTime(p.currentTime))
+            self.minutes.append(self.lastMinutes)
+            
+    # the actual wait (in minutes) from each poll until endTime; if the predicted wait reached 0 before
+    #    the vehicle left the prediction list, the arrival time is the average of the two times (unless
+    #    the vehicle was located at the stop, which gives the arrival time itself)
+    def actualWaits(self, endTime):
+        if self.arrivalTime:
+            end = secondsFromTime(self.arrivalTime)
+        else:
+            end = secondsFromTime(endTime)
+            if self.zeroTime: end = (end + secondsFromTime(self.zeroTime)) / 2.0
+        return [(end - t) / 60.0 for t in self.pollTimes]
+        
+    # the database rows (in nextmunipy.DatabaseParser.order) of the trip, for a vehicle that arrived at endTime
+    def rows(self, startTime, endTime, lat=MISSING_VALUE, lon=MISSING_VALUE):
+        rows = []
+        if self.arrivalTime: endTime = self.arrivalTime
+        for (t, m, w) in zip(self.pollTimes, self.minutes, self.actualWaits(endTime)):
+            if w >= 0.0:
+                rows.append((self.routeTag, self.stopTag, self.vehicle, self.directionTag, startTime, endTime, 
+                             timeFromSeconds(t), m, w, 0, lat, lon))
+        return rows
+        
+        
+#
+# STOPLOCATOR
+#
+class StopLocator:
+    '''
+    A spatial index of the stops of a BusRoute: the stops are kept in a grid of cells about radius meters 
+    wide, so that the stops near a position are found by looking in 9 cells.
+    '''
+    def __init__(self, route, radius=None):
+        if radius is None: radius = ARRIVAL_RADIUS
+        self.radius = radius
+        self.cells = {}		# dictionary (key=(row, column)) of lists of (direction key, position, stopTag, lat, lon)
+        
+        positions = [s.getPosition() for s in route.stops]
+        lat0 = numpy.mean([lat for (lat, lon) in positions]) if positions else 0.0
+        self.metersPerLat = 111320.0
+        self.metersPerLon = 111320.0 * math.cos(math.radians(lat0))
+        
+        for (directionKey, tags) in route.stopOrder.items():
+            for (position, tag) in enumerate(tags):
+                stop = route.stopWithTag(tag)
+                if not stop: continue
+                (lat, lon) = stop.getPosition()
+                cell = self.cell(lat, lon)
+                if cell not in self.cells: self.cells[cell] = []
+                self.cells[cell].append((directionKey, position, tag, lat, lon))
+                
+    # the grid cell of a position
+    def cell(self, lat, lon):
+        return (int(math.floor(lat * self.metersPerLat / self.radius)), int(math.floor(lon * self.metersPerLon / self.radius)))
+        
+    # the distance (in meters) between two nearby positions
+    def distance(self, lat1, lon1, lat2, lon2):
+        return math.hypot((lat2 - lat1) * self.metersPerLat, (lon2 - lon1) * self.metersPerLon)
+        
+    # the (position, stopTag) of the closest stop within radius of a position (on a direction, if given);
+    #    None if there is none
+    def nearestStop(self, lat, lon, directionKey=None):
+        if math.isnan(lat) or math.isnan(lon): return None
+        (row, column) = self.cell(lat, lon)
+        nearest = None
+        for r in (row - 1, row, row + 1):
+            for c in (column - 1, column, column + 1):
+                for (d, position, tag, stopLat, stopLon) in self.cells.get((r, c), []):
+                    if directionKey and d != directionKey: continue
+                    distance = self.distance(lat, lon, stopLat, stopLon)
+                    if distance <= self.radius and (nearest is None or distance < nearest[0]):
+                        nearest = (distance, position, tag)
+        if nearest: return nearest[1:]
+        return None
+        
+        
+# the key that groups the predictions of one trip of a vehicle, at all of its stops (without a trip tag,
+#    the vehicle and direction; the age limit of pruneTrips keeps apart the trips of a vehicle that runs
+#    the same direction again)
+def tripKey(p):
+    if p.tripTag: return p.tripTag
+    return (p.getVehicle(), p.directionTag)
+    
+    
+#
+# ACTIVEPREDICTIONSTORE
+#
+class ActivePredictionStore:
+    '''
+    The ActiveTrips followed by a TrackerController, by stop tag and vehicle, and by trip (see tripKey).  The
+    stops at which a trip arrived are recorded in order, so that arriving at a stop can close its trips at 
+    the stops before it (which the vehicle has passed), and keep them from being followed again.
+    '''
+    def __init__(self):
+        self.trips = {}		# dictionary (key=stopTag) of dictionaries (key=vehicle) of ActiveTrips
+        self.tripsByKey = {}	# dictionary (key=trip key) of dictionaries (key=stopTag) of ActiveTrips
+        self.arrivals = {}		# dictionary (key=trip key) of lists of (position, stopTag, arrival time)
+        self.finishedTrips = deque(maxlen=FINISHED_TRIP_COUNT)	# (trip key, arrivals) of pruned trips
+        
+    def __len__(self):
+        return sum([len(t) for t in self.trips.values()])
+        
+    # the trips at a stop, as a dictionary with vehicles as keys
+    def tripsAtStop(self, stopTag):
+        if stopTag not in self.trips: self.trips[stopTag] = {}
+        return self.trips[stopTag]
+        
+    # start following a trip at a stop
+    def add(self, trip):
+        self.tripsAtStop(trip.stopTag)[trip.vehicle] = trip
+        if trip.tripKey not in self.tripsByKey: self.tripsByKey[trip.tripKey] = {}
+        self.tripsByKey[trip.tripKey][trip.stopTag] = trip
+        
+    # stop following the trip of a vehicle at a stop (returns the ActiveTrip, or None)
+    def remove(self, stopTag, vehicle):
+        trip = self.tripsAtStop(stopTag).pop(vehicle, None)
+        if trip:
+            stops = self.tripsByKey.get(trip.tripKey, {})
+            if stops.get(stopTag) is trip: del stops[stopTag]
+        return trip
+        
+    # record the arrival of a trip at its stop, and stop following it there; returns the trips of the 
+    #    same vehicle (and direction) that are still followed at stops before it
+    def arrive(self, trip, arrivalTime):
+        self.remove(trip.stopTag, trip.vehicle)
+        if trip.position is None: return []
+        self.recordArrival(trip, arrivalTime)
+        
+        upstream = [t for t in self.tripsByKey.get(trip.tripKey, {}).values()
+                    if t.directionTag == trip.directionTag and t.position is not None and t.position < trip.position]
+        for t in upstream: self.remove(t.stopTag, t.vehicle)
+        return upstream
+        
+    # add a stop to the arrival sequence of a trip
+    def recordArrival(self, trip, arrivalTime):
+        if trip.tripKey not in self.arrivals: self.arrivals[trip.tripKey] = []
+        self.arrivals[trip.tripKey].append((trip.position, trip.stopTag, arrivalTime))
+        
+    # True if the trip of a prediction already arrived at (or passed) the stop at a position
+    def hasPassed(self, p, position):
+        if position is None: return False
+        for (arrivedPosition, stopTag, arrivalTime) in self.arrivals.get(tripKey(p), []):
+            if arrivedPosition >= position: return True
+        return False
+        
+    # forget the trips that are no longer followed at any stop, and are not among the trip keys of 
+    #    the latest poll, or that have not arrived at a stop for FINISHED_TRIP_AGE seconds before 
+    #    currentTime (their arrival sequences are moved to finishedTrips)
+    def pruneTrips(self, currentKeys, currentTime=None):
+        for key in self.tripsByKey.keys():
+            if not self.tripsByKey[key] and key not in currentKeys: del self.tripsByKey[key]
+        oldest = None
+        if currentTime is not None: oldest = currentTime - timedelta(seconds=FINISHED_TRIP_AGE)
+        for key in self.arrivals.keys():
+            isOld = oldest is not None and max([t for (position, stopTag, t) in self.arrivals[key]]) < oldest
+            if isOld or (key not in self.tripsByKey and key not in currentKeys):
+                self.finishedTrips.append((key, self.arrivalSequence(key)))
+                del self.arrivals[key]
+                
+    # the (stopTag, arrival time) of each stop at which a trip arrived, in stop order
+    def arrivalSequence(self, key):
+        return [(stopTag, t) for (position, stopTag, t) in sorted(self.arrivals.get(key, []))]
+        
+    # the total number of samples held
+    def sampleCount(self):
+        return sum([len(trip) for trips in self.trips.values() for trip in trips.values()])
+        
+    # the vehicles being followed at each stop
+    def vehiclesByStop(self):
+        vehicles = {}
+        for (stopTag, trips) in self.trips.items():
+            if trips: vehicles[stopTag] = trips.keys()
+        return vehicles
+        
+        
+# a poll snapshot: a dictionary (key=stopTag) of dictionaries (key=vehicle) of the Predictions of a poll
+#    (a vehicle predicted more than once at a stop keeps its soonest prediction)
+def pollSnapshot(predictions):
+    snapshot = {}
+    for (stopTag, preds) in predictions.items():
+        vehicles = {}
+        for p in preds:
+            v = p.getVehicle()
+            if v not in vehicles: vehicles[v] = p
+        snapshot[stopTag] = vehicles
+    return snapshot
+    
+    
+#
+# POLLDIFF
+#
+class PollDiff:
+    '''
+    The changes between two poll snapshots (see pollSnapshot), as lists of (stopTag, vehicle) pairs: the 
+    vehicles that appeared at a stop, those that are still predicted (updated), and those that disappeared.
+    Only the stops in the current snapshot (i.e., the stops that were polled) are compared.
+    '''
+    def __init__(self, previous, current):
+        self.appeared = []
+        self.updated = []
+        self.disappeared = []
+        
+        for (stopTag, vehicles) in current.items():
+            before = previous.get(stopTag)
+            if not before:
+                self.appeared.extend([(stopTag, v) for v in vehicles])
+            elif not vehicles:
+                self.disappeared.extend([(stopTag, v) for v in before])
+            else:
+                now = vehicles.viewkeys()
+                was = before.viewkeys()
+                self.appeared.extend([(stopTag, v) for v in now - was])
+                self.updated.extend([(stopTag, v) for v in now & was])
+                self.disappeared.extend([(stopTag, v) for v in was - now])
+                
+    # the number of vehicles that appeared or disappeared
+    def __len__(self):
+        return len(self.appeared) + len(self.disappeared)
+        
+    def show(self):
+        print "Appeared:    " + str(self.appeared)
+        print "Disappeared: " + str(self.disappeared)
+        print "(%i vehicles updated)" % len(self.updated)
+        
+        
+#
+# TIMEDRUN
+#
+class TimedRun:
+    '''
+    The timing of a polling run, shared by TrackerController and VehicleTracker.  A subclass calls
+    initTiming from its __init__, and implements runIteration (which returns the time it finished at,
+    see recordIteration) and closeRun; start runs iterations every defaultWaitTime seconds for
+    timeToRun seconds, then calls stop.
+    '''
+    def initTiming(self, defaultWaitTime):
+        self.timeToRun = TIME_TO_RUN
+        self.defaultWaitTime = defaultWaitTime
+        self.count = 0
+        self.startTime = None
+        self.endTime = None
+        self.aveExecutionTime = 0
+        self.isStopped = False
+        
+    # prepare for a run (called by start, or by a TrackerScheduler)
+    def beginRun(self, startTime=None):
+        if startTime is None: startTime = nm.now()
+        self.startTime = startTime
+        self.endTime = startTime + timedelta(seconds=self.timeToRun)
+        self.count = 0
+        self.aveExecutionTime = 0
+        
+    # True once the run has lasted timeToRun seconds
+    def isFinished(self, currentTime=None):
+        if currentTime is None: currentTime = nm.now()
+        return currentTime > self.endTime
+        
+    # the time to wait before the next iteration, compensated for the average execution time
+    def currentWaitTime(self):
+        return max(self.defaultWaitTime - self.aveExecutionTime, 1e-3)
+        
+    # count an iteration that started at t0, and update the average execution time; returns the
+    #    time at which the iteration finished
+    def recordIteration(self, t0):
+        currentTime = nm.now()
+        self.count += 1
+        self.aveExecutionTime = ((self.count - 1) * self.aveExecutionTime + (currentTime - t0).total_seconds()) / self.count
+        return currentTime
+        
+    # (shown before each iteration of start)
+    def showIteration(self, currentTime):
+        pass
+        
+    # sleep until the next iteration
+    def wait(self, seconds):
+        nm.sleep(seconds)
+        
+    # run iterations until timeToRun has passed (or stop is called)
+    def start(self):
+        
+        self.beginRun()
+        currentTime = self.startTime
+        
+        try:
+            while currentTime <= self.endTime and not self.isStopped:
+               
+                self.showIteration(currentTime)
+           
+                # wait the specified amount of time
+                if (self.count > 0): self.wait(self.currentWaitTime())
+                
+                currentTime = self.runIteration()
+			
+			# end of while loop.
+        
+        except nm.ReplayFinished:
+            raise		# (the end of a replay, see replayResponses)
+        except:
+            print '\n\n*** LOOP FAILED TO COMPLETE ***\n\n'
+        finally:
+            self.stop()		# (writes any buffered output)
+            
+    # end the run (once), closing its files
+    def stop(self):
+        if self.isStopped: return
+        self.isStopped = True
+        self.closeRun()
+        
+        
 #
 # TRACKERCONTROLLER
 #
-class TrackerController:
+class TrackerController(TimedRun):
     '''
     An object that controls the timing of a StopController's prediction request methods, 
     and generates a database file (currently, a text file) that is periodically updated 
@@ -261,10 +791,7 @@ class TrackerController:
     # initialize using route tag (e.g., '12' or 'N')
     def __init__(self, routeTag, stopIndices=None):
         self.route = nm.BusRoute(routeTag)
-        self.timeToRun = TIME_TO_RUN
-        self.defaultWaitTime = WAIT_TIME
-        self.count = 0
-        self.startTime = None
+        self.initTiming(WAIT_TIME)
         
         
         # the stop controller
@@ -276,6 +803,10 @@ class TrackerController:
             self.stops = newStops
             
         self.stopController = StopController(self.stops)
+        if self.stopController.planner: self.defaultWaitTime = HOT_POLL_INTERVAL
+        self.breaker = CircuitBreaker('route ' + self.route.routeTag)
+        self.failedCount = 0		# polls that failed (after their retries)
+        self.lastTrackTime = None	# the update time of the latest poll that was tracked
         # make sure all stops only have a single route listed
         for s in self.stopController.stops:
             s.routes = [self.route.routeTag]
@@ -289,43 +820,60 @@ class TrackerController:
         fname += '.' + DATABASE_FILE_EXT
         self.filename = fname
         
-        # open the file where data will be saved (with overwrite turned on; when data
-        #	is actually saved, append mode is used)
-        self.fid = open(self.filename, 'w')
-        self.writeHeaderToFile()
-        self.fid.close()	# close for now; open in append mode later
-        
+        # the archive writers (the text file, and/or the binary archive) keep their files open
+        #	for the whole run, and write predictions in batches
+        self.archiveWriters = []
+        if ARCHIVE_FORMAT in ['text', 'both']:
+            self.textArchive = nmarchive.TextArchiveWriter(self.filename, header=self.databaseHeader())
+            self.archiveWriters.append(self.textArchive)
+        else:
+            self.textArchive = None
+        if ARCHIVE_FORMAT in ['binary', 'both']:
+            self.binaryArchive = nmarchive.BinaryArchiveWriter(self.filename, overwrite=True)
+            self.archiveWriters.append(self.binaryArchive)
+        else:
+            self.binaryArchive = None
+            
+        # (from a background thread, so that the polling loop only has to queue predictions)
+        self.archiveInBackground = ARCHIVE_IN_BACKGROUND and len(self.archiveWriters) > 0
+        if self.archiveInBackground:
+            self.archiveWriters = [nmarchive.BackgroundArchiveWriter(self.archiveWriters, onWrite=self.showArchivedRows)]
             
         # the predictions
-        self.activePredictionContainer = {}  # dictionary (key=vehicleNo) containing lists of predictions
-        self.predictionArchive = [] # list of arrived predictions
+        self.activeTrips = ActivePredictionStore()  # the vehicles being followed to each stop
+        self.lastPoll = {}		# the latest poll snapshot of each stop (see pollSnapshot)
+        self.tripPositions = {}	# dictionary (key=(stopTag, directionTag)) of positions in the route's stop order
+        
+        # vehicle locations (optional; used to time arrivals more precisely than the prediction polls can)
+        self.useVehicleLocations = USE_VEHICLE_LOCATIONS
+        self.stopLocator = None
+        self.lastLocationTime = 0		# the NextBus time of the latest vehicleLocations request
+        self.lastLocationPoll = None
+        self.vehicleStops = {}			# dictionary (key=vehicle) of the (direction key, position, time) of the last stop it was located at
         self.predictionCount = 0
         
         # output
         print "Tracker Controller initialized to follow route %s" % self.route.routeTag
-        print "  - Predictions will be saved to:\n      %s" % self.filename
+        if self.textArchive: print "  - Predictions will be saved to:\n      %s" % self.filename
+        if self.binaryArchive: print "  - Predictions will be archived to:\n      %s" % self.binaryArchive.filename
             
     
-    # write header info to file
-    def writeHeaderToFile(self):
-        self.fid.write('# Prediction data for Route ' + self.route.routeTag + '\n')
-        self.fid.write('# Date: ' + str(datetime.now()).split('.')[0] + '\n')
+    # the header info at the top of the database file
+    def databaseHeader(self):
+        header = '# Prediction data for Route ' + self.route.routeTag + '\n'
+        header += '# Date: ' + str(nm.now()).split('.')[0] + '\n'
         stopStr = ''
         for s in self.stops:
             stopStr += (s.tag + '; ')
-        self.fid.write('# Stops to track (%i total): ' % len(self.stops) + '\n')
-        self.fid.write('#   ' + stopStr + '\n')
-        self.fid.write('# routeTag | stopTag | vehicle | directionTag | startTime | endTime | currentTime | predictedWait | actualWait | uncertainty | latitude | longitude\n')
+        header += '# Stops to track (%i total): ' % len(self.stops) + '\n'
+        header += '#   ' + stopStr + '\n'
+        header += '# routeTag | stopTag | vehicle | directionTag | startTime | endTime | currentTime | predictedWait | actualWait | uncertainty | latitude | longitude\n'
+        return header
         
         
-    # get all vehicles in a list of predictions
+    # get all vehicles in a list of predictions (as a set)
     def getVehicles(self, predList):
-        V = []
-        for p in predList:
-            v = p.getVehicle()
-            if v not in V:
-                V.append(v)
-        return V
+        return set([p.getVehicle() for p in predList])
     
     
     #
@@ -334,32 +882,27 @@ class TrackerController:
     
     # general-purpose viewer
     def show(self):
-        print self.activePredictionContainer
+        print self.activeTrips.vehiclesByStop()
     
     # outputs (to console) the vehicles that are currently being tracked at each stop
     def showActivePredictions(self):
-        keys = self.activePredictionContainer.keys()
-        for stopTag in keys:
-            predByVehicle = self.activePredictionContainer[stopTag]
-            vehicles = predByVehicle.keys()
+        for (stopTag, vehicles) in self.activeTrips.vehiclesByStop().items():
+            trips = self.activeTrips.tripsAtStop(stopTag)
             print "STOP " + stopTag
             print "  Vehicles: " + str(vehicles)
             for v in vehicles:
-                preds = predByVehicle[v]
-                for p in preds:
-                    print "  " + v + ": " + str(p.currentTime).split('.')[0] + " --> " + str(p.getMinutes())
+                for (t, m) in zip(trips[v].pollTimes, trips[v].minutes):
+                    print "  " + v + ": " + str(timeFromSeconds(t)).split('.')[0] + " --> " + str(m)
                     
     
     #
     #
     # DATA UPDATING & SAVING METHODS
     
-    # save the predictions to file
+    # save (closed) predictions to file
     def archivePredictions(self, predictions):    
         
-        dbp = nm.DatabaseParser()
-        sep = dbp.separator
-        self.fid = open(self.filename, 'a')
+        rows = []
         
         for p in predictions:
         
@@ -371,38 +914,50 @@ class TrackerController:
 #                 print 'Actual wait:    ' + str(p.actualWait)
             
             if p.actualWait >= 0.0 and p.getMinutes() >= PREDICTION_TIME_THRESHOLD:
-            
-				# store to ivar:
-				self.predictionArchive.append(p)
-				self.predictionCount += 1
-				
-				print "ACTUAL WAIT: " + str(p.actualWait)
-				
-				# get stop info
-				try:
-				    stop = self.route.stopWithTag(p.stopTag)
-				    if stop:
-				        (lat, lon) = stop.getPosition()
-				    else:
-				        warnings.warn("Could not find stop with tag %s in BusRoute stop list. Cannot save lat/lon." % p.stopTag)
-				except:
-				    lat, lon = MISSING_VALUE, MISSING_VALUE
+				(lat, lon) = self.stopPosition(p.stopTag)
+				    
+				# the database row (in DatabaseParser.order)
+				rows.append((p.routeTag, p.stopTag, p.getVehicle(), p.directionTag, p.startTime, p.endTime, 
+				             p.currentTime, int(p.getMinutes()), p.actualWait, p.uncertainty, lat, lon))
 				        
-				# save prediction to file:
-				s = '%s' % p.routeTag + sep
-				s += '%s' % p.stopTag + sep
-				s += '%s' % p.getVehicle() + sep
-				s += '%s' % p.directionTag + sep
-				s += '%s' % str(p.startTime).split('.')[0] + sep
-				s += '%s' % str(p.endTime).split('.')[0] + sep
-				s += '%s' % str(p.currentTime).split('.')[0] + sep
-				s += '%i' % p.getMinutes() + sep
-				s += '%f' % p.actualWait + sep
-				s += '%i' % p.uncertainty + sep
-				s += '%f' % lat + sep
-				s += '%f' % lon + sep
-				s += '\n'
-				self.fid.write(s)
+        self.archiveRows(rows)
+        
+    # save the predictions of a trip whose vehicle arrived at endTime to file
+    def archiveTrip(self, trip, endTime, reason):
+        (lat, lon) = self.stopPosition(trip.stopTag)
+        self.archiveRows(trip.rows(self.startTime, endTime, lat, lon), self.arrivalMessage(trip, reason))
+        
+    # save database rows to file; the message (if any) is shown with them, by the background writer if
+    #    there is one (so the polling loop does not wait on the console either)
+    def archiveRows(self, rows, message=None):
+        self.predictionCount += len(rows)
+        
+        # (the writers buffer rows, and write them in batches)
+        if self.archiveInBackground:
+            self.archiveWriters[0].write(rows, message)
+            return
+        self.showArchivedRows(rows, message)
+        if not rows: return
+        for w in self.archiveWriters:
+            w.write(rows)
+            
+    # the (lat, lon) of a stop on the route
+    def stopPosition(self, stopTag):
+        try:
+            stop = self.route.stopWithTag(stopTag)
+            if stop:
+                return stop.getPosition()
+            else:
+                warnings.warn("Could not find stop with tag %s in BusRoute stop list. Cannot save lat/lon." % stopTag)
+        except:
+            pass
+        return (MISSING_VALUE, MISSING_VALUE)
+            
+    # print the actual waits of archived predictions (database rows), and the message archived with them
+    def showArchivedRows(self, rows, message=None):
+        for r in rows:
+            print "ACTUAL WAIT: " + str(r[8])
+        if message: print message
             
    
          
@@ -429,148 +984,609 @@ class TrackerController:
         return predList
             
             
-    # Cycles through predictions to see if any arrivals occurred, and takes appropriate database action
+    # the position of a stop in the route's stop order for a direction tag (None if it cannot be found)
+    def tripPosition(self, stopTag, directionTag):
+        k = (stopTag, directionTag)
+        if k not in self.tripPositions:
+            position = None
+            directionKey = self.route.directionKeyOfTag(directionTag)
+            if directionKey:
+                position = self.route.stopPosition(stopTag, directionKey)
+            elif len(self.route.stopPositions.get(stopTag, [])) == 1:
+                position = self.route.stopPositions[stopTag][0][1]
+            self.tripPositions[k] = position
+        return self.tripPositions[k]
+        
+    # Compares the predictions (a dictionary, with stop tags as keys) with those of the previous poll
+    #    to see if any arrivals occurred, and takes appropriate database action
     def trackUsingPredictions(self, predictions, updateTime):
         
-        # predictions are organized by stop (i.e., predictions' keys are stop tags)
-        keys = predictions.keys()
+        current = pollSnapshot(predictions)
+        diff = PollDiff(self.lastPoll, current)
+        self.lastPoll.update(current)
         
-        activeStops = self.activePredictionContainer.keys()				# the stops in the container currently
+        # (after an outage, the vehicles that left the lists may have arrived at any time during it)
+        isAfterOutage = self.lastTrackTime is not None and (updateTime - self.lastTrackTime).total_seconds() > OUTAGE_TIME
+        self.lastTrackTime = updateTime
         
-        for stopTag in keys:
-            
-            predsByStop = predictions[stopTag]           				# all predictions for a certain stop
-            vehiclesCurrentlyAtStop = self.getVehicles(predsByStop)		# the vehicles currently at that stop
+        # vehicles that are (still) predicted: follow them
+        for (stopTag, v) in diff.appeared + diff.updated:
+            p = current[stopTag][v]
+            trips = self.activeTrips.tripsAtStop(stopTag)
             
-            # find the vehicles at this stop that we are tracking (in the container):
-            if stopTag in activeStops:
-                contents = self.activePredictionContainer[stopTag]
-                if isinstance(contents, dict):
-                    vehiclesBeingTrackedAtStop = contents.keys()
-                else:
-                    vehiclesBeingTrackedAtStop = []
-            else:
-                self.activePredictionContainer[stopTag] = {}
-                vehiclesBeingTrackedAtStop = []
-                    
-            for p in predsByStop:
-                v = p.getVehicle()		# one of the vehiclesCurrentlyAtStop
-                p.startTime = self.startTime
+            if v in trips:
+                trip = trips[v]
+                trip.addPrediction(p)
+                if trip.lastMinutes <= 0 and not trip.zeroTime:
+                    # the time when the prediction went to 0; it will be averaged with the time when
+                    #   the vehicle disappears from the list
+                    trip.zeroTime = updateTime
+            elif p.getMinutes() > 0:
+                # (otherwise, we have already counted the vehicle as arrived (i.e., its timer went
+                #   to 0 in a previous iteration), but it is still on the prediction list.  In this
+                #   case, do not re-add it.  The same goes for stops that the trip has already passed.)
+                position = self.tripPosition(stopTag, p.directionTag)
+                if not self.activeTrips.hasPassed(p, position):
+                    self.activeTrips.add(ActiveTrip(p, position))
                 
-                if v in vehiclesBeingTrackedAtStop:
-                    self.activePredictionContainer[stopTag][v].append(p)
-                else:
-                    if (p.getMinutes() > 0):
-                        self.activePredictionContainer[stopTag][v] = [p]
-                    else:
-                        None
-                        # this means we have already counted the vehicle as arrived (i.e., its
-                        #   timer went to 0 in a previous iteration), but it is still on the prediction
-                        #   list.  In this case, do not re-add it to the list.
+        # vehicles that are no longer predicted at a stop have arrived there; the trips are handled in stop
+        #   order, so that a vehicle that left the lists of several stops in this poll arrives at each of them
+        leaving = set(diff.disappeared)
+        trips = [self.activeTrips.tripsAtStop(stopTag).get(v) for (stopTag, v) in diff.disappeared]
+        for trip in sorted([t for t in trips if t], key=lambda t: t.position):
+            if self.activeTrips.tripsAtStop(trip.stopTag).get(trip.vehicle) is not trip: continue	# (closed already)
+            if not self.isArrivalKnown(trip, isAfterOutage):
+                self.activeTrips.remove(trip.stopTag, trip.vehicle)
+                continue
                 
-            # see if any vehicles have arrived (i.e., are no longer in the vehiclesCurrentlyAtStop list)
-            arrivedVehicles = []
-            for v in vehiclesBeingTrackedAtStop:
-                arrived = None
-                if v not in vehiclesCurrentlyAtStop:
-                    p = self.activePredictionContainer[stopTag][v][-1]
-                    estimatedWait = p.getMinutes()
-                    actualTime = (datetime.now() - p.currentTime).total_seconds()/60.0
-                    if estimatedWait / actualTime > 4.0:
-                        arrived = 'arrival unlikey; estimate exceeded real wait time by factor of >= 4.0'
-                        del self.activePredictionContainer[stopTag][v]
-                    else:
-                        arrivedVehicles.append(v)
-                        arrived = 'no longer on active vehicle list'
-                elif self.activePredictionContainer[stopTag][v][-1].getMinutes() <= 0:    # if times has reached 0, count vehicle as arrived
-                    p.setEndTime(updateTime)  # <----- this is used to set the time when prediction went to 0; it will be averages with the time when the vehicle disappeared from the list
-                    #arrivedVehicles.append(v)
-                    arrivalLogic = 'timer reached zero'
-                
-                if VERBOSE and arrived:
-                    stop = self.route.stopWithTag(stopTag)
-                    print '*** Vehicle ' + v + ' arrived at stop ' + stopTag + ' (' + stop.name + ') ***'
-                    print '    Reason: ' + arrived + '\n'
-   
-            # if there are arrived vehicles
-            for v in arrivedVehicles:
-                # move all predictions for this vehicle at this stop to the archive
-                predsToArchive = self.activePredictionContainer[stopTag][v]   # <-- this is a list of predictions
-                if predsToArchive:
-                    self.closePredictions(predsToArchive, updateTime)
-                    del self.activePredictionContainer[stopTag][v]
-                    self.archivePredictions(predsToArchive)
+            # move the trip's predictions to the archive
+            upstream = self.activeTrips.arrive(trip, trip.arrivalTime or updateTime)
+            self.archiveTrip(trip, updateTime, 'no longer on active vehicle list')
+            
+            # the vehicle has passed the stops before this one (if it left their lists in this poll too, its
+            #   predicted wait reached 0 there, or it was located there, it arrived by now; otherwise its
+            #   arrival went unseen)
+            for t in upstream:
+                if (t.stopTag, t.vehicle) in leaving:
+                    if not self.isArrivalKnown(t, isAfterOutage): continue
+                    self.activeTrips.recordArrival(t, t.arrivalTime or updateTime)
+                    self.archiveTrip(t, updateTime, 'no longer on active vehicle list')
+                elif t.zeroTime or t.arrivalTime:
+                    self.activeTrips.recordArrival(t, t.arrivalTime or updateTime)
+                    self.archiveTrip(t, updateTime, 'arrived at a later stop')
+                elif VERBOSE:
+                    print '*** Vehicle ' + t.vehicle + ' passed stop ' + t.stopTag + ' unseen; dropping its predictions ***\n'
+                    
+        self.activeTrips.pruneTrips(set([tripKey(p) for vehicles in current.values() for p in vehicles.values()]), updateTime)
+        
+    # False if the time at which a trip's vehicle left the prediction list cannot be taken as its arrival
+    #    time (the reason is shown)
+    def isArrivalKnown(self, trip, isAfterOutage=False):
+        if trip.arrivalTime: return True
+        estimatedWait = trip.lastMinutes
+        actualTime = max((nm.now() - trip.lastPollTime).total_seconds()/60.0, 1e-6)
+        if estimatedWait / actualTime > 4.0:
+            self.showArrival(trip, 'arrival unlikey; estimate exceeded real wait time by factor of >= 4.0')
+            return False
+        if isAfterOutage:
+            self.showArrival(trip, 'arrival time unknown; vehicle arrived during an outage (not saved)')
+            return False
+        return True
+        
+    # request the vehicle locations of the route, if LOCATION_POLL_INTERVAL has passed since the last request
+    def updateLocationsIfDue(self, currentTime=None):
+        if not self.useVehicleLocations or self.isStopped: return
+        if currentTime is None: currentTime = nm.now()
+        if self.lastLocationPoll and (currentTime - self.lastLocationPoll).total_seconds() < LOCATION_POLL_INTERVAL: return
+        self.lastLocationPoll = currentTime
+        
+        try:
+            (locations, self.lastLocationTime) = nm.getVehicleLocations(self.route.routeTag, self.lastLocationTime)
+        except nm.ReplayFinished:
+            raise
+        except Exception as e:
+            warnings.warn("Could not get vehicle locations for route %s: %s" % (self.route.routeTag, e))
+            return
+        self.locateArrivals(locations)
+        
+    # set the arrival times of the trips whose vehicles were located at their stops; the stops a vehicle 
+    #    passed between two reports (at stops) get times interpolated between the two
+    def locateArrivals(self, locations):
+        if self.stopLocator is None: self.stopLocator = StopLocator(self.route)
+        
+        for loc in locations:
+            directionKey = self.route.directionKeyOfTag(loc.directionTag)
+            if not directionKey: continue
+            stop = self.stopLocator.nearestStop(loc.latitude, loc.longitude, directionKey)
+            if not stop: continue
+            
+            (position, stopTag) = stop
+            last = self.vehicleStops.get(loc.vehicle)
+            self.vehicleStops[loc.vehicle] = (directionKey, position, loc.reportTime)
+            if last and last[:2] == (directionKey, position): continue		# (still at the same stop)
+            
+            if last and last[0] == directionKey and last[1] < position:
+                (d, lastPosition, lastTime) = last
+                seconds = (loc.reportTime - lastTime).total_seconds()
+                for p in range(lastPosition + 1, position):
+                    t = lastTime + timedelta(seconds=seconds * (p - lastPosition) / float(position - lastPosition))
+                    self.setArrivalTime(self.route.stopOrder[directionKey][p], loc.vehicle, t)
+            self.setArrivalTime(stopTag, loc.vehicle, loc.reportTime)
+            
+    # set the arrival time of a vehicle's trip at a stop (if it is being followed there)
+    def setArrivalTime(self, stopTag, vehicle, t):
+        trip = self.activeTrips.tripsAtStop(stopTag).get(vehicle)
+        if trip: trip.setArrivalTime(t)
+        
+    # show an arrival whose predictions are not archived (through the archive writers, in order with the
+    #    arrivals that are)
+    def showArrival(self, trip, reason):
+        message = self.arrivalMessage(trip, reason)
+        if message: self.archiveRows([], message)
+        
+    # the text shown for an arrival (None unless VERBOSE)
+    def arrivalMessage(self, trip, reason):
+        if VERBOSE:
+            stop = self.route.stopWithTag(trip.stopTag)
+            return ('*** Vehicle ' + trip.vehicle + ' arrived at stop ' + trip.stopTag + ' (' + stop.name + ') ***\n' +
+                    '    Reason: ' + reason + '\n')
   
   
     #
     #
-    # TIMING METHODS
+    # TIMING METHODS (see TimedRun)
     
-    # runs the tracker on the specified route, generating a data file    
-    def start(self):
-        
-        elapsedTime = 0
-        startTime = datetime.now()
-        currentTime = datetime.now()
-        endTime = startTime + timedelta(seconds=self.timeToRun)
-        currentWaitTime = self.defaultWaitTime
-        aveExecutionTime = 0
+    # print the iteration banner
+    def showIteration(self, currentTime):
+        print '+---------------------------------------------------'
+        print '| ITERATION ' + str(self.count) + ' (Route ' + self.route.routeTag + ')'
+        print '|   Current time:      ' + str(currentTime).split('.')[0]
+        print '|   Expected end time: ' + str(self.endTime).split('.')[0]
+        print '|   Tracking %i stops' % len(self.stops)
+        if self.stopController.planner: print '|   (%i stops polled often)' % self.stopController.planner.hotCount()
+        if self.stopController.cache and self.count > 0:
+            print '|   %i stops unchanged on the last poll' % len(self.stopController.unchangedStops)
+        if self.predictionCount > 0: print '|   %i predicted arrivals recorded' % self.predictionCount
+        if self.failedCount > 0: print '|   %i polls failed' % self.failedCount
+        budget = nm.sharedRequestBudget
+        if budget and budget.delayedCount > 0:
+            print '|   %i requests delayed by the request budget (%.1f s in total)' % (budget.delayedCount, budget.totalDelay)
+        print '+---------------------------------------------------\n'            
         
-        self.startTime = startTime
-        self.count = 0
+    # update predictions, see if any arrivals occurred (logging predictions), and update
+    #    the average execution time; returns the time at which the iteration finished
+    def runIteration(self):
+        t0 = nm.now()
         
-        # begin timing the route
+        # update predictions (unless the route's requests are suspended); if that fails, the
+        #    tracked vehicles keep their last-known state until a poll succeeds
+        if not self.breaker.allowRequest():
+            if VERBOSE: print 'Requests for route %s suspended after repeated failures\n' % self.route.routeTag
+            return self.skipIteration()
         try:
-            while currentTime <= endTime:
-               
-                print '+---------------------------------------------------'
-                print '| ITERATION ' + str(self.count)
-                print '|   Current time:      ' + str(currentTime).split('.')[0]
-                print '|   Expected end time: ' + str(endTime).split('.')[0]
-                print '|   Tracking %i stops' % len(self.stops)
-                if self.predictionCount > 0: print '|   %i predicted arrivals recorded' % self.predictionCount
-                print '+---------------------------------------------------\n'            
-           
-                # wait the specified amount of time
-                if (self.count > 0): time.sleep(currentWaitTime)
-                t0 = datetime.now()
-				
-                # update predictions
-                self.stopController.updatePredictions()
-				
-                # see if any arrivals occurred, and log predictions
-                self.trackUsingPredictions(self.stopController.predictions, self.stopController.lastUpdateTime)
-                # self.showActivePredictions()
-				
-				
-                # update execution time
-                currentTime = datetime.now()
-                self.count += 1
-                aveExecutionTime = ((self.count - 1) * aveExecutionTime + (currentTime - t0).total_seconds()) / self.count
-                currentWaitTime = max(self.defaultWaitTime - aveExecutionTime, 1e-3)
-			
-			# end of while loop.
+            self.stopController.updatePredictions()
+        except nm.ReplayFinished:
+            raise
+        except Exception as e:
+            self.failedCount += 1
+            self.breaker.recordFailure()
+            warnings.warn("Could not update predictions for route %s: %s" % (self.route.routeTag, e))
+            return self.skipIteration()
         
-        except:
-            print '\n\n*** LOOP FAILED TO COMPLETE ***\n\n'
-        self.stop()
+        return self.finishIteration(t0)
+        
+    # an iteration without new predictions
+    def skipIteration(self):
+        for w in self.archiveWriters:
+            w.flushIfDue()
+        self.count += 1
+        return nm.now()
+        
+    # the part of an iteration that follows the prediction update (which a TrackerScheduler
+    #    may have done for several controllers at once)
+    def finishIteration(self, t0):
+        self.breaker.recordSuccess()
+        
+        # see if any arrivals occurred, and log predictions
+        self.updateLocationsIfDue()
+        self.trackUsingPredictions(self.stopController.predictions, self.stopController.lastUpdateTime)
+        # self.showActivePredictions()
+        
+        # write predictions that have been buffered for too long
+        for w in self.archiveWriters:
+            w.flushIfDue()
+        
+        # update execution time
+        return self.recordIteration(t0)
     
+    # sleep until the next iteration (following the vehicle locations in the meantime, if asked to)
+    def wait(self, seconds):
+        end = nm.clockTime() + seconds
+        while True:
+            self.updateLocationsIfDue()
+            remaining = end - nm.clockTime()
+            if remaining <= 0: break
+            if self.useVehicleLocations: nm.sleep(min(remaining, LOCATION_POLL_INTERVAL))
+            else: nm.sleep(remaining)
     
-    # stop method cleans up file i/o, and displays results
-    def stop(self):
-        self.fid.close()
+    # clean up file i/o, and display results (see TimedRun.stop)
+    def closeRun(self):
         
-        print '\n\n\nExecution completed at ' + str(datetime.now()).split('.')[0]
+        # write buffered predictions, and close the files
+        for w in self.archiveWriters:
+            try:
+                w.close()
+            except (IOError, OSError) as e:
+                warnings.warn("Could not save predictions to %s: %s" % (w.filename, e))
+        
+        print '\n\n\nExecution completed at ' + str(nm.now()).split('.')[0]
         print '\nAll prediction info saved to:\n' + '--> ' + self.filename
         print '--> (%i predictions total)' % self.predictionCount
         
         
         
         
+#
+# PREDICTIONCOALESCER
+#
+class PredictionCoalescer:
+    '''
+    Gathers the (route, stop) pairs of several StopControllers into shared predictionsForMultiStops
+    requests (as few MAX_STOPS_PER_PREDICTION-stop requests as possible), and routes the returned
+    predictions back to the controller that asked for each stop.
+    '''
+    def __init__(self):
+        self.updateCount = 0
+        self.pairCount = 0		# total number of (route, stop) pairs requested
+        self.requestCount = 0	# total number of URL requests sent
+        self.cache = None
+        if SKIP_UNCHANGED_STOPS: self.cache = nm.PredictionBlockCache()
+        
+    def updatePredictions(self, stopControllers):
+        
+        currentTime = nm.now()
+        
+        # gather the pairs of all controllers (each distinct pair is requested only once)
+        routeTags = []; stopTags = []
+        requested = set()
+        for sc in stopControllers:
+            for (routeTag, stopTag) in sc.requestPairs():
+                key = (nm.routeFromString(routeTag), stopTag)
+                if key not in requested:
+                    requested.add(key)
+                    routeTags.append(routeTag)
+                    stopTags.append(stopTag)
+                    
+        preds = []
+        try:
+            priorities = [sc.requestPriority() for sc in stopControllers]
+            priorities = [x for x in priorities if x is not None]
+            priority = min(priorities) if priorities else None
+            if stopTags: preds = nm.getMultiStopPrediction(routeTags, stopTags, cache=self.cache, priority=priority)
+        except:
+            if self.cache: self.cache.clear()
+            raise
+        
+        self.updateCount += 1
+        self.pairCount += len(stopTags)
+        if stopTags: self.requestCount += len(nm.splitStopRequest(routeTags, stopTags))
+        
+        # sort the predictions by (route, stop) pair
+        predsByPair = {}
+        for p in preds:
+            key = (p.routeTag, p.stopTag)
+            if key in predsByPair: predsByPair[key].append(p)
+            else: predsByPair[key] = [p]
+            
+        # hand each controller the predictions for its own stops (a controller asking for a pair that
+        #    another controller already received gets copies, since trackers modify their predictions)
+        delivered = set()
+        for sc in stopControllers:
+            scPreds = []
+            for (routeTag, stopTag) in sc.requestPairs():
+                key = (nm.routeFromString(routeTag), stopTag)
+                ps = predsByPair.get(key, [])
+                if key in delivered: ps = [copy.copy(p) for p in ps]
+                delivered.add(key)
+                scPreds += ps
+            sc.assignPredictions(scPreds, currentTime, self.cache)
+            
+    # average number of (route, stop) pairs per request
+    def pairsPerRequest(self):
+        if not self.requestCount: return 0.0
+        return float(self.pairCount) / self.requestCount
+        
+        
+        
+#
+# TRACKERSCHEDULER
+#
+class TrackerScheduler:
+    '''
+    Runs many TrackerControllers (e.g., one per route) in a single process.  Each controller is
+    polled on its own fixed schedule (start time + n * defaultWaitTime, so timing errors do not
+    accumulate), with a little jitter.  By default, polls that fall within COALESCE_WINDOW seconds
+    of each other are sent as shared requests by a PredictionCoalescer; otherwise, each route starts
+    at a random phase so that routes do not all poll at once.
+    '''
+    def __init__(self, controllers=None, jitter=None, coalesce=None):
+        if jitter is None: jitter = SCHEDULER_JITTER
+        if coalesce is None: coalesce = COALESCE_REQUESTS
+        self.controllers = []
+        self.jitter = jitter
+        self.coalescer = None
+        if coalesce: self.coalescer = PredictionCoalescer()
+        self.isRunning = False
+        if controllers:
+            for tc in controllers:
+                self.addController(tc)
+                
+    # add a TrackerController (or a route tag, from which a controller is created)
+    def addController(self, tc):
+        if isinstance(tc, str): tc = TrackerController(tc)
+        self.controllers.append(tc)
+        return tc
+        
+    # the (jittered) time of a controller's n-th poll after the reference time t0 (in epoch seconds)
+    def pollTime(self, t0, n, interval):
+        return t0 + n * interval + random.uniform(-self.jitter, self.jitter)
+        
+    # runs all controllers until each has run for its timeToRun, or until stop() is called
+    def start(self):
+        
+        self.isRunning = True
+        now = nm.clockTime()
+        
+        # queue of (poll time, n, controller index, reference time) tuples; the first poll of each
+        #    route is placed at a random phase within its interval (or, when coalescing, all
+        #    routes start together so that their polls fall in the same window)
+        queue = []
+        for (i, tc) in enumerate(self.controllers):
+            tc.beginRun()
+            if self.coalescer: t0 = now
+            else: t0 = now + random.uniform(0, tc.defaultWaitTime)
+            heapq.heappush(queue, (t0, 0, i, t0))
+            
+        print "Tracker Scheduler started for routes: " + ', '.join([tc.route.routeTag for tc in self.controllers])
+        if nm.USE_REQUEST_BUDGET: nm.getRequestBudget().ensureBurst(self.requestsPerPeriod())
+        
+        try:
+            while queue and self.isRunning:
+                (t, n, i, t0) = heapq.heappop(queue)
+                
+                # wait until the poll is due (in short steps, so that stop() takes effect quickly)
+                while self.isRunning and nm.clockTime() < t:
+                    nm.sleep(max(min(t - nm.clockTime(), SCHEDULER_TICK), 0))
+                    for tc in self.controllers: tc.updateLocationsIfDue()
+                if not self.isRunning: break
+                
+                # the polls in this batch: this one, plus (when coalescing) any due within the window
+                batch = [(t, n, i, t0)]
+                while self.coalescer and queue and queue[0][0] <= t + COALESCE_WINDOW:
+                    batch.append(heapq.heappop(queue))
+                    
+                currentTime = nm.now()
+                active = []
+                for entry in batch:
+                    tc = self.controllers[entry[2]]
+                    if tc.isFinished(currentTime): tc.stop()
+                    else: active.append(entry)
+                    
+                for entry in self.runBatch(active):
+                    (t, n, i, t0) = entry
+                    tc = self.controllers[i]
+                    
+                    # schedule the next poll; if this one overran, skip the polls that were missed
+                    n += 1
+                    now = nm.clockTime()
+                    while t0 + n * tc.defaultWaitTime < now:
+                        n += 1
+                    heapq.heappush(queue, (self.pollTime(t0, n, tc.defaultWaitTime), n, i, t0))
+                
+        except KeyboardInterrupt:
+            print '\n\n*** TRACKER SCHEDULER INTERRUPTED ***\n\n'
+        finally:
+            # (however the loop ends, every controller writes its buffered predictions and closes its files)
+            self.isRunning = False
+            for tc in self.controllers:
+                try:
+                    tc.stop()
+                except Exception as e:
+                    warnings.warn("Could not stop the tracker for route %s: %s" % (tc.route.routeTag, e))
+            
+    # the number of requests that the polls of all controllers send per MIN_TIME_BETWEEN_REQUESTS (every
+    #    stop at each controller's defaultWaitTime, and the vehicle locations of the routes that follow them)
+    def requestsPerPeriod(self):
+        period = float(nm.MIN_TIME_BETWEEN_REQUESTS)
+        chunks = lambda stopCount: math.ceil(stopCount / float(nm.MAX_STOPS_PER_PREDICTION))
+        if not self.controllers: return 0
+        if self.coalescer:
+            interval = min([tc.defaultWaitTime for tc in self.controllers])
+            count = chunks(sum([len(tc.stops) for tc in self.controllers])) * period / interval
+        else:
+            count = sum([chunks(len(tc.stops)) * period / tc.defaultWaitTime for tc in self.controllers])
+        count += sum([period / LOCATION_POLL_INTERVAL for tc in self.controllers if tc.useVehicleLocations])
+        return int(math.ceil(count))
+        
+    # the request priority of a queue entry's controller (lower is sooner; see StopController.requestPriority)
+    def requestPriority(self, entry):
+        priority = self.controllers[entry[2]].stopController.requestPriority()
+        if priority is None: return nm.DEFAULT_REQUEST_PRIORITY
+        return priority
+        
+    # run one iteration for each controller in a batch of queue entries (the routes with the soonest
+    #    arrivals first, since their requests are sent one after another through the request budget);
+    #    returns the entries whose controllers completed the iteration (failed controllers are stopped)
+    def runBatch(self, batch):
+        
+        t0 = nm.now()
+        batch = sorted(batch, key=self.requestPriority)		# (before the updates plan the next polls)
+        isUpdated = False
+        shared = [entry for entry in batch if self.controllers[entry[2]].breaker.allowRequest()]
+        if self.coalescer and len(shared) > 1:
+            try:
+                self.coalescer.updatePredictions([self.controllers[entry[2]].stopController for entry in shared])
+                isUpdated = True
+            except nm.ReplayFinished:
+                raise
+            except Exception as e:
+                # fall back to separate requests, so that a failure only counts against the route that caused it
+                warnings.warn("Shared prediction request failed (%s); polling the routes separately" % e)
+                
+        completed = []
+        for entry in batch:
+            tc = self.controllers[entry[2]]
+            if VERBOSE: tc.showIteration(nm.now())
+            try:
+                if isUpdated and entry in shared: tc.finishIteration(t0)
+                else: tc.runIteration()
+                completed.append(entry)
+            except:
+                print '\n\n*** LOOP FAILED TO COMPLETE FOR ROUTE %s ***\n\n' % tc.route.routeTag
+                tc.stop()
+        return completed
+            
+    # stops the scheduler (and, with it, all of its controllers)
+    def stop(self):
+        self.isRunning = False
+        
+        
+        
+#
+# VEHICLETRACKER
+#
+class VehicleTracker(TimedRun):
+    '''
+    Follows the vehicleLocations feed of one or more routes.  Each request passes the time returned by the
+    previous one (the API's t parameter), so only the vehicles that reported since then are sent.  The latest
+    location of each vehicle is kept in a table per route, and every new report is written to a position
+    archive (see nmarchive.PositionArchiveWriter).  Runs like a TrackerController (see TimedRun).
+    '''
+    # initialize with a route tag, or a list of route tags
+    def __init__(self, routeTags):
+        if isinstance(routeTags, str): routeTags = [routeTags]
+        self.routeTags = routeTags
+        self.initTiming(LOCATION_POLL_INTERVAL)
+        
+        # the state of each route: the time of its last request, and its vehicles' latest locations
+        self.lastTimes = dict([(r, 0) for r in routeTags])
+        self.vehicles = dict([(r, {}) for r in routeTags])		# dictionary (key=routeTag) of dictionaries (key=vehicle) of VehicleLocations
+        self.positionCount = 0
+        
+        fname = POSITION_FILENAME_BASE + '_'.join(routeTags)
+        if APPEND_DATE:
+            fname += ('_' + str(datetime.now()).replace('-','').replace(':','').split('.')[0].replace(' ','_') )
+        self.archive = nmarchive.PositionArchiveWriter(fname, overwrite=True)
+        self.filename = self.archive.filename
+        
+        print "Vehicle Tracker initialized to follow routes %s" % ', '.join(routeTags)
+        print "  - Vehicle positions will be archived to:\n      %s" % self.filename
+        
+    # the latest locations of the vehicles on a route (as a list)
+    def locationsOnRoute(self, routeTag):
+        return self.vehicles[routeTag].values()
+        
+    def show(self):
+        for r in self.routeTags:
+            print "ROUTE " + r
+            for loc in self.locationsOnRoute(r):
+                loc.show()
+                
+                
+    #
+    #
+    # UPDATING METHODS
+    
+    # request the locations reported on a route since the previous request, and archive the new reports;
+    #    returns the number of vehicles whose location changed
+    def updateRoute(self, routeTag):
+        (locations, self.lastTimes[routeTag]) = nm.getVehicleLocations(routeTag, self.lastTimes[routeTag])
+        
+        vehicles = self.vehicles[routeTag]
+        rows = []
+        for loc in locations:
+            last = vehicles.get(loc.vehicle)
+            if last and last.reportTime >= loc.reportTime: continue
+            vehicles[loc.vehicle] = loc
+            rows.append((routeTag, loc.vehicle, loc.directionTag or '', loc.reportTime, 
+                         loc.latitude, loc.longitude, loc.heading, loc.speed))
+                         
+        self.positionCount += len(rows)
+        self.archive.write(rows)
+        return len(rows)
+        
+    # forget the vehicles that have not reported for VEHICLE_STALE_TIME seconds
+    def pruneVehicles(self, currentTime=None):
+        if currentTime is None: currentTime = nm.now()
+        oldest = currentTime - timedelta(seconds=VEHICLE_STALE_TIME)
+        for vehicles in self.vehicles.values():
+            for (v, loc) in vehicles.items():
+                if loc.reportTime < oldest: del vehicles[v]
+                
+                
+    #
+    #
+    # TIMING METHODS (see TimedRun)
+    
+    # update the locations of every route (a route whose request fails is skipped until the next iteration);
+    #    returns the time at which the iteration finished
+    def runIteration(self):
+        t0 = nm.now()
+        
+        changed = 0
+        for r in self.routeTags:
+            try:
+                changed += self.updateRoute(r)
+            except Exception as e:
+                warnings.warn("Could not get vehicle locations for route %s: %s" % (r, e))
+        self.pruneVehicles(t0)
+        self.archive.flushIfDue()
+        
+        if VERBOSE:
+            print 'Iteration %i: %i vehicle locations updated (%i vehicles followed)' % (self.count, changed, 
+                  sum([len(v) for v in self.vehicles.values()]))
+        return self.recordIteration(t0)
+        
+    # write buffered positions, and close the archive (see TimedRun.stop)
+    def closeRun(self):
+        try:
+            self.archive.close()
+        except (IOError, OSError) as e:
+            warnings.warn("Could not save vehicle positions to %s: %s" % (self.filename, e))
+            
+        print '\n\n\nExecution completed at ' + str(nm.now()).split('.')[0]
+        print '\nAll vehicle positions saved to:\n' + '--> ' + self.filename
+        print '--> (%i positions total)' % self.positionCount
+        
+        
+        
 #
 # UTILITY FUNCTIONS
 #
 
+# Runs a TrackerController on the responses recorded by nm.startRecording (instead of nextbus.com), on a
+#   simulated clock, so that a day of polling can be tracked again in seconds; the replay ends when a
+#   request has no recorded response left.  (The responses are handed out per request, so the tracker
+#   settings, e.g. the route cache and the stops, must be the ones the recording was made with.)
+def replayResponses(filename, routeTag, stopIndices=None):
+
+    replayer = nm.startReplay(filename)
+    t0 = time.time()
+    try:
+        tc = TrackerController(routeTag, stopIndices)
+        if replayer.startTime is not None:
+            tc.timeToRun = replayer.endTime - replayer.startTime + tc.defaultWaitTime
+        try:
+            tc.start()
+        except nm.ReplayFinished:
+            pass
+    finally:
+        nm.stopReplay()
+        
+    print '--> %i of %i recorded responses replayed in %.1f s' % (replayer.replayedCount, replayer.count, time.time() - t0)
+    return tc
+    
+
 # Loads the specified file, makes a copy, and appends the stop latitude/longitude info
 #   (Early database files were not saved with this information; this corrects the omission)
 def appendLatLonToDatabaseFile(filename, route):
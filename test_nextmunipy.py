@@ -0,0 +1,260 @@
+# Tests for nextmunipy.py (offline; nothing here contacts nextbus.com)
+
+import os
+import warnings
+import pytest
+from xml.dom import minidom
+import nextmunipy as nm
+
+
+# a small two-direction route, built without the routeConfig download
+def makeRoute(tag='T'):
+    route = nm.BusRoute()
+    route.routeTag = tag
+    route.routeName = 'T-Test; Line=1'
+    route.directionList = {'Inbound': 'Inbound to Downtown', 'Outbound': 'Outbound, to the Beach'}
+    route.directionTags = {'Inbound': tag + '_IB', 'Outbound': tag + '_OB'}
+    route.stopOrder = {'Inbound': ['1', '2', '3'], 'Outbound': ['3', '2']}
+    for (tag, name) in [('1', 'Mission St & 16th St'), ('2', 'Odd; Name=Stop'), ('3', '100% Corner, East')]:
+        s = nm.BusStop()
+        s.tag = tag
+        s.name = name
+        s.latitude = 37.76 + int(tag) * 1e-3
+        s.longitude = -122.42
+        s.stopID = 13000 + int(tag)
+        s.routes = [route.routeTag]
+        s.routeDirs = [route.routeTag + '_IB']
+        route.stops.append(s)
+    route.buildStopIndex()
+    return route
+
+@pytest.fixture
+def cacheDirectory(tmpdir, monkeypatch):
+    monkeypatch.setattr(nm, 'ROUTE_CACHE_DIRECTORY', str(tmpdir))
+    return str(tmpdir)
+
+
+#
+# ROUTE CONFIG
+
+ROUTE_CONFIG = '''<body><route tag="T" title="T-Test">
+<stop tag="1" title="Stop 1" lat="37.761" lon="-122.42" stopId="13001"/>
+<stop tag="2" title="Stop 2" lat="37.762" lon="-122.42" stopId="13002"/>
+<stop tag="9" title="Stop 9" lat="37.769" lon="-122.42" stopId="13009"/>
+<stop tag="3" title="Stop 3" lat="37.763" lon="-122.42" stopId="13003"/>
+<direction tag="T_IB" title="Inbound to Downtown" name="Inbound"><stop tag="1"/><stop tag="2"/><stop tag="3"/></direction>
+<direction tag="T_OB" title="Outbound to the Beach" name="Outbound"><stop tag="3"/><stop tag="2"/></direction>
+</route></body>'''
+
+@pytest.mark.filterwarnings('ignore')
+def test_downloadRouteInfo_indexesOrderedStops():
+    route = nm.BusRoute()
+    route.downloadRouteInfo(minidom.parseString(ROUTE_CONFIG))
+    assert [s.tag for s in route.stops] == ['1', '2', '3', '3', '2']
+    assert route.stopWithTag('9') is None		# (on no direction, so not kept)
+    assert all([route.stopWithTag(s.tag) in route.stops for s in route.stops])
+    assert route.stopPosition('2', 'Outbound') == 1
+
+
+#
+# ROUTE CACHE
+
+def test_databaseLine_roundTrip_escapesSeparators():
+    stop = makeRoute().stopWithTag('2')
+    copy = nm.BusStop()
+    copy.setFromDatabaseLine(stop.databaseLine())
+    assert copy.identity() == stop.identity()
+    assert copy.routes == stop.routes and copy.routeDirs == stop.routeDirs
+
+def test_setFromDatabaseLine_raisesValueError():
+    with pytest.raises(ValueError):
+        nm.BusStop().setFromDatabaseLine('12; stopTag=12; name=A=B; lat=37.7\n')
+
+def test_routeCache_roundTrip(cacheDirectory):
+    route = makeRoute()
+    route.saveToFile()
+
+    loaded = nm.BusRoute()
+    assert loaded.loadFromFile('T')
+    assert loaded.routeName == route.routeName
+    assert loaded.directionList == route.directionList
+    assert loaded.stopOrder == route.stopOrder
+    assert [s.identity() for s in loaded.stops] == [s.identity() for s in route.stops]
+    assert loaded.stopPosition('2', 'Outbound') == 1
+
+@pytest.mark.parametrize('damage', ['Odd=Stop; Name', 'lat='])
+def test_routeCache_ignoresDamagedFile(cacheDirectory, damage):
+    filename = makeRoute().saveToFile()
+    text = open(filename).read()
+
+    # a stop line with an unescaped separator, or one that was cut short
+    lines = text.splitlines(True)
+    if damage == 'lat=': lines[-1] = lines[-1].split(damage)[0] + '\n'
+    else: lines[-2] = lines[-2].replace('Odd%3B Name%3DStop', damage)
+    open(filename, 'w').write(''.join(lines))
+
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter('always')
+        assert not nm.BusRoute().loadFromFile('T')
+    assert 'will be replaced' in str(w[-1].message)
+
+def test_routeCache_rejectsOtherVersions(cacheDirectory, monkeypatch):
+    makeRoute().saveToFile()
+    monkeypatch.setattr(nm, 'ROUTE_CACHE_VERSION', nm.ROUTE_CACHE_VERSION + 1)
+    assert not nm.BusRoute().loadFromFile('T')
+
+
+#
+# STOP DATABASE
+
+def test_stopDatabase_reloadsModifiedFile(tmpdir, monkeypatch):
+    monkeypatch.setattr(nm, 'sharedStopDatabase', None)
+    route = makeRoute()
+    filename = str(tmpdir.join('stops.dat'))
+    open(filename, 'w').write('# stops\n' + route.stops[0].databaseLine())
+
+    database = nm.getStopDatabase(filename)
+    assert '1' in database and '2' not in database
+
+    open(filename, 'a').write(route.stops[1].databaseLine())
+    os.utime(filename, (database.mtime + 10, database.mtime + 10))
+    assert nm.getStopDatabase(filename) is database
+    assert '2' in database
+    stop = nm.BusStop()
+    stop.setFromDatabaseLine(database.lineWithTag('2'))
+    assert stop.name == 'Odd; Name=Stop'
+
+
+#
+# PREDICTION BLOCK CACHE
+
+# a predictionsForMultiStops response, from (stopTag, minutes) pairs
+def makeResponse(stops):
+    blocks = ['<predictions agencyTitle="San Francisco Muni" routeTag="12" stopTag="%s">'
+              '<direction title="Inbound"><prediction minutes="%i" vehicle="8001" dirTag="12_IB"/></direction>'
+              '</predictions>' % (tag, minutes) for (tag, minutes) in stops]
+    return '<?xml version="1.0" encoding="utf-8" ?>\n<body copyright="All data copyright">\n' + '\n'.join(blocks) + '\n</body>'
+
+def filterPoll(cache, response):
+    cache.beginPoll()
+    (data, digests) = cache.filterResponse(response)
+    cache.update(digests)
+    return data
+
+def test_predictionBlockCache_dropsUnchangedBlocks():
+    cache = nm.PredictionBlockCache()
+    first = makeResponse([('4001', 3), ('4002', 7)])
+    assert filterPoll(cache, first).count('<predictions ') == 2
+    assert not cache.isUnchanged('12', '4001')
+    
+    data = filterPoll(cache, makeResponse([('4001', 3), ('4002', 6)]))
+    assert data.count('<predictions ') == 1 and 'stopTag="4002"' in data and data.endswith('</body>')
+    assert cache.isUnchanged('12_IB', '4001') and not cache.isUnchanged('12', '4002')
+    assert (cache.pollSkippedCount, cache.skippedCount, cache.blockCount) == (1, 1, 4)
+    
+    # (after clear, every block is parsed again)
+    cache.clear()
+    assert filterPoll(cache, first).count('<predictions ') == 2
+    assert cache.unchangedStops == set()
+    
+def test_predictionBlockCache_passesErrorsThrough():
+    cache = nm.PredictionBlockCache()
+    error = '<body><Error shouldRetry="false">Route r is not valid</Error></body>'
+    assert cache.filterResponse(error) == (error, {})
+
+
+#
+# REQUEST BUDGET
+
+def test_requestBudget_interruptedWaitLeavesTheLine(monkeypatch):
+    budget = nm.RequestBudget(requestBurst=1, requestPeriod=3600, byteBudget=1e6, bytePeriod=1)
+    budget.acquire()
+    
+    def interrupt(timeout=None): raise KeyboardInterrupt
+    monkeypatch.setattr(budget.condition, 'wait', interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        budget.acquire(priority=1.0)
+    assert budget.waiting == []
+    
+    # (a later request is not held up behind the interrupted one)
+    monkeypatch.undo()
+    budget.requestTokens = 1.0
+    budget.acquire(priority=5.0)
+    assert budget.requestCount == 2 and budget.waiting == []
+    
+def test_requestBudget_followsSimulatedClock(monkeypatch):
+    clock = nm.SimulatedClock(1000.0)
+    monkeypatch.setattr(nm, 'clock', clock)
+    budget = nm.RequestBudget(requestBurst=2, requestPeriod=60, byteBudget=1e6, bytePeriod=1)
+    budget.acquire(); budget.acquire()
+    assert clock.time() == 1000.0
+    assert budget.acquire() == pytest.approx(30.0)		# (the clock is moved to the next token)
+    assert clock.time() == pytest.approx(1030.0)
+    
+    budget.ensureBurst(4)
+    assert budget.requestBurst == 4 and budget.requestRate == pytest.approx(4 / 60.0)
+    budget.ensureBurst(3)
+    assert budget.requestBurst == 4
+
+
+#
+# RETRIES
+
+@pytest.mark.filterwarnings('ignore')
+def test_callWithRetries(monkeypatch):
+    clock = nm.SimulatedClock()
+    monkeypatch.setattr(nm, 'clock', clock)
+    failures = [IOError('reset'), nm.NextBusError('busy', shouldRetry=True)]
+    def request():
+        if failures: raise failures.pop(0)
+        return 'response'
+    assert nm.callWithRetries(request) == 'response'
+    assert nm.RETRY_BACKOFF * 3 <= clock.time() <= nm.RETRY_BACKOFF * 6		# (two backed-off retries)
+    
+    # (errors that will not go away are raised at once, and the retries are limited)
+    def invalid(): raise nm.NextBusError('Route r is not valid')
+    with pytest.raises(nm.NextBusError):
+        nm.callWithRetries(invalid)
+    calls = []
+    def down(): calls.append(1); raise IOError('down')
+    with pytest.raises(IOError):
+        nm.callWithRetries(down)
+    assert len(calls) == nm.REQUEST_RETRIES + 1
+
+
+#
+# RECORDING AND REPLAY
+
+@pytest.fixture
+def responseLog(tmpdir):
+    filename = str(tmpdir.join('responses.log.gz'))
+    recorder = nm.ResponseRecorder(filename)
+    for (t, cmdStr, data) in [(100.0, 'a', '<a1/>'), (110.0, 'b', '<b1/>'), (120.0, 'b', '<b2/>\n'), (130.0, 'a', '<a2/>')]:
+        recorder.record(t, cmdStr, data)
+    recorder.close()
+    return filename
+
+def test_responseReplayer_readsLogAsRequested(responseLog):
+    clock = nm.SimulatedClock()
+    replayer = nm.ResponseReplayer(responseLog, clock)
+    assert (replayer.startTime, replayer.endTime, replayer.count) == (100.0, 130.0, 4)
+    assert replayer.pending == {}
+    
+    assert replayer.open('b').read() == '<b1/>'
+    assert clock.time() == 110.0 and replayer.pending == {'a': [(100.0, '<a1/>')]}	# (read past on the way)
+    assert replayer.open('a').read() == '<a1/>'
+    assert replayer.open('a').read() == '<a2/>'
+    assert replayer.pending == {'b': [(120.0, '<b2/>\n')]} and clock.time() == 130.0
+    assert replayer.open('b').read() == '<b2/>\n'
+    with pytest.raises(nm.ReplayFinished):
+        replayer.open('a')
+    assert replayer.replayedCount == 4
+    replayer.close()
+    
+def test_replay_restoresSettings(responseLog, monkeypatch):
+    monkeypatch.setattr(nm, 'USE_REQUEST_BUDGET', False)
+    replayer = nm.startReplay(responseLog)
+    assert nm.clockTime() == 100.0 and nm.openCommand('a').read() == '<a1/>'
+    nm.stopReplay()
+    assert nm.USE_REQUEST_BUDGET == False and nm.responseReplayer is None
+    assert not isinstance(nm.clock, nm.SimulatedClock)
@@ -0,0 +1,117 @@
+# Tests for nmarchive.py
+
+import os
+from datetime import datetime, timedelta
+import numpy
+import pytest
+import nmarchive
+import nmdata
+
+
+# database rows (in nextmunipy.DatabaseParser.order), as a TrackerController archives them
+def makeRows(count=3):
+    t0 = datetime(2012, 5, 15, 14, 33, 41)
+    rows = []
+    for i in range(count):
+        t = t0 + timedelta(minutes=i)
+        rows.append(('12', str(4001 + i), str(8001 + i), '12_IB', t0, t + timedelta(minutes=5), t,
+                     5 + i, 5.5 - i, 0, 37.76 if i % 2 else numpy.nan, -122.41 if i % 2 else numpy.nan))
+    return rows
+
+def assertRowsLoaded(columns, rows):
+    assert len(columns[0]) == len(rows)
+    for (i, col) in enumerate(columns):
+        values = [r[i] for r in rows]
+        if i in [4, 5, 6]: values = numpy.array(values, dtype='datetime64[s]')
+        elif i in [2]: values = [int(v) for v in values]
+        if numpy.asarray(col).dtype.kind == 'f':
+            numpy.testing.assert_allclose(col, values, rtol=1e-6)
+        else:
+            assert list(col) == list(values)
+
+
+#
+# WRITERS
+
+def test_textArchiveWriter_buffersRows(tmpdir):
+    filename = str(tmpdir.join('db.dat'))
+    writer = nmarchive.TextArchiveWriter(filename, header='# header\n', flushCount=3, flushInterval=1e6)
+    rows = makeRows(4)
+    writer.write(rows[:2])
+    assert writer.recordCount == 0 and open(filename).read() == '# header\n'
+    writer.write(rows[2:3])
+    assert writer.recordCount == 3
+    writer.write(rows[3:])
+    writer.close()
+    assert writer.recordCount == 4
+    assertRowsLoaded(nmdata.loadTextData(filename), rows)
+
+def test_textArchiveWriter_appends(tmpdir):
+    filename = str(tmpdir.join('db.dat'))
+    rows = makeRows(4)
+    for (header, part) in [('# header\n', rows[:2]), (None, rows[2:])]:
+        writer = nmarchive.TextArchiveWriter(filename, header=header)
+        writer.write(part)
+        writer.close()
+    assertRowsLoaded(nmdata.loadTextData(filename), rows)
+
+def test_binaryArchiveWriter_roundTrip(tmpdir):
+    filename = str(tmpdir.join('db.dat'))
+    rows = makeRows(5)
+    writer = nmarchive.BinaryArchiveWriter(filename, overwrite=True, flushCount=2)
+    writer.write(rows[:3])
+    writer.close()
+
+    # (an existing archive is appended to, and its tags keep their ids)
+    writer = nmarchive.BinaryArchiveWriter(filename)
+    writer.write(rows[3:])
+    writer.close()
+    (records, table) = nmarchive.openArchive(filename)
+    assert len(records) == 5 and len(table) == 1 + 5 + 1
+    assertRowsLoaded(nmdata.loadArchive(writer.filename), rows)
+
+def test_openArchive_ignoresPartialRecord(tmpdir):
+    filename = str(tmpdir.join('db.nma'))
+    nmarchive.writeArchive(filename, zip(*makeRows(2)))
+    open(filename, 'ab').write('\1' * (nmarchive.ARCHIVE_DTYPE.itemsize // 2))
+    assertRowsLoaded(nmdata.loadArchive(filename), makeRows(2))
+
+def test_openArchive_checksHeader(tmpdir):
+    filename = str(tmpdir.join('db.nma'))
+    open(filename, 'wb').write('not an archive')
+    with pytest.raises(IOError):
+        nmarchive.openArchive(filename)
+    with pytest.raises(IOError):
+        nmarchive.BinaryArchiveWriter(filename)
+
+def test_positionArchiveWriter_roundTrip(tmpdir):
+    t = datetime(2012, 5, 15, 14, 33, 41)
+    rows = [('12', '8001', '12_IB', t, 37.76, -122.41, 90, 4.5), ('14', 'x', '', t, 37.77, -122.42, -1, 0.0)]
+    writer = nmarchive.PositionArchiveWriter(str(tmpdir.join('pos')), overwrite=True)
+    writer.write(rows)
+    writer.close()
+    (records, table) = nmarchive.openPositionArchive(writer.filename)
+    assert list(table.tagsWithIds(records['routeTag'])) == ['12', '14']
+    assert list(records['vehicle']) == [8001, nmarchive.MISSING_VEHICLE]
+    assert list(nmarchive.timesFromSeconds(records['reportTime'])) == [numpy.datetime64(t, 's')] * 2
+    assert list(records['heading']) == [90, -1]
+
+def test_backgroundArchiveWriter_writesEverythingOnClose(tmpdir):
+    filename = str(tmpdir.join('db.dat'))
+    shown = []
+    writers = [nmarchive.TextArchiveWriter(filename, header='# header\n'), nmarchive.BinaryArchiveWriter(filename, overwrite=True)]
+    background = nmarchive.BackgroundArchiveWriter(writers, onWrite=lambda rows, message: shown.append((len(rows), message)))
+    rows = makeRows(6)
+    for r in rows: background.write([r])
+    background.write([], 'done')
+    background.close()
+    assert shown == [(1, None)] * 6 + [(0, 'done')] and background.errorCount == 0
+    assertRowsLoaded(nmdata.loadTextData(filename), rows)
+    assertRowsLoaded(nmdata.loadArchive(filename), rows)
+
+def test_backgroundArchiveWriter_refusesRowsAfterClose(tmpdir):
+    writer = nmarchive.TextArchiveWriter(str(tmpdir.join('db.dat')), header='# header\n')
+    background = nmarchive.BackgroundArchiveWriter([writer])
+    background.close()
+    with pytest.raises(ValueError):
+        background.write(makeRows(1))
@@ -0,0 +1,175 @@
+# Tests for nmdata.py
+
+import os
+import numpy
+import pytest
+import nmdata
+import nmarchive
+
+
+# the columns of a small database (in nmdata.COLUMNS order)
+def makeData():
+    times = ['2012-05-15 14:33:41', '2012-05-15 14:35:00', '2012-05-16 08:00:30']
+    return (['12', '12', '14'], ['4001', '4002', '4001'], [8001, 8002, 8001], ['12_IB', '12_IB', '14_OB'],
+            times, times, times, [5.0, 3.0, 5.0], [7.5, 2.0, 4.0], [0, 0, 0],
+            [37.76, 37.77, numpy.nan], [-122.41, -122.42, numpy.nan])
+
+
+#
+# PREDDATA
+
+def test_predData_columns():
+    pd = nmdata.PredData(makeData())
+    assert pd.count == 3
+    assert list(pd.stops()) == ['4001', '4002', '4001']
+    assert list(pd.delays()) == [2.5, -1.0, -1.0]
+    assert pd.currentTimes().dtype == numpy.dtype('datetime64[s]')
+
+def test_dataForVarEqualTo_columns():
+    pd = nmdata.PredData(makeData())
+    assert list(pd.dataForVarEqualTo('waits', 'stops', '4001')) == [7.5, 4.0]
+    assert list(pd.dataForVarEqualTo('routes', 'predictions', 3.0)) == ['12']
+    assert list(pd.dataForVarEqualTo('waits', 'stops', 'missing')) == []
+
+def test_dataForVarEqualTo_derivedValues():
+    pd = nmdata.PredData(makeData())
+    assert list(pd.dataForVarEqualTo('delays', 'predictions', 5)) == [2.5, -1.0]
+    assert list(pd.dataForVarEqualTo('stops', 'delays', -1.0)) == ['4002', '4001']
+
+def test_getDict_includesDelays():
+    d = nmdata.PredData(makeData()).getDict()
+    assert sorted(d.keys()) == sorted(nmdata.COLUMNS + ['delays'])
+    assert list(d['delays']) == [2.5, -1.0, -1.0]
+
+
+#
+# LOADING TEXT DATABASE FILES
+
+# the text of a database file: a header, lines as the TrackerController writes them (with NaN lat/lon,
+#    negative waits, and a missing end time), and lines of older files (10 fields, fractional seconds)
+DATABASE_TEXT = '''# Prediction data for Route 12
+# routeTag | stopTag | vehicle | directionTag | startTime | endTime | currentTime | predictedWait | actualWait | uncertainty | latitude | longitude
+12; 4001; 8001; 12_IB; 2012-05-15 14:33:41; 2012-05-15 14:40:00; 2012-05-15 14:34:00; 5; 6.000000; 0; 37.760000; -122.410000; 
+12; 4002; 8002; 12_IB; 2012-05-15 14:33:41; None; 2012-05-15 14:35:00; 3; -1.250000; 0; nan; nan; 
+
+12; 4003; 8003; 12_OB; 2012-05-15 14:33:41.500; 2012-05-15 14:50:00; 2012-05-15 14:36:00.250; 12; 14.5; 1
+12;4004;8004;12_OB;2012-05-15 14:33:41;2012-05-15 14:51:00;2012-05-15 14:37:00;7;8;0;
+'''
+
+# the columns DATABASE_TEXT should load as (in nextmunipy.DatabaseParser.order)
+EXPECTED_COLUMNS = (['12', '12', '12', '12'], ['4001', '4002', '4003', '4004'], [8001, 8002, 8003, 8004],
+                    ['12_IB', '12_IB', '12_OB', '12_OB'],
+                    ['2012-05-15T14:33:41'] * 4, ['2012-05-15T14:40:00', 'NaT', '2012-05-15T14:50:00', '2012-05-15T14:51:00'],
+                    ['2012-05-15T14:34:00', '2012-05-15T14:35:00', '2012-05-15T14:36:00', '2012-05-15T14:37:00'],
+                    [5.0, 3.0, 12.0, 7.0], [6.0, -1.25, 14.5, 8.0], [0, 0, 1, 0],
+                    [37.76, numpy.nan, numpy.nan, numpy.nan], [-122.41, numpy.nan, numpy.nan, numpy.nan])
+
+def assertColumnsEqual(columns, expected):
+    assert len(columns) == len(expected)
+    for (name, col, values) in zip(nmdata.COLUMNS, columns, expected):
+        col = numpy.asarray(col)
+        if name in nmdata.TIME_COLUMNS:
+            numpy.testing.assert_array_equal(col, numpy.array(values, dtype='datetime64[s]'), err_msg=name)
+        elif col.dtype.kind == 'f':
+            numpy.testing.assert_allclose(col, values, rtol=0, atol=1e-5, err_msg=name)
+        else:
+            assert list(col) == list(values), name
+            
+@pytest.fixture
+def databaseFile(tmpdir):
+    filename = str(tmpdir.join('PredictionDatabaseRte12_20120515_143341.dat'))
+    open(filename, 'w').write(DATABASE_TEXT)
+    return filename
+
+def test_loadTextData(databaseFile):
+    assertColumnsEqual(nmdata.loadTextData(databaseFile), EXPECTED_COLUMNS)
+
+def test_loadTextData_inChunks(databaseFile, monkeypatch):
+    monkeypatch.setattr(nmdata, 'LOAD_CHUNK_SIZE', 50)		# (chunks end in the middle of lines)
+    assertColumnsEqual(nmdata.loadTextData(databaseFile), EXPECTED_COLUMNS)
+
+def test_loadTextData_skipsShortLines(tmpdir):
+    filename = str(tmpdir.join('short.dat'))
+    open(filename, 'w').write(DATABASE_TEXT + '12; 4005; 8005; 12_IB; \n')
+    assertColumnsEqual(nmdata.loadTextData(filename), EXPECTED_COLUMNS)
+
+def test_loadTextData_emptyFile(tmpdir):
+    filename = str(tmpdir.join('empty.dat'))
+    open(filename, 'w').write('# nothing recorded\n')
+    columns = nmdata.loadTextData(filename)
+    assert len(columns) == len(nmdata.COLUMNS)
+    assert all([len(col) == 0 for col in columns])
+
+def test_loadTextData_matchesRowByRowParsing(databaseFile):
+    # the fields of each line, converted one at a time as the original loader did
+    parser = nmdata.nm.DatabaseParser()
+    expected = [[] for name in nmdata.COLUMNS]
+    for txt in DATABASE_TEXT.splitlines():
+        if not txt.strip() or txt[0] == '#': continue
+        data = [f.strip() for f in txt.split(nmdata.sep)]
+        if not data[-1]: data.pop()
+        data += ['nan'] * (len(nmdata.COLUMNS) - len(data))
+        for (i, name) in enumerate(parser.order):
+            if name in ['vehicle', 'uncertainty']: expected[i].append(int(data[i]))
+            elif name in ['predictedWait', 'actualWait', 'latitude', 'longitude']: expected[i].append(float(data[i]))
+            elif i in [parser.startTimeIndex(), parser.endTimeIndex(), parser.currentTimeIndex()]:
+                expected[i].append('NaT' if data[i] == 'None' else data[i][:19])
+            else: expected[i].append(data[i])
+    assertColumnsEqual(nmdata.loadTextData(databaseFile), expected)
+
+def test_parseDataBuffer_numbers():
+    # (plain decimals are converted digit by digit, anything else by numpy; lines may end in \r\n)
+    values = ['-0.25', '.5', '007', '1e3', '-1.5E-2', '123456789012.125', 'NaN', 'inf', '  42  ']
+    text = ''.join(['12; 4001; 8001; 12_IB; 2012-05-15 14:33:41; None; 2012-05-15 14:34:00; 5; %s; 0; 37.76; nan; \r\n' % v
+                    for v in values])
+    numpy.testing.assert_array_equal(nmdata.parseDataBuffer(text)[8], [float(v) for v in values])
+    
+def test_parseDataBuffer_vehicleTags():
+    text = DATABASE_TEXT.replace('8002', 'x8002').replace('8003', ' ')
+    assert list(nmdata.parseDataBuffer(text)[2]) == [8001, nmarchive.MISSING_VEHICLE, nmarchive.MISSING_VEHICLE, 8004]
+    
+
+#
+# BINARY ARCHIVES
+
+def test_convertToArchive_roundTrip(databaseFile):
+    archiveFilename = nmdata.convertToArchive(databaseFile)
+    assert archiveFilename.endswith(nmarchive.ARCHIVE_FILE_EXT)
+    assertColumnsEqual(nmdata.loadArchive(archiveFilename), EXPECTED_COLUMNS)
+
+def test_loadData_prefersArchive(databaseFile, monkeypatch):
+    nmdata.convertToArchive(databaseFile)
+    open(databaseFile, 'a').write('# (a line only the text file has)\n12; 4009; 8009; 12_IB; 2012-05-15 14:33:41; None; None; 5; 6; 0; \n')
+    monkeypatch.setattr(nmdata, 'USE_BINARY_ARCHIVE', True)
+    assert len(nmdata.loadData(databaseFile)[0]) == 4
+    monkeypatch.setattr(nmdata, 'USE_BINARY_ARCHIVE', False)
+    assert len(nmdata.loadData(databaseFile)[0]) == 5
+
+@pytest.fixture
+def databaseFolder(tmpdir, monkeypatch):
+    monkeypatch.setattr(nmdata, 'filenameBase', str(tmpdir.join('PredictionDatabaseRte')))
+    return tmpdir
+
+def test_findDatabaseFiles(databaseFolder, monkeypatch):
+    older = str(databaseFolder.join('PredictionDatabaseRte12_20120514_090000.dat'))		# (text only)
+    both = str(databaseFolder.join('PredictionDatabaseRte12_20120515_143341.dat'))
+    newest = str(databaseFolder.join('PredictionDatabaseRte12_20120516_080000.dat'))	# (binary only)
+    for fn in [older, both, newest]: open(fn, 'w').write(DATABASE_TEXT)
+    for fn in [both, newest]: nmdata.convertToArchive(fn)
+    os.remove(newest)
+    open(str(databaseFolder.join('PredictionDatabaseRte14_20120517_080000.dat')), 'w').write(DATABASE_TEXT)
+    
+    archive = lambda fn: nmarchive.archiveFilenames(fn)[0]
+    monkeypatch.setattr(nmdata, 'USE_BINARY_ARCHIVE', True)
+    assert nmdata.findDatabaseFiles('12') == ([older, archive(both), archive(newest)], archive(newest))
+    monkeypatch.setattr(nmdata, 'USE_BINARY_ARCHIVE', False)
+    assert nmdata.findDatabaseFiles('12') == ([older, both, archive(newest)], archive(newest))
+    assert nmdata.findDatabaseFiles('7') == ([], None)
+
+def test_predData_loadsBinaryOnlyRuns(databaseFolder):
+    filename = str(databaseFolder.join('PredictionDatabaseRte12_20120515_143341.dat'))
+    nmarchive.writeArchive(filename, nmdata.parseDataBuffer(DATABASE_TEXT))		# (as with ARCHIVE_FORMAT = 'binary')
+    assertColumnsEqual(nmdata.loadData('12'), EXPECTED_COLUMNS)
+    assert nmdata.PredData('12').count == 4
+    with pytest.raises(IOError):
+        nmdata.loadData('7')
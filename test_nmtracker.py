@@ -0,0 +1,357 @@
+# Tests for nmtracker.py (offline; predictions are built here instead of being requested)
+
+from datetime import datetime, timedelta
+import pytest
+import nextmunipy as nm
+import nmtracker
+import nmdata
+
+
+T0 = datetime(2012, 5, 15, 14, 0, 0)
+
+# a Prediction of a poll at time t
+def makePrediction(stopTag, vehicle, minutes, t=T0, dirTag='T_IB', tripTag=None):
+    attrs = {'minutes': str(minutes), 'seconds': str(minutes * 60), 'vehicle': vehicle, 'dirTag': dirTag}
+    if tripTag: attrs['tripTag'] = tripTag
+    p = nm.Prediction(attrs, t)
+    p.stopTag = stopTag
+    p.currentTime = t
+    return p
+
+# the predictions of a poll, as a dictionary with stop tags as keys, from (stopTag, vehicle, minutes) tuples
+def makePoll(stopTags, entries, t=T0):
+    predictions = dict([(tag, []) for tag in stopTags])
+    for (stopTag, vehicle, minutes) in entries:
+        predictions[stopTag].append(makePrediction(stopTag, vehicle, minutes, t))
+    return predictions
+
+
+#
+# POLL SNAPSHOTS
+
+def test_pollSnapshot_keepsSoonestPrediction():
+    snapshot = nmtracker.pollSnapshot(makePoll(['1', '2'], [('1', 'a', 3), ('1', 'a', 15), ('1', 'b', 7)]))
+    assert sorted(snapshot.keys()) == ['1', '2']
+    assert snapshot['1']['a'].getMinutes() == 3
+    assert snapshot['2'] == {}
+
+def test_pollDiff():
+    previous = nmtracker.pollSnapshot(makePoll(['1', '2', '3', '4'], [('1', 'a', 3), ('1', 'b', 9), ('2', 'a', 5), ('4', 'c', 1)]))
+    current = nmtracker.pollSnapshot(makePoll(['1', '2', '3'], [('1', 'b', 8), ('1', 'c', 12), ('3', 'd', 4)]))
+    diff = nmtracker.PollDiff(previous, current)
+    assert sorted(diff.appeared) == [('1', 'c'), ('3', 'd')]
+    assert sorted(diff.updated) == [('1', 'b')]
+    assert sorted(diff.disappeared) == [('1', 'a'), ('2', 'a')]		# (stop 4 was not polled)
+    assert len(diff) == 4
+
+def test_pollDiff_firstPoll():
+    current = nmtracker.pollSnapshot(makePoll(['1', '2'], [('1', 'a', 3), ('2', 'a', 5)]))
+    diff = nmtracker.PollDiff({}, current)
+    assert sorted(diff.appeared) == [('1', 'a'), ('2', 'a')]
+    assert diff.updated == [] and diff.disappeared == []
+
+
+#
+# POLL PLANNING
+
+def test_stopPollPlanner_pollInterval():
+    planner = nmtracker.StopPollPlanner([])
+    (hot, cold) = (nmtracker.HOT_POLL_INTERVAL, nmtracker.COLD_POLL_INTERVAL)
+    assert planner.pollInterval(None) == cold
+    assert planner.pollInterval(0) == hot and planner.pollInterval(nmtracker.HOT_STOP_MINUTES) == hot
+    assert planner.pollInterval(nmtracker.HOT_STOP_MINUTES + 0.5) == hot		# (never more often than hot stops)
+    assert planner.pollInterval(nmtracker.HOT_STOP_MINUTES + 2) == 60.0
+    assert planner.pollInterval(60) == cold
+    
+def test_stopPollPlanner_schedulesStopsBySoonestPrediction():
+    planner = nmtracker.StopPollPlanner(['1', '2', '3', '4'])
+    now = 1000.0
+    assert planner.dueStops(now) == set(['1', '2', '3', '4'])		# (every stop is polled first)
+    
+    planner.schedule(makePoll(['1', '2', '3', '4'], [('1', 'a', 2), ('2', 'b', 5), ('2', 'c', 30), ('3', 'd', 40)]), now=now)
+    assert planner.intervals == {'1': 20.0, '2': 60.0, '3': 180.0, '4': 180.0}
+    assert planner.dueStops(now + 10) == set(['1'])			# (due within half a hot interval)
+    assert planner.dueStops(now + 60) == set(['1', '2'])
+    assert planner.hotCount(now) == 1
+    
+    # stops that were polled again without changing keep their interval
+    planner.schedule(makePoll(['1'], [('1', 'a', 1)]), unchangedTags=['2'], now=now + 60)
+    assert planner.nextPollTimes['1'] == now + 80 and planner.nextPollTimes['2'] == now + 120
+    assert planner.nextPollTimes['3'] == now + 180
+
+
+#
+# OUTAGES
+
+@pytest.mark.filterwarnings('ignore')
+def test_circuitBreaker_suspendsRequestsAfterFailures():
+    breaker = nmtracker.CircuitBreaker('route T', failureThreshold=2, cooldown=60)
+    breaker.recordFailure(now=0)
+    assert breaker.allowRequest(now=0)
+    breaker.recordFailure(now=10)
+    assert not breaker.allowRequest(now=10) and not breaker.allowRequest(now=69.9)
+    assert breaker.allowRequest(now=70)			# (a trial request after the cooldown)
+    
+    # a failed trial suspends the requests again; a successful one closes the breaker
+    breaker.recordFailure(now=70)
+    assert breaker.isOpen(now=100) and breaker.tripCount == 2
+    breaker.recordSuccess()
+    assert breaker.allowRequest(now=100) and breaker.failureCount == 0
+    
+
+
+#
+# TRACKING
+
+# a route 'T' with stops 1-5 inbound (and 5-1 outbound), saved to the route cache so that
+#    TrackerController('T') does not download it
+@pytest.fixture
+def testRoute(tmpdir, monkeypatch):
+    monkeypatch.setattr(nm, 'ROUTE_CACHE_DIRECTORY', str(tmpdir))
+    monkeypatch.setattr(nmtracker, 'DATABASE_FILENAME_BASE', str(tmpdir.join('PredictionDatabaseRte')))
+    monkeypatch.setattr(nmtracker, 'ARCHIVE_IN_BACKGROUND', False)
+    monkeypatch.setattr(nmtracker, 'VERBOSE', False)
+    
+    route = nm.BusRoute()
+    route.routeTag = 'T'
+    route.routeName = 'T-Test'
+    route.directionList = {'Inbound': 'Inbound', 'Outbound': 'Outbound'}
+    route.directionTags = {'Inbound': 'T_IB', 'Outbound': 'T_OB'}
+    tags = ['1', '2', '3', '4', '5']
+    route.stopOrder = {'Inbound': tags, 'Outbound': tags[::-1]}
+    for tag in tags:
+        s = nm.BusStop()
+        (s.tag, s.name, s.latitude, s.longitude, s.stopID) = (tag, 'Stop ' + tag, 37.76 + int(tag) * 1e-3, -122.42, 13000 + int(tag))
+        s.routes = ['T']
+        s.routeDirs = ['T_IB', 'T_OB']
+        route.stops.append(s)
+    route.saveToFile()
+    return route
+    
+@pytest.fixture
+def tracker(testRoute):
+    tc = nmtracker.TrackerController('T')
+    tc.beginRun(T0)
+    yield tc
+    tc.stop()
+
+# track a poll at T0 + minutes
+def trackPoll(tc, minutes, entries):
+    t = T0 + timedelta(minutes=minutes)
+    tc.trackUsingPredictions(makePoll(tc.stopController.tagsOfStops(tc.stops), entries, t), t)
+    
+# the (stopTag, vehicle, predicted wait, actual wait) of every row a tracker has archived
+def archivedRows(tc):
+    tc.textArchive.flush()
+    data = nmdata.loadTextData(tc.filename)
+    return sorted(zip(data[1], [str(v) for v in data[2]], data[7], data[8]))
+
+def test_track_arrival(tracker):
+    trackPoll(tracker, 0, [('2', '8001', 3)])
+    trackPoll(tracker, 1, [('2', '8001', 2)])
+    trackPoll(tracker, 3, [])
+    assert archivedRows(tracker) == [('2', '8001', 2, 2.0), ('2', '8001', 3, 3.0)]
+    assert len(tracker.activeTrips) == 0
+    
+def test_track_arrivalAfterPredictionReachedZero(tracker):
+    trackPoll(tracker, 0, [('2', '8001', 2)])
+    trackPoll(tracker, 2, [('2', '8001', 0)])
+    trackPoll(tracker, 4, [])
+    assert archivedRows(tracker) == [('2', '8001', 2, 3.0)]		# (arrived between the last two polls)
+
+def test_track_arrivalClosesUpstreamTrips(tracker):
+    trackPoll(tracker, 0, [('1', '8001', 1), ('2', '8001', 3), ('3', '8001', 6)])
+    trackPoll(tracker, 1, [('1', '8001', 0), ('2', '8001', 2), ('3', '8001', 5)])
+    trackPoll(tracker, 2, [('1', '8001', 0), ('3', '8001', 4)])		# (still predicted at 1, but arrived at 2)
+    trackPoll(tracker, 3, [('1', '8001', 0), ('3', '8001', 3)])		# (not followed at 1 again)
+    assert archivedRows(tracker) == [('1', '8001', 1, 1.5), ('2', '8001', 2, 1.0), ('2', '8001', 3, 2.0)]
+    assert [s for (s, t) in tracker.activeTrips.arrivalSequence(('8001', 'T_IB'))] == ['1', '2']
+    assert tracker.activeTrips.tripsAtStop('1') == {}
+    
+def test_track_unseenUpstreamArrivalIsDropped(tracker):
+    trackPoll(tracker, 0, [('1', '8001', 2), ('2', '8001', 4)])
+    trackPoll(tracker, 1, [('1', '8001', 1), ('2', '8001', 3)])
+    trackPoll(tracker, 2, [('1', '8001', 1)])		# (arrived at 2, so it passed 1 without being seen to)
+    assert archivedRows(tracker) == [('2', '8001', 3, 1.0), ('2', '8001', 4, 2.0)]
+    assert tracker.activeTrips.tripsAtStop('1') == {}
+
+def test_track_sameDisappearancesInOnePoll(tracker):
+    # the vehicle leaves the lists of stops 1 and 2 in the same poll, while stop 3 still predicts it
+    trackPoll(tracker, 0, [('1', '8001', 3), ('2', '8001', 4), ('3', '8001', 8)])
+    trackPoll(tracker, 1, [('1', '8001', 2), ('2', '8001', 3), ('3', '8001', 7)])
+    trackPoll(tracker, 2, [('3', '8001', 6)])
+    assert archivedRows(tracker) == [('1', '8001', 2, 1.0), ('1', '8001', 3, 2.0), ('2', '8001', 3, 1.0), ('2', '8001', 4, 2.0)]
+    assert [s for (s, t) in tracker.activeTrips.arrivalSequence(('8001', 'T_IB'))] == ['1', '2']
+    
+@pytest.mark.parametrize('stopTags', [['1', '2', '3', '4'], ['4', '3', '2', '1'], ['3', '1', '4', '2']])
+def test_track_sameDisappearancesInAnyOrder(tracker, monkeypatch, stopTags):
+    # (the stops of a poll are handled in whatever order its dictionary has)
+    PollDiff = nmtracker.PollDiff
+    class OrderedPollDiff(PollDiff):
+        def __init__(self, previous, current):
+            PollDiff.__init__(self, previous, current)
+            self.disappeared.sort(key=lambda (stopTag, v): stopTags.index(stopTag))
+    monkeypatch.setattr(nmtracker, 'PollDiff', OrderedPollDiff)
+    
+    trackPoll(tracker, 0, [('1', '8001', 3), ('2', '8001', 4), ('3', '8001', 5), ('4', '8001', 8)])
+    trackPoll(tracker, 1, [('1', '8001', 2), ('2', '8001', 3), ('3', '8001', 4), ('4', '8001', 7)])
+    trackPoll(tracker, 2, [('4', '8001', 6)])
+    assert [s for (s, v, p, w) in archivedRows(tracker)] == ['1', '1', '2', '2', '3', '3']
+
+def test_track_arrivalsAreShownByBackgroundWriter(testRoute, monkeypatch, capsys):
+    monkeypatch.setattr(nmtracker, 'ARCHIVE_IN_BACKGROUND', True)
+    monkeypatch.setattr(nmtracker, 'VERBOSE', True)
+    tc = nmtracker.TrackerController('T')
+    tc.beginRun(T0)
+    shown = []
+    tc.archiveWriters[0].onWrite = lambda rows, message: shown.append((len(rows), message))
+    capsys.readouterr()
+    
+    trackPoll(tc, 0, [('2', '8001', 3), ('3', '8002', 20)])
+    trackPoll(tc, 1, [('2', '8001', 2), ('3', '8002', 19)])
+    trackPoll(tc, 3, [('3', '8002', 17)])
+    trackPoll(tc, 10, [])		# (after an outage, so 8002's arrival is not saved)
+    assert '***' not in capsys.readouterr()[0]
+    tc.stop()
+    assert [n for (n, message) in shown] == [2, 0]
+    assert 'Vehicle 8001 arrived at stop 2' in shown[0][1] and 'during an outage' in shown[1][1]
+
+def test_activePredictionStore_tripsWithoutTripTagAreKeyedByDirection():
+    store = nmtracker.ActivePredictionStore()
+    trip = nmtracker.ActiveTrip(makePrediction('3', '8001', 1), 2)
+    store.add(trip)
+    store.arrive(trip, T0)
+    assert store.hasPassed(makePrediction('2', '8001', 5), 1)
+    assert not store.hasPassed(makePrediction('4', '8001', 5, dirTag='T_OB'), 1)		# (the trip back)
+    
+def test_activePredictionStore_prunesOldArrivalSequences():
+    store = nmtracker.ActivePredictionStore()
+    trip = nmtracker.ActiveTrip(makePrediction('3', '8001', 1), 2)
+    store.add(trip)
+    store.arrive(trip, T0)
+    currentKeys = set([trip.tripKey])		# (the vehicle is predicted again, for its next trip)
+    store.pruneTrips(currentKeys, T0 + timedelta(seconds=nmtracker.FINISHED_TRIP_AGE - 1))
+    assert store.hasPassed(makePrediction('2', '8001', 5), 1)
+    store.pruneTrips(currentKeys, T0 + timedelta(seconds=nmtracker.FINISHED_TRIP_AGE + 1))
+    assert not store.hasPassed(makePrediction('2', '8001', 5), 1)
+    assert list(store.finishedTrips) == [(('8001', 'T_IB'), [('3', T0)])]
+
+
+#
+# RUNS
+
+@pytest.fixture
+def simulatedClock(monkeypatch):
+    clock = nm.SimulatedClock(1337000000.0)
+    monkeypatch.setattr(nm, 'clock', clock)
+    return clock
+
+def test_vehicleTracker_runsForTimeToRun(tmpdir, monkeypatch, simulatedClock):
+    monkeypatch.setattr(nmtracker, 'POSITION_FILENAME_BASE', str(tmpdir.join('VehiclePositionsRte')))
+    requests = []
+    def getVehicleLocations(routeTag, lastTime=0):
+        requests.append((routeTag, nm.clockTime()))
+        return ([], lastTime + 1)
+    monkeypatch.setattr(nm, 'getVehicleLocations', getVehicleLocations)
+    
+    vt = nmtracker.VehicleTracker(['T', 'U'])
+    vt.timeToRun = 60
+    vt.start()
+    t0 = 1337000000.0
+    assert requests[:4] == [('T', t0), ('U', t0), ('T', t0 + 15), ('U', t0 + 15)]
+    assert vt.count == 6 and vt.isStopped		# (the last iteration starts once timeToRun has passed)
+    assert vt.lastTimes == {'T': 6, 'U': 6}
+
+# a TrackerController stand-in for TrackerScheduler.runBatch, which records the order its routes run in
+class FakeController:
+    def __init__(self, routeTag, priority, order):
+        self.route = nm.BusRoute()
+        self.route.routeTag = routeTag
+        self.stopController = type('FakeStopController', (), {'requestPriority': lambda sc: priority})()
+        self.breaker = nmtracker.CircuitBreaker(routeTag)
+        self.order = order
+        self.defaultWaitTime = 60
+        self.stops = [None] * 100
+        self.useVehicleLocations = False
+        self.isStopped = False
+        
+    def beginRun(self): pass
+    def isFinished(self, currentTime): return False
+    def updateLocationsIfDue(self): pass
+    def stop(self): self.isStopped = True
+        
+    def runIteration(self):
+        self.order.append(self.route.routeTag)
+        
+def test_trackerScheduler_pollsSoonestArrivalsFirst(monkeypatch):
+    monkeypatch.setattr(nmtracker, 'VERBOSE', False)
+    order = []
+    controllers = [FakeController(tag, priority, order) for (tag, priority) in [('A', 12.0), ('B', None), ('C', 2.0)]]
+    ts = nmtracker.TrackerScheduler(controllers, coalesce=False)
+    batch = [(0.0, 0, i, 0.0) for i in range(3)]
+    assert sorted(ts.runBatch(batch)) == batch
+    assert order == ['C', 'A', 'B']		# (B has no predictions, so it has the default priority)
+
+def test_trackerScheduler_requestsPerPeriod():
+    controllers = [FakeController(tag, None, []) for tag in 'ABCDEFGHIJKL']
+    controllers[0].useVehicleLocations = True
+    assert nmtracker.TrackerScheduler(controllers, coalesce=False).requestsPerPeriod() == 12		# (0.75 polls of 12 routes, and 3 location requests)
+    assert nmtracker.TrackerScheduler(controllers, coalesce=True).requestsPerPeriod() == 9		# (0.75 polls of 8 shared requests, and 3 location requests)
+    
+def test_trackerScheduler_pollsSeparatelyWhenSharedRequestFails(monkeypatch):
+    monkeypatch.setattr(nmtracker, 'VERBOSE', False)
+    order = []
+    controllers = [FakeController(tag, None, order) for tag in ['A', 'B']]
+    ts = nmtracker.TrackerScheduler(controllers, coalesce=True)
+    def updatePredictions(stopControllers): raise IOError('no connection')
+    monkeypatch.setattr(ts.coalescer, 'updatePredictions', updatePredictions)
+    with pytest.warns(UserWarning, match='polling the routes separately'):
+        ts.runBatch([(0.0, 0, i, 0.0) for i in range(2)])
+    assert order == ['A', 'B']
+
+def test_trackerScheduler_stopsControllersWhenLoopFails(monkeypatch, simulatedClock):
+    controllers = [FakeController(tag, None, []) for tag in ['A', 'B']]
+    ts = nmtracker.TrackerScheduler(controllers, coalesce=False)
+    def runBatch(batch): raise RuntimeError('unexpected')
+    monkeypatch.setattr(ts, 'runBatch', runBatch)
+    with pytest.raises(RuntimeError):
+        ts.start()
+    assert not ts.isRunning and all([tc.isStopped for tc in controllers])
+
+@pytest.mark.filterwarnings('ignore')
+def test_trackerController_skipsPollsWhileSuspended(tracker, monkeypatch, simulatedClock):
+    attempts = []
+    def updatePredictions():
+        attempts.append(nm.clockTime())
+        raise IOError('no connection')
+    monkeypatch.setattr(tracker.stopController, 'updatePredictions', updatePredictions)
+    
+    for i in range(nmtracker.BREAKER_FAILURES + 2):
+        tracker.runIteration()
+        simulatedClock.sleep(tracker.defaultWaitTime)
+    assert len(attempts) == nmtracker.BREAKER_FAILURES and tracker.failedCount == nmtracker.BREAKER_FAILURES
+    assert tracker.count == nmtracker.BREAKER_FAILURES + 2
+    
+    simulatedClock.sleep(nmtracker.BREAKER_COOLDOWN)
+    tracker.runIteration()
+    assert len(attempts) == nmtracker.BREAKER_FAILURES + 1		# (the trial poll)
+
+def test_replayResponses(testRoute, tmpdir, monkeypatch, capsys):
+    monkeypatch.setattr(nm, 'USE_STREAMING_PARSER', True)
+    cmdStr = 'predictionsForMultiStops&a=sf-muni' + ''.join(['&stops=T|%s' % s.tag for s in testRoute.stops])
+    response = ('<body><predictions routeTag="T" routeTitle="T-Test" stopTag="2" stopTitle="Stop 2">'
+                '<direction title="Inbound">%s</direction></predictions></body>')
+    prediction = '<prediction seconds="%i" minutes="%i" vehicle="8001" dirTag="T_IB" />'
+    
+    logFilename = str(tmpdir.join('responses.log.gz'))
+    recorder = nm.ResponseRecorder(logFilename)
+    t0 = 1337100000.0
+    for (t, minutes) in [(0, 3), (60, 2), (120, None)]:
+        recorder.record(t0 + t, cmdStr, response % (prediction % (minutes * 60, minutes) if minutes else ''))
+    recorder.close()
+    
+    tc = nmtracker.replayResponses(logFilename, 'T')
+    assert tc.isStopped and tc.count == 3
+    assert 'LOOP FAILED' not in capsys.readouterr()[0]		# (the replay ends when its responses run out)
+    assert archivedRows(tc) == [('2', '8001', 2, 1.0), ('2', '8001', 3, 2.0)]
+    assert nm.USE_REQUEST_BUDGET and not isinstance(nm.clock, nm.SimulatedClock)